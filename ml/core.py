@@ -1,26 +1,52 @@
 import os
+import sys
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from time import time
+import numpy as np
 import gin
 
-from ml.licchavi import Licchavi
+from ml.licchavi_base import LicchaviBase  # noqa: F401, gin configurable
 from ml.handle_data import (
-    select_criteria, shape_data, distribute_data,
+    get_columns, get_criterias_data, distribute_data,
     distribute_data_from_save, format_out_loc, format_out_glob)
+from ml.data_utility import (
+    FOLDER_PATH, PATH, reverse_idxs, load_checkpoint, checkpoint_exists)
+from ml.multi_criteria import (
+    distribute_data_multi, save_models_multi, load_models_multi,
+    format_out_multi)
+from ml.monitoring import (
+    timed, set_metric, record_peak_memory, get_metrics, update_metrics,
+    clear_metrics)
 
 
 TOURNESOL_DEV = bool(int(os.environ.get("TOURNESOL_DEV", 0)))  # dev mode
-FOLDER_PATH = "ml/checkpoints/"
-FILENAME = "models_weights"
-PATH = FOLDER_PATH + FILENAME
 os.makedirs(FOLDER_PATH, exist_ok=True)
 logging.basicConfig(filename="ml/ml_logs.log", level=logging.INFO)
 
 
+def _get_backend(backend):
+    """Returns the Licchavi class of a backend, imported only when used
+
+    backend (str): "torch" (autograd) or "numpy" (analytic gradients)
+
+    Returns:
+        (LicchaviBase subclass): Licchavi or LicchaviNumpy
+    """
+    if backend == "torch":
+        from ml.licchavi import Licchavi
+        return Licchavi
+    if backend == "numpy":
+        from ml.licchavi_numpy import LicchaviNumpy
+        return LicchaviNumpy
+    raise ValueError(f"Unknown Licchavi backend: {backend}")
+
+
 def _get_licchavi(
         nb_vids, vid_vidx, criteria,
-        device, verb, ground_truths, licchavi_class):
-    """ Used to decide wether to use Licchavi() or LicchaviDev() class
+        device, verb, ground_truths, licchavi_class, backend="torch"):
+    """ Used to decide wether to use a production backend or LicchaviDev()
 
     nb_vids (int): number of videos
     vid_vidx (dictionnary): dictionnary of {video ID: video index}
@@ -30,14 +56,15 @@ def _get_licchavi(
     verb (float): verbosity level
     global, local and s parmaeters ground truths (test mode only)
     licchavi_class (Licchavi()): training structure used
-                                        (Licchavi or LicchaviDev)
+                        (LicchaviDev, None to use -backend)
+    backend (str): backend used if -licchavi_class is None ("torch"/"numpy")
 
     Returns:
-        (Licchavi()): Licchavi or LicchaviDev object
+        (LicchaviBase()): Licchavi, LicchaviNumpy or LicchaviDev object
     """
-    if licchavi_class == Licchavi:
-        return Licchavi(
-            nb_vids, vid_vidx, criteria, verb=verb)
+    if licchavi_class is None:
+        return _get_backend(backend)(
+            nb_vids, vid_vidx, criteria, device=device, verb=verb)
     # only in dev mode
     else:
         test_mode = ground_truths is not None
@@ -56,11 +83,12 @@ def _set_licchavi(
     verb=2,
     device="cpu",
     ground_truths=None,
-    licchavi_class=Licchavi,
+    licchavi_class=None,
+    backend="torch",
 ):
     """Shapes data and inputs it in Licchavi to initialize
 
-    comparison_data (list of lists): output of fetch_data()
+    comparison_data (list of lists or tuple): output of fetch_data()
     criteria (str): rating criteria
     fullpath (str): path from which to load previous training
     resume (bool): wether to resume previous training or not
@@ -69,49 +97,105 @@ def _set_licchavi(
     ground_truths (float array, couples list list, float array):
         global, local and s parmaeters ground truths (test mode only)
     licchavi_class (Licchavi()): training structure used
-                                        (Licchavi or LicchaviDev)
+                        (LicchaviDev, None to use -backend)
+    backend (str): backend used if -licchavi_class is None ("torch"/"numpy")
 
     Returns :
         (Licchavi()): Licchavi object initialized with data
         (int array): array of users IDs in order
     """
-    # shape data
-    one_crit_data = select_criteria(comparison_data, criteria)
-    if len(one_crit_data) == 0:  # if no data for selected criteria
-        logging.warning(f"No comparison for this criteria ({criteria})")
+    full_data = get_criterias_data(comparison_data, [criteria])[criteria]
+    if full_data is None:
         return None, None
-    full_data = shape_data(one_crit_data)
+    return _set_licchavi_from_arr(
+        full_data, criteria, fullpath, resume, verb, device,
+        ground_truths, licchavi_class, backend
+    )
+
+
+def _set_licchavi_from_arr(
+    full_data,
+    criteria,
+    fullpath=None,
+    resume=False,
+    verb=2,
+    device="cpu",
+    ground_truths=None,
+    licchavi_class=None,
+    backend="torch",
+):
+    """Inputs shaped data in Licchavi to initialize
+
+    full_data (array tuple): comparisons of -criteria, see
+                                get_criterias_data()
+    criteria (str): rating criteria
+    fullpath (str): path from which to load previous training
+    resume (bool): wether to resume previous training or not
+    verb (int): verbosity level
+    device (str): device used (cpu/gpu)
+    ground_truths (float array, couples list list, float array):
+        global, local and s parmaeters ground truths (test mode only)
+    licchavi_class (Licchavi()): training structure used
+                        (LicchaviDev, None to use -backend)
+    backend (str): backend used if -licchavi_class is None ("torch"/"numpy")
+
+    Returns :
+        (Licchavi()): Licchavi object initialized with data
+        (int array): array of users IDs in order
+    """
     # set licchavi using data
-    if resume:
-        nodes_dic, users_ids, vid_vidx = distribute_data_from_save(
-            full_data, fullpath, device
-        )
-        licch = _get_licchavi(
-            len(vid_vidx), 
-            vid_vidx, 
-            criteria,
-            device, 
-            verb, 
-            ground_truths, 
-            licchavi_class
-        )
-        licch.load_and_update(nodes_dic, users_ids, fullpath)
-    else:
-        nodes_dic, users_ids, vid_vidx = distribute_data(full_data, device)
-        licch = _get_licchavi(
-            len(vid_vidx), 
-            vid_vidx, criteria,
-            device, 
-            verb, 
-            ground_truths, 
-            licchavi_class
-        )
-        licch.set_allnodes(nodes_dic, users_ids)
+    with timed("distribute", criteria):
+        if resume:
+            saved_data = load_checkpoint(fullpath)  # loaded once
+            nodes_data, users_ids, vid_vidx = distribute_data_from_save(
+                full_data, saved_data
+            )
+            licch = _get_licchavi(
+                len(vid_vidx), 
+                vid_vidx, 
+                criteria,
+                device, 
+                verb, 
+                ground_truths, 
+                licchavi_class,
+                backend,
+            )
+            licch.load_and_update(nodes_data, users_ids, saved_data)
+        else:
+            nodes_data, users_ids, vid_vidx = distribute_data(full_data)
+            licch = _get_licchavi(
+                len(vid_vidx), 
+                vid_vidx, criteria,
+                device, 
+                verb, 
+                ground_truths, 
+                licchavi_class,
+                backend,
+            )
+            licch.set_allnodes(nodes_data, users_ids)
     return licch, users_ids  # FIXME we can do without users_ids ?
 
 
+def _record_training(licch):
+    """Records metrics of the last training of -licch (see monitoring.py)
+
+    licch (Licchavi()): licchavi object trained
+    """
+    # all criterias at once in multi-criteria mode
+    criteria = licch.criteria if isinstance(licch.criteria, str) else "all"
+    for stage, duration in licch.times.items():  # train, uncertainty
+        set_metric("stage_seconds", duration, stage=stage, criteria=criteria)
+    epoch_time = licch.times["train"] / max(licch.nb_iters, 1)
+    set_metric("epoch_seconds", epoch_time, criteria=criteria)
+    set_metric("epochs", licch.nb_iters, criteria=criteria)
+    set_metric("nodes", licch.nb_nodes, criteria=criteria)
+    set_metric("videos", licch.nb_vids, criteria=criteria)
+    set_metric("comparisons", len(licch.vid1), criteria=criteria)
+
+
 def _train_predict(
-    licch, epochs, fullpath=None, save=False, verb=2, compute_uncertainty=False
+    licch, epochs, fullpath=None, save=False, verb=2, compute_uncertainty=False,
+    incremental=False,
 ):
     """Trains models and returns video scores for one criteria
 
@@ -120,23 +204,242 @@ def _train_predict(
     fullpath (str): path where to save trained models
     save (bool): wether to save the result of training or not
     verb (int): verbosity level
+    incremental (bool): wether to train only nodes whose comparisons
+                            changed since the checkpoint loaded
 
     Returns :
-    - (list of all vIDS , tensor of global video scores)
-    - (list of arrays of local vIDs , list of tensors of local video scores)
+    - (array of all vIDS , array of global video scores)
+    - (arrays of user indexes, vIDs and scores of all local scores)
     (float list list, float list): uncertainty of local scores,
                                     uncertainty of global scores
                                     (None, None) if not computed
     """
     uncertainties = licch.train(
         epochs,
-        compute_uncertainty=compute_uncertainty)
-    glob, loc = licch.output_scores()
+        compute_uncertainty=compute_uncertainty,
+        incremental=incremental)
+    _record_training(licch)
+    glob, loc = licch.output_flat_scores()
     if save:
-        licch.save_models(fullpath)
+        with timed("save", licch.criteria):
+            licch.save_models(fullpath)
     return glob, loc, uncertainties
 
 
+def _run_criteria(
+    full_data,
+    criteria,
+    epochs,
+    resume=False,
+    save=True,
+    verb=1,
+    device="cpu",
+    ground_truths=None,
+    compute_uncertainty=False,
+    licchavi_class=None,
+    backend="torch",
+    incremental=False,
+):
+    """Trains models and returns video scores for one criteria
+
+    full_data (array tuple): comparisons of -criteria, see
+                                get_criterias_data()
+    criteria (str): rating criteria
+    (other arguments are the ones of ml_run())
+
+    Returns:
+        (list list): global scores, see ml_run()
+        (list list): local scores, see ml_run()
+        (Licchavi(), tuple, tuple, tuple): licchavi object, global and
+            local outputs and uncertainties (used in dev mode)
+    """
+    logging.info("PROCESSING " + criteria)
+    fullpath = PATH + "_" + criteria
+    if incremental:
+        resume = checkpoint_exists(fullpath)
+        if not resume:
+            logging.warning(f"No saved models for this criteria ({criteria})")
+
+    # preparing data
+    licch, users_ids = _set_licchavi_from_arr(
+        full_data, criteria,
+        fullpath, resume, verb, device,
+        ground_truths, licchavi_class=licchavi_class, backend=backend
+    )
+    # training and predicting
+    glob, loc, uncertainties = _train_predict(
+        licch, epochs, fullpath, save, verb,
+        compute_uncertainty=compute_uncertainty,
+        incremental=incremental,
+    )
+    # putting in required shape for output
+    out_glob = format_out_glob(glob, criteria, uncertainties[0])
+    out_loc = format_out_loc(loc, users_ids, criteria, uncertainties[1])
+    record_peak_memory(criteria)
+    return out_glob, out_loc, (licch, glob, loc, uncertainties)
+
+
+# ----------- all criterias in one Licchavi -------------
+def _run_multi(
+    columns,
+    criterias,
+    epochs,
+    resume=False,
+    save=True,
+    verb=1,
+    device="cpu",
+    compute_uncertainty=False,
+    backend="torch",
+    incremental=False,
+):
+    """Trains all criterias at once in one Licchavi
+
+    columns (tuple): comparisons, output of get_columns()
+    criterias (str list): list of criterias to compute
+    (other arguments are the ones of ml_run())
+
+    Returns:
+        (list list, list list): global and local scores, see ml_run()
+    """
+    logging.info("PROCESSING " + ", ".join(criterias))
+    if incremental:  # (criteria, video) indexes change between runs
+        logging.warning("Incremental training trains all multi-criteria nodes")
+        resume = True
+    with timed("distribute"):
+        data = distribute_data_multi(columns, criterias)
+        if data is None:
+            logging.warning(f"No comparison for these criterias ({criterias})")
+            return [], []
+        nodes_data, layout = data
+        for crit, start, end in zip(criterias, layout[1][:-1], layout[1][1:]):
+            if start == end:
+                logging.warning(f"No comparison for this criteria ({crit})")
+
+        nb_glob = len(layout[4])  # number of (criteria, video) couples
+        licch = _get_backend(backend)(
+            nb_glob, reverse_idxs(range(nb_glob)), criterias,
+            device=device, verb=verb
+        )
+        licch.set_allnodes(nodes_data, np.arange(len(layout[2])))
+        if resume:
+            load_models_multi(licch, layout, PATH)
+    uncertainties = licch.train(epochs, compute_uncertainty=compute_uncertainty)
+    _record_training(licch)
+    if save:
+        with timed("save"):
+            save_models_multi(licch, layout, PATH)
+    return format_out_multi(licch, layout, uncertainties)
+
+
+# ----------- parallel training of criterias -------------
+_SHARED = {}  # comparisons shared by the main process (in workers only)
+
+
+def _init_worker(shm_name, nb_comps, config_str, nb_threads, backend):
+    """Initializes a worker process training criterias
+
+    shm_name (str): name of shared memory with comparisons of all criterias
+    nb_comps (int): number of comparisons of all criterias
+    config_str (str): gin configuration of the main process
+    nb_threads (int): maximum number of torch threads
+    backend (str): backend used ("torch"/"numpy")
+    """
+    from multiprocessing import shared_memory  # python >= 3.8, when used
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _SHARED["shm"] = shm  # keeping a reference keeps the buffer alive
+    # IDs (users, videos 1, videos 2) then ratings, see _run_parallel()
+    _SHARED["ids"] = np.ndarray((3, nb_comps), dtype=np.int64, buffer=shm.buf)
+    _SHARED["r"] = np.ndarray(
+        nb_comps, dtype=np.float64, buffer=shm.buf, offset=3 * nb_comps * 8
+    )
+    gin.parse_config(config_str)
+    if backend == "torch":
+        import torch
+        torch.set_num_threads(nb_threads)
+
+
+def _run_criteria_worker(criteria, start, end, run_kwargs):
+    """Trains one criteria in a worker, on lines [start, end[ of comparisons
+
+    Returns:
+        (list list, list list): global and local scores, see ml_run()
+        (dictionnary): metrics recorded for this criteria (see monitoring.py)
+    """
+    clear_metrics()  # metrics of previous criterias were already returned
+    ids, r = _SHARED["ids"][:, start:end], _SHARED["r"][start:end]  # views
+    full_data = (ids[0], ids[1], ids[2], r)
+    out_glob, out_loc, _ = _run_criteria(full_data, criteria, **run_kwargs)
+    return out_glob, out_loc, get_metrics()
+
+
+def _run_parallel(crits_data, criterias, workers, run_kwargs):
+    """Trains criterias concurrently in a pool of worker processes
+
+    crits_data (dictionnary): output of get_criterias_data()
+    criterias (str list): list of criterias to compute
+    workers (int): maximum number of worker processes
+    run_kwargs (dictionnary): arguments of _run_criteria()
+
+    Returns:
+        (list list, list list): global and local scores, see ml_run()
+    """
+    from multiprocessing import shared_memory  # python >= 3.8, when used
+
+    l_crit, l_data = [], []
+    for criteria in criterias:
+        full_data = crits_data[criteria]
+        if full_data is not None:
+            l_crit.append(criteria)
+            l_data.append(full_data)
+    if not l_crit:
+        return [], []
+    # comparisons of all criterias, those of criteria i in [off[i], off[i+1][
+    offsets = np.cumsum([0] + [len(data[0]) for data in l_data])
+    nb_comps = int(offsets[-1])
+    # one buffer, int64 IDs (users, videos 1, videos 2) then float64 ratings
+    shm = shared_memory.SharedMemory(create=True, size=32 * nb_comps)
+    ids = np.ndarray((3, nb_comps), dtype=np.int64, buffer=shm.buf)
+    for col in range(3):
+        ids[col] = np.concatenate([data[col] for data in l_data])
+    r = np.ndarray(
+        nb_comps, dtype=np.float64, buffer=shm.buf, offset=3 * nb_comps * 8
+    )
+    r[:] = np.concatenate([data[3] for data in l_data])
+    del ids, r
+
+    nb_workers = min(workers, len(l_crit))
+    nb_threads = max(1, (os.cpu_count() or 1) // nb_workers)
+    initargs = (
+        shm.name, nb_comps, gin.config_str(),
+        nb_threads, run_kwargs["backend"]
+    )
+    glob_scores, loc_scores = [], []
+    try:
+        with ProcessPoolExecutor(
+            nb_workers,
+            # forking a process using torch threads can deadlock
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=initargs,
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _run_criteria_worker, crit, start, end, run_kwargs
+                )
+                for crit, start, end in zip(l_crit, offsets[:-1], offsets[1:])
+            ]
+            for future in futures:  # keeping criterias order
+                out_glob, out_loc, metrics = future.result()
+                update_metrics(metrics)
+                glob_scores += out_glob
+                loc_scores += out_loc
+    finally:
+        shm.close()
+        shm.unlink()
+    return glob_scores, loc_scores
+
+
 @gin.configurable
 def ml_run(
     comparison_data,
@@ -148,11 +451,18 @@ def ml_run(
     device="cpu",
     ground_truths=None,
     compute_uncertainty=False,
-    licchavi_class=Licchavi,
+    licchavi_class=None,
+    backend="torch",
+    workers=1,
+    multi_criteria=False,
+    incremental=False,
 ):
     """Runs the ml algorithm for all criterias
 
-    comparison_data (list of lists): output of fetch_data()
+    comparison_data (list of lists or tuple): output of fetch_data(),
+                        or list of [contributor_id: int, video_id_1: int,
+                        video_id_2: int, criteria: str, score: float,
+                        weight: float]
     epochs (int): number of epochs of gradient descent for Licchavi
     criterias (str list): list of criterias to compute
     resume (bool): wether to resume from save or not
@@ -162,7 +472,17 @@ def ml_run(
     ground_truths (float array, couples list list, float array):
         global, local and s parmaeters ground truths (test mode only)
     licchavi_class (Licchavi()): training structure used
-                                        (Licchavi or LicchaviDev)
+                        (LicchaviDev, None to use -backend)
+    backend (str): "torch" (Licchavi) or "numpy" (LicchaviNumpy),
+                        used if -licchavi_class is None
+    workers (int): number of processes training criterias concurrently
+                        (1 to train them one after another)
+    multi_criteria (bool): wether to train all criterias at once in one
+                        Licchavi (with one learning rate schedule)
+    incremental (bool): wether to resume from save training only nodes
+                        whose comparisons changed since the save (and
+                        global scores of videos they rate), see
+                        LicchaviBase._train_incremental()
 
     Returns:
         (list list): list of [video_id: int, criteria_name: str,
@@ -173,34 +493,50 @@ def ml_run(
     """  # FIXME: not better to regroup contributors in same list or smthg ?
     ml_run_time = time()
     glob_scores, loc_scores = [], []
+    run_kwargs = {
+        "epochs": epochs,
+        "resume": resume,
+        "save": save,
+        "verb": verb,
+        "device": device,
+        "compute_uncertainty": compute_uncertainty,
+        "backend": backend,
+        "incremental": incremental,
+    }
 
-    for criteria in criterias:
-        logging.info("PROCESSING " + criteria)
-        fullpath = PATH + "_" + criteria
-
-        # preparing data
-        licch, users_ids = _set_licchavi(
-            comparison_data, criteria,
-            fullpath, resume, verb, device,
-            ground_truths, licchavi_class=licchavi_class
+    if (workers > 1 or multi_criteria) and TOURNESOL_DEV:
+        logging.warning("Dev mode trains criterias one after another")
+    if workers > 1 and sys.version_info < (3, 8):  # no shared_memory
+        logging.warning("Python >= 3.8 is required to use several workers")
+        workers = 1
+    multi_criteria = multi_criteria and not TOURNESOL_DEV
+    with timed("shape"):
+        columns = get_columns(comparison_data)
+        if not multi_criteria:
+            crits_data = get_criterias_data(columns, criterias)
+    if multi_criteria:
+        glob_scores, loc_scores = _run_multi(columns, criterias, **run_kwargs)
+    elif workers > 1 and not TOURNESOL_DEV:
+        glob_scores, loc_scores = _run_parallel(
+            crits_data, criterias, workers, run_kwargs
         )
+    else:
+        for criteria in criterias:
+            full_data = crits_data.pop(criteria, None)  # freed once trained
+            if full_data is not None:  # if not 0 data for selected criteria
+                out_glob, out_loc, infos = _run_criteria(
+                    full_data, criteria,
+                    ground_truths=ground_truths,
+                    licchavi_class=licchavi_class,
+                    **run_kwargs
+                )
+                glob_scores += out_glob
+                loc_scores += out_loc
 
-        if licch is not None:  # if not 0 data for selected criteria
-
-            # training and predicting
-            glob, loc, uncertainties = _train_predict(
-                licch, epochs, fullpath, save, verb,
-                compute_uncertainty=compute_uncertainty
-            )
-            # putting in required shape for output
-            out_glob = format_out_glob(glob, criteria, uncertainties[0])
-            out_loc = format_out_loc(loc, users_ids, criteria, uncertainties[1])
-            glob_scores += out_glob
-            loc_scores += out_loc
-
+    record_peak_memory()
     logging.info(f'ml_run() total time : {round(time() - ml_run_time)}')
     if TOURNESOL_DEV:  # return more information in dev mode
-        return glob_scores, loc_scores, (licch, glob, loc, uncertainties)
+        return glob_scores, loc_scores, infos
     return glob_scores, loc_scores
 
 
@@ -1,12 +1,14 @@
-import torch
 import numpy as np
 import json
 import pickle
 import os
 import shutil
+from statistics import median
 
 """
-Utility functions used in "handle_data.py"
+Utility functions used in "handle_data.py" and Licchavi backends
+
+Doesn't depend on torch
 
 Main file is "ml_train.py"
 """
@@ -17,102 +19,164 @@ def rescale_rating(rating):
     return rating / 50 - 1
 
 
-def get_all_vids(arr):
+def get_all_vids(vid1, vid2):
     """get all unique vIDs for one criteria (all users)
 
-    arr (2D float array): 1 line is [userID, vID1, vID2, r]
+    vid1 (int array): IDs of first videos compared
+    vid2 (int array): IDs of second videos compared
 
     Returns:
-        (float array): unique video IDs
+        (int array): unique video IDs
     """
-    return np.unique(arr[:, 1:3])  # columns 1 and 2 are what we want
+    return np.unique(np.concatenate((vid1, vid2)))
+
 
+def sort_by_first(cols):
+    """sorts columns (arrays of same length) by the first one"""
+    order = np.argsort(cols[0], kind="stable")
+    return tuple(col[order] for col in cols)
 
-def get_mask(batch1, batch2):
-    """returns boolean tensor indicating which videos the user rated
 
-    batch1 (2D bool tensor): 1 line is a one-hot encoded video index
-    batch2 (2D bool tensor): 1 line is a one-hot encoded video index
+def get_vidxs(vid_vidx, l_vid):
+    """Converts video IDs to video indexes (vectorized)
+
+    vid_vidx (int dictionnary): dictionnary of {vID: vidx}
+    l_vid (int array): video IDs
 
     Returns:
-        (bool tensor): True for all indexes rated by the user
+        (int array): video indexes
     """
-    return torch.sum(batch1 + batch2, axis=0, dtype=bool)
+    vids = np.fromiter(vid_vidx.keys(), dtype=np.int64, count=len(vid_vidx))
+    vidxs = np.fromiter(vid_vidx.values(), dtype=np.int64, count=len(vid_vidx))
+    order = np.argsort(vids)
+    positions = np.searchsorted(vids[order], l_vid)
+    return vidxs[order][positions]
 
 
-def sort_by_first(arr):
-    """sorts 2D array lines by first element of lines"""
-    order = np.argsort(arr, axis=0)[:, 0]
-    return arr[order, :]
+def get_offsets(user_col):
+    """Returns users and boundaries of their comparisons
 
+    user_col (int array): user ID of each comparison, sorted
+
+    Returns:
+        (int array): unique user IDs
+        (int array): offsets, comparisons of user i are in
+                        [offsets[i], offsets[i + 1][
+    """
+    user_ids, first_of_each = np.unique(user_col, return_index=True)
+    offsets = np.append(first_of_each, len(user_col)).astype(np.int64)
+    return user_ids, offsets
 
-def one_hot_vid(vid_vidx, vid):
-    """One-hot inputs for neural network
 
-    vid_vidx (dictionnary): dictionnary of {vID: idx}
-    vid (int): video ID
+def get_comp_uidxs(offsets):
+    """Returns node index of each comparison
+
+    offsets (int array): comparisons of user i are in
+                            [offsets[i], offsets[i + 1][
 
     Returns:
-        (1D boolean tensor): one-hot encoded video index
+        (int array): user index of each comparison
     """
-    tens = torch.zeros(len(vid_vidx), dtype=bool)
-    tens[vid_vidx[vid]] = True
-    return tens
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
 
 
-def one_hot_vids(vid_vidx, l_vid, device="cpu"):
-    """One-hot inputs for neural network, list to batch
+def get_rated_pairs(uidxs, vidx1, vidx2, nb_vids):
+    """Returns all (user, video) couples appearing in comparisons
 
-    vid_vidx (int dictionnary): dictionnary of {vID: vidx}
-    vid (int list): list of vID
-    device (str): device used (cpu/gpu)
+    uidxs (int array): user index of each comparison
+    vidx1 (int array): first videos compared
+    vidx2 (int array): second videos compared
+    nb_vids (int): total number of videos
 
     Returns:
-        (2D boolean tensor): one line is one-hot encoded video index
+        (int array): user indexes, sorted
+        (int array): video indexes, sorted for each user
     """
-    batch = torch.zeros(len(l_vid), len(vid_vidx), dtype=bool, device=device)
-    for idx, vid in enumerate(l_vid):
-        batch[idx][vid_vidx[vid]] = True
-    return batch
+    keys = np.unique(
+        np.concatenate((uidxs * nb_vids + vidx1, uidxs * nb_vids + vidx2))
+    )
+    return keys // nb_vids, keys % nb_vids
 
 
-def get_batch_r(node_arr, device="cpu"):
-    """Returns batch of one user's ratings
+def get_pairs_positions(ref_uidxs, ref_vidxs, uidxs, vidxs, nb_vids):
+    """Finds (user, video) couples in a reference list of couples
 
-    node_arr (2D float array): one line is [userID, vID1, vID2, rating]
-    device (str): device used (cpu/gpu)
+    ref_uidxs (int array): user indexes of reference couples, sorted
+    ref_vidxs (int array): video indexes of reference couples,
+                                sorted for each user
+    uidxs (int array): user indexes of couples to find
+    vidxs (int array): video indexes of couples to find
+    nb_vids (int): total number of videos (more than any video index)
 
     Returns:
-        (float tensor): batch of ratings
+        (int array): position of each couple in reference couples
+        (bool array): True for couples found in reference couples
     """
-    return torch.FloatTensor(node_arr[:, 3], device=device)
+    ref_keys = ref_uidxs * nb_vids + ref_vidxs
+    keys = uidxs * nb_vids + vidxs
+    positions = np.searchsorted(ref_keys, keys)
+    positions = positions.clip(max=max(len(ref_keys) - 1, 0))
+    found = ref_keys[positions] == keys if len(ref_keys) else keys < 0
+    return positions, found
 
 
-def reverse_idxs(vids):
-    """Returns dictionnary of {vid: vidx}
+def get_vid_index(rated_vidxs, nb_vids):
+    """Returns local scores of each video (video to contributors index)
 
-    vids (int iterable): unique video IDs
+    rated_vidxs (int array): video index of each local score
+    nb_vids (int): total number of videos
 
     Returns:
-        (int:int dictionnary): dictionnary of {videoID: video index}
+        (int array): positions of local scores, grouped by video
+        (int array): offsets, local scores of video j are at positions
+                        order[offsets[j]:offsets[j + 1]]
     """
-    return {vid: idx for idx, vid in enumerate(vids)}
+    order = np.argsort(rated_vidxs, kind="stable")
+    offsets = np.searchsorted(rated_vidxs[order], np.arange(nb_vids + 1))
+    return order, offsets
+
+
+def _mix64(keys):
+    """Mixes bits of 64 bits keys (splitmix64 finalizer)"""
+    keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return keys ^ (keys >> np.uint64(31))
+
 
+def get_comps_hashes(vid1, vid2, r, offsets):
+    """Returns a fingerprint of the comparisons of each user
 
-# used for updating models after loading
-def expand_tens(tens, nb_new, device="cpu"):
-    """Expands a tensor to include scores for new videos
+    A fingerprint doesn't depend on the order of comparisons, it changes
+    when a comparison of this user is added, removed or edited
 
-    tens (tensor): a detached tensor
-    nb_new (int): number of parameters to add
-    device (str): device used (cpu/gpu)
+    vid1 (int array): IDs of first videos compared
+    vid2 (int array): IDs of second videos compared
+    r (float array): ratings
+    offsets (int array): comparisons of user i are in
+                            [offsets[i], offsets[i + 1][
 
     Returns:
-        (tensor): expanded tensor requiring gradients
+        (uint64 array): fingerprint of each user
     """
-    expanded = torch.cat([tens, torch.zeros(nb_new, device=device)])
-    expanded.requires_grad = True
-    return expanded
+    if len(r) == 0:
+        return np.zeros(len(offsets) - 1, dtype=np.uint64)
+    # IDs hashed as floats, fingerprints of previous checkpoints stay valid
+    cols = np.stack([vid1, vid2, r]).astype(np.float64).view(np.uint64)
+    keys = _mix64(cols[0])
+    keys = _mix64(keys ^ cols[1])
+    keys = _mix64(keys ^ cols[2])
+    return np.add.reduceat(keys, offsets[:-1])  # sum modulo 2^64
+
+
+def reverse_idxs(vids):
+    """Returns dictionnary of {vid: vidx}
+
+    vids (int iterable): unique video IDs
+
+    Returns:
+        (int:int dictionnary): dictionnary of {videoID: video index}
+    """
+    return {vid: idx for idx, vid in enumerate(vids)}
 
 
 def expand_dic(vid_vidx, l_vid_new):
@@ -132,6 +196,62 @@ def expand_dic(vid_vidx, l_vid_new):
     return vid_vidx
 
 
+def round_loss(tens, dec=0):
+    """from an input scalar tensor/array or int/float returns rounded int/float"""
+    if type(tens) is int or type(tens) is float:
+        return round(tens, dec)
+    else:
+        return round(tens.item(), dec)
+
+
+def _global_uncert(values, prior=4, weight=5):
+    """Returns posterior value of median
+
+    prior(float): value of prior median
+    weight (int): weight of prior
+    values (float list): data to take median of
+
+    Returns:
+        (float): global uncertainty for one video
+    """
+    full_values = values + [prior] * weight
+    return median(full_values) / len(values) ** 0.5
+
+
+def _global_uncerts(dists, vid_order, vid_offsets, prior=4, weight=5):
+    """Returns posterior value of median for all videos at once
+
+    Same as _global_uncert() for each video, vectorized
+
+    dists (float array): distance of each local score to its global score
+    vid_order (int array): positions of local scores, grouped by video
+    vid_offsets (int array): local scores of video j are at positions
+                                vid_order[vid_offsets[j]:vid_offsets[j + 1]]
+    prior(float): value of prior median
+    weight (int): weight of prior
+
+    Returns:
+        (float array): global uncertainty for each video
+    """
+    counts = np.diff(vid_offsets)
+    starts = vid_offsets[:-1]
+    vidxs = np.repeat(np.arange(len(counts)), counts)
+    dists = dists[vid_order]
+    dists = dists[np.lexsort((dists, vidxs))]  # sorted for each video
+    nb_below = np.bincount(vidxs, dists < prior, len(counts))
+
+    def _nth(idxs):
+        """Returns element idxs[j] of sorted (values + priors) of video j"""
+        is_prior = (nb_below <= idxs) & (idxs < nb_below + weight)
+        idxs = np.where(idxs < nb_below, idxs, idxs - weight)
+        idxs = np.clip(starts + idxs, 0, max(len(dists) - 1, 0))
+        return np.where(is_prior, prior, dists[idxs] if len(dists) else 0)
+
+    nb_values = counts + weight
+    medians = (_nth((nb_values - 1) // 2) + _nth(nb_values // 2)) / 2
+    return medians / counts ** 0.5
+
+
 # folder manipulation
 def replace_dir(path):
     ''' create or replace directory '''
@@ -171,3 +291,172 @@ def load_from_pickle(name="pickle"):
     with open(filename, "rb") as filehandler:
         obj = pickle.load(filehandler)
     return obj
+
+
+# checkpoints
+FOLDER_PATH = "ml/checkpoints/"
+FILENAME = "models_weights"
+PATH = FOLDER_PATH + FILENAME  # criteria name is appended
+ARRAYS_MAGIC = b"LICCHAVI"  # first bytes of files written by save_arrays()
+ALIGN = 64  # arrays start at multiples of ALIGN bytes
+CKPT_EXT = ".ckpt"  # extension of checkpoints
+CKPT_KEYS = (  # local arrays of checkpoints, see save_checkpoint()
+    "users", "s", "rated_offsets", "rated_vidxs", "models", "ages",
+    "comp_hashes",
+)
+
+
+def _aligned(nbytes):
+    """Returns the smallest multiple of ALIGN greater or equal to -nbytes"""
+    return -(-nbytes // ALIGN) * ALIGN
+
+
+def save_arrays(arrays, meta, filename):
+    """Saves numpy arrays in one file, atomically
+
+    The file is a json header followed by raw arrays, it is written to
+    a temporary file then renamed, a previous file is never left half
+    written.
+
+    arrays (dictionnary): {name: numpy array}
+    meta (dictionnary): json serializable informations
+    filename (str): path of file
+    """
+    arrays = {key: np.ascontiguousarray(arr) for key, arr in arrays.items()}
+    header, offset = {}, 0
+    for key, arr in arrays.items():
+        header[key] = (arr.dtype.str, arr.shape, offset)
+        offset += _aligned(arr.nbytes)
+    head = json.dumps({"meta": meta, "arrays": header}).encode()
+    start = _aligned(len(ARRAYS_MAGIC) + 8 + len(head))
+
+    tmp_name = f"{filename}.tmp{os.getpid()}"
+    with open(tmp_name, "wb") as f:
+        f.write(ARRAYS_MAGIC)
+        f.write(np.uint64(len(head)).tobytes())
+        f.write(head)
+        for key, arr in arrays.items():
+            f.seek(start + header[key][2])
+            f.write(arr.data)
+        f.truncate(start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_name, filename)
+
+
+def load_arrays(filename, mmap=True):
+    """Loads arrays saved with save_arrays()
+
+    filename (str): path of file
+    mmap (bool): wether to memory map arrays (copy on write) or read them
+
+    Returns:
+        (dictionnary): meta informations
+        (dictionnary): {name: numpy array}
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(ARRAYS_MAGIC)) != ARRAYS_MAGIC:
+            raise ValueError(f"{filename} is not an arrays file")
+        len_head = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        head = json.loads(f.read(len_head))
+        start = _aligned(len(ARRAYS_MAGIC) + 8 + len_head)
+        arrays = {}
+        for key, (dtype, shape, offset) in head["arrays"].items():
+            dtype, shape = np.dtype(dtype), tuple(shape)
+            count = int(np.prod(shape))
+            if mmap and count > 0:
+                arrays[key] = np.memmap(
+                    f, dtype=dtype, mode="c", offset=start + offset, shape=shape
+                )
+            else:
+                f.seek(start + offset)
+                arrays[key] = np.fromfile(f, dtype=dtype, count=count)
+                arrays[key] = arrays[key].reshape(shape)
+    return head["meta"], arrays
+
+
+def save_checkpoint(saved_data, name):
+    """Saves trained models in a checkpoint, see load_checkpoint()
+
+    saved_data (str, dictionnary, float array, array tuple): criteria,
+        {video ID: video index}, global scores and (users IDs, s, rated
+        offsets, rated vidxs, local scores, ages (, fingerprints of
+        comparisons))
+    name (str): path of checkpoint, without extension
+    """
+    criteria, vid_vidx, glob, local_data = saved_data
+    vids = np.empty(len(vid_vidx), dtype=np.int64)  # video IDs by video index
+    vids[list(vid_vidx.values())] = list(vid_vidx.keys())
+    arrays = dict(zip(CKPT_KEYS, local_data))
+    arrays.update(vids=vids, glob=glob)
+    save_arrays(arrays, {"criteria": criteria}, name + CKPT_EXT)
+
+
+def _load_torch_checkpoint(name):
+    """Loads and converts a checkpoint saved with torch.save() by versions
+    with one dense local model (all videos) per node
+
+    Local scores of videos a node didn't rate were never trained, they
+    are 0 and are not kept (a rated video scored exactly 0 is
+    initialized again to 0 when loaded)
+
+    name (str): path of checkpoint (without extension)
+
+    Returns:
+        (tuple): same as load_checkpoint(), without fingerprints
+    """
+    import torch  # imported when used, only these checkpoints need it
+
+    try:  # IDs are numpy scalars, refused by torch >= 2.6 default loader
+        saved_data = torch.load(name, weights_only=False)
+    except TypeError:  # torch < 1.13
+        saved_data = torch.load(name)
+    criteria, vid_vidx, glob, loc_models = saved_data
+    users = np.array(sorted(loc_models), dtype=np.int64)
+    s, ages, l_vidxs, l_models = [], [], [], []
+    for uid in users:
+        s_node, model, age = loc_models[uid]
+        model = model.detach().cpu().numpy()
+        vidxs = np.flatnonzero(model)
+        s.append(float(s_node))
+        ages.append(age)
+        l_vidxs.append(vidxs)
+        l_models.append(model[vidxs])
+    rated_offsets = np.cumsum([0] + [len(vidxs) for vidxs in l_vidxs])
+    local_data = (
+        users,
+        np.array(s, dtype=np.float32),
+        rated_offsets,
+        np.concatenate(l_vidxs + [np.zeros(0, dtype=np.int64)]),
+        np.concatenate(l_models + [np.zeros(0, dtype=np.float32)]),
+        np.array(ages, dtype=np.int64),
+    )
+    vid_vidx = {int(vid): int(vidx) for vid, vidx in vid_vidx.items()}
+    glob = glob.detach().cpu().numpy()
+    return criteria, vid_vidx, glob, local_data
+
+
+def load_checkpoint(name):
+    """Loads a checkpoint, arrays are memory mapped
+
+    Checkpoints saved with torch.save() by previous versions (at -name,
+    without extension) are converted
+
+    name (str): path of checkpoint, without extension
+
+    Returns:
+        (str, dictionnary, float array, array tuple): same as saved
+            with save_checkpoint()
+    """
+    if not os.path.exists(name + CKPT_EXT):
+        return _load_torch_checkpoint(name)
+    meta, arrays = load_arrays(name + CKPT_EXT)
+    # video IDs were saved as floats before version with int64 IDs
+    vid_vidx = reverse_idxs(arrays["vids"].astype(np.int64).tolist())
+    local_data = tuple(arrays[key] for key in CKPT_KEYS if key in arrays)
+    return meta["criteria"], vid_vidx, arrays["glob"], local_data
+
+
+def checkpoint_exists(name):
+    """Returns True if a checkpoint (or a torch.save() one) exists at -name"""
+    return os.path.exists(name + CKPT_EXT) or os.path.isfile(name)
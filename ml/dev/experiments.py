@@ -33,7 +33,7 @@ def run_experiment(comparison_data):
         5, 3, 5,  # 40, 27, 30,
         dens=0.8,
         noise=0.02)
-    print(len(comparison_data))
+    print(len(comparison_data[1]))  # number of comparisons
     glob_scores, loc_scores, infos = ml_run(
         comps_fake,
         EPOCHS,
@@ -1,96 +1,130 @@
-import random
 import numpy as np
-from math import exp, sinh
-import scipy.stats as st
 import logging
 
+from ..data_utility import save_arrays, load_arrays
+
+"""
+Generation of fake comparisons with ground truths (not used in production)
+
+Structure:
+- all draws are vectorized numpy operations on arrays of all users, with
+    a numpy random Generator (seed given, or drawn from np.random)
+- generate_data() returns lists (comparisons like fetch_data() ones and
+    ground truths), generate_columns() returns columns (like get_columns()
+    ones) for large scale data, optionally saved to a file
+"""
+
+CHUNK_SIZE = 10 ** 7  # maximum number of random keys drawn at once
+
+
+def _get_rng(seed=None):
+    """Returns a numpy random Generator
+
+    seed (int): seed of the generator, None to draw it with np.random
+                    (seeded by seedall() in experiments)
+    """
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    return np.random.default_rng(seed)
+
 
 # ----------- fake data generation ---------------
-def _fake_glob_scores(nb_vid, scale=1):
+def _fake_glob_scores(nb_vid, scale=1, rng=None):
     """Creates fake global scores for test
 
     nb_vid (int): number of videos "generated"
     scale (float): variance of generated global scores
+    rng (numpy Generator): source of randomness
 
     Returns:
         (float array): fake global scores
     """
-    glob_scores = np.random.normal(scale=scale, size=nb_vid)
+    rng = rng or _get_rng()
+    glob_scores = rng.normal(scale=scale, size=nb_vid)
     return glob_scores
 
 
-def _fake_loc_scores(distribution, glob_scores, loc_noise):
+def _pick_videos(nb_vids, nb_users, vids_per_user, rng):
+    """Draws videos rated by each user, without repetition
+
+    Returns:
+        (2D int array): video indexes, one line per user
+    """
+    if vids_per_user ** 2 < nb_vids:  # few repetitions, drawn again
+        vidxs = rng.integers(nb_vids, size=(nb_users, vids_per_user))
+        redraw = np.arange(nb_users)
+        while len(redraw):
+            sort = np.sort(vidxs[redraw], axis=1)
+            redraw = redraw[(sort[:, 1:] == sort[:, :-1]).any(axis=1)]
+            vidxs[redraw] = rng.integers(
+                nb_vids, size=(len(redraw), vids_per_user)
+            )
+        return vidxs
+    vidxs = np.empty((nb_users, vids_per_user), dtype=np.int64)
+    chunk = max(1, CHUNK_SIZE // max(nb_vids, 1))  # users by chunk
+    for start in range(0, nb_users, chunk):
+        keys = rng.random((min(chunk, nb_users - start), nb_vids))
+        # videos with the smallest random keys, in random order
+        vidxs[start:start + chunk] = np.argpartition(
+            keys, vids_per_user - 1, axis=1
+        )[:, :vids_per_user]
+    return vidxs
+
+
+def _fake_loc_scores(vidxs, glob_scores, loc_noise, rng=None):
     """Creates fake local scores for test
 
-    distribution (int list): list of videos rated by the user
+    vidxs (2D int array): videos rated by each user, one line per user
     glob_scores (float array): fake global scores
-    w (float): nodes weight
     loc_noise (float): variance/std of local scores noise
+    rng (numpy Generator): source of randomness
 
     Returns:
-        (list of list of couples): (vid, local score) for each video
-                                            of each node
+        (2D float array): local score of each video of each user
     """
-    all_idxs = range(len(glob_scores))
-    b = loc_noise  # scale of laplace noise
-    l_nodes = []
-    for nb_vids in distribution:  # for each node
-        pick_idxs = random.sample(all_idxs, nb_vids)  # videos rated by user
-        noises = np.random.laplace(size=nb_vids, scale=b)  # random noise
-        node = [
-            (idx, glob_scores[idx] + noise) for idx, noise in zip(pick_idxs, noises)
-        ]  # list of (video id , video local score)
-        l_nodes.append(node)
-    return l_nodes
-
-
-def _fake_s(nb_s, multiple_scales=True):
+    rng = rng or _get_rng()
+    noises = rng.laplace(size=vidxs.shape, scale=loc_noise)  # random noise
+    return glob_scores[vidxs] + noises
+
+
+def _fake_s(nb_s, multiple_scales=True, rng=None):
     """Returns random s parameters
 
     nb_s (int): number of s parameters required
     multiple_scales (bool): wether to draw s parameters or set all to 1
+    rng (numpy Generator): source of randomness
 
     Returns:
         (float array): random independant s parameters
     """
+    rng = rng or _get_rng()
     if multiple_scales:
-        return np.random.gamma(4, scale=0.3, size=nb_s)
+        return rng.gamma(4, scale=0.3, size=nb_s)
     return np.ones(nb_s)
 
 
-def _rate_density(r, a, b, s):
-    """Returns density of r knowing a and b
+def _get_rd_rates(a, b, s, rng=None):
+    """Gives random comparison scores, drawn with the inverse of the
+    cumulative distribution function of r knowing a and b
+    (density of r is t * exp(-r * t) / (2 * sinh(t)), t = s * (a - b))
 
-    r (float in [-1, 1]): comparison rate
-    a (float): local score of video a
-    b (float): local score of video b
-    s (float): scaling parameter of user
+    a (float array): local scores of videos a
+    b (float array): local scores of videos b
+    s (float array): scaling parameters of users
+    rng (numpy Generator): source of randomness
 
     Returns:
-        (float): density of r knowing a and b
+        (float array): random comparison scores, in [-1, 1]
     """
+    rng = rng or _get_rng()
     t = s * (a - b)
-    dens = t * exp(-r * t) / (2 * sinh(t))
-    return dens
-
-
-def _get_rd_rate(a, b, s):
-    """Gives a random comparison score
-
-    a (float): local score of video a
-    b (float): local score of video b
-    s (float): scaling parameter of user
-
-    Returns:
-        (float): random comparison score
-    """
-
-    class my_pdf(st.rv_continuous):
-        def _pdf(self, r):
-            return _rate_density(r, a, b, s)
-
-    my_cv = my_pdf(a=-1, b=1, name="my_pdf")
-    return my_cv.rvs()
+    u = rng.uniform(size=len(t))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # exp(-r * t) = (1 - u) * exp(t) + u * exp(-t)
+        r = -np.logaddexp(np.log1p(-u) + t, np.log(u) - t) / t
+    small = np.abs(t) < 1e-6  # uniform density when t is 0
+    r[small] = 2 * u[small] - 1
+    return np.clip(r, -1, 1)
 
 
 def _unscale_rating(r):
@@ -98,41 +132,80 @@ def _unscale_rating(r):
     return (r + 1) * 50
 
 
-def _fake_comparisons(l_nodes, s_params, dens=0.5, crit="test"):
-    """
+def _fake_pairs(nb_users, vids_per_user, dens, rng):
+    """Draws pairs of videos compared by each user
+
+    The video at position i of a user is compared to int(dens * (n - i))
+    videos drawn among the following ones (n videos per user)
 
-    l_nodes (list of list of couples): (vid, local score) for each video
-                                                            of each node
+    Returns:
+        (int array, int array, int array): user index and positions of
+            both videos of each comparison, grouped by user
+    """
+    l_uidx, l_pos1, l_pos2 = [], [], []
+    for pos in range(vids_per_user):  # same position for all users
+        nb_following = vids_per_user - pos - 1
+        nb_comp = min(int(dens * (vids_per_user - pos)), nb_following)
+        if nb_comp <= 0:
+            continue
+        keys = rng.random((nb_users, nb_following))
+        picks = np.argpartition(keys, nb_comp - 1, axis=1)[:, :nb_comp]
+        l_uidx.append(np.repeat(np.arange(nb_users), nb_comp))
+        l_pos1.append(np.full(nb_users * nb_comp, pos))
+        l_pos2.append(picks.ravel() + pos + 1)
+    if not l_uidx:
+        return (np.zeros(0, dtype=np.int64),) * 3
+    uidx, pos1, pos2 = (np.concatenate(l) for l in (l_uidx, l_pos1, l_pos2))
+    order = np.argsort(uidx, kind="stable")
+    return uidx[order], pos1[order], pos2[order]
+
+
+def _fake_comparisons(vidxs, loc, s_params, dens=0.5, rng=None):
+    """Draws comparisons of all users and their ratings
+
+    vidxs (2D int array): videos rated by each user, one line per user
+    loc (2D float array): local score of each video of each user
     s_params (float array): s parameter for each node
-    crit (str): criteria of comparisons
     dens (float [0,1[): density of comparisons
+    rng (numpy Generator): source of randomness
 
     Returns:
-        (list of lists): list of all comparisons
-                    [   contributor_id: int, video_id_1: int, video_id_2: int,
-                        criteria: str, score: float, weight: float  ]
+        (int array, int array, int array, float array): user index, video
+            indexes and rating ([0, 100]) of each comparison
+    """
+    rng = rng or _get_rng()
+    uidx, pos1, pos2 = _fake_pairs(*vidxs.shape, dens, rng)
+    rates = _get_rd_rates(
+        loc[uidx, pos1], loc[uidx, pos2], s_params[uidx], rng
+    )
+    return uidx, vidxs[uidx, pos1], vidxs[uidx, pos2], _unscale_rating(rates)
+
+
+def _generate(nb_vids, nb_users, vids_per_user, dens, scale, noise, rng):
+    """Generates ground truths and comparisons as arrays
+
+    Returns:
+        (float array): fake global scores
+        (2D int array, 2D float array): videos rated by each user
+                                            and their local scores
+        (float array): random independant s parameters
+        (int array, int array, int array, float array): comparisons,
+                                                see _fake_comparisons()
     """
-    all_comps = []
-    for uid, node in enumerate(l_nodes):  # for each node
-        if uid % 50 == 0:
-            logging.info(f"Node number {uid}")
-        s = s_params[uid]
-        nbvid = len(node)
-        for vidx1, video in enumerate(node):  # for each video
-            nb_comp = int(dens * (nbvid - vidx1))  # number of comparisons
-            following_videos = range(vidx1 + 1, nbvid)
-            pick_idxs = random.sample(following_videos, nb_comp)
-            for vidx2 in pick_idxs:  # for each second video drawn
-                r = _get_rd_rate(video[1], node[vidx2][1], s)  # get random r
-                rate = _unscale_rating(r)  # rescale to [0, 100]
-                comp = [uid, video[0], node[vidx2][0], crit, rate, 0]
-                all_comps.append(comp)
-    return all_comps
+    s_params = _fake_s(nb_users, rng=rng)
+    glob = _fake_glob_scores(nb_vids, scale=scale, rng=rng)
+    logging.info(f'{nb_vids} global scores generated')
+    vidxs = _pick_videos(nb_vids, nb_users, vids_per_user, rng)
+    loc = _fake_loc_scores(vidxs, glob, noise, rng)
+    logging.info(f"{vids_per_user} local scores generated per user")
+    comps = _fake_comparisons(vidxs, loc, s_params, dens, rng)
+    logging.info(f"{len(comps[0])} comparisons generated")
+    return glob, (vidxs, loc), s_params, comps
 
 
 def generate_data(
         nb_vids, nb_users, vids_per_user,
-        dens=0.8, scale=0.5, noise=0.1
+        dens=0.8, scale=0.5, noise=0.1, crit="test", seed=None
     ):
     """ Generates fake input data for testing
 
@@ -142,6 +215,8 @@ def generate_data(
     dens (float [0,1[): density of comparisons for each user
     scale (float): variance/std of global scores
     noise (float): variance/std of local scores noise
+    crit (str): criteria of comparisons
+    seed (int): random seed (None to draw it with np.random)
 
     Returns:
 
@@ -151,14 +226,73 @@ def generate_data(
         (float array): random independant s parameters
         (list of lists): list of all comparisons
             [   contributor_id: int, video_id_1: int, video_id_2: int,
-                criteria: "test", score: float, weight: float  ]
+                criteria: -crit, score: float, weight: float  ]
     """
-    s_params = _fake_s(nb_users)
-    distr = [vids_per_user] * nb_users
-    glob = _fake_glob_scores(nb_vids, scale=scale)
-    logging.info(f'{nb_vids} global scores generated')
-    loc = _fake_loc_scores(distr, glob, noise)
-    logging.info(f"{vids_per_user} local scores generated per user")
-    comp = _fake_comparisons(loc, s_params, dens)
-    logging.info(f"{len(comp)} comparisons generated")
-    return glob, loc, s_params, comp
+    glob, (vidxs, loc), s_params, comps = _generate(
+        nb_vids, nb_users, vids_per_user, dens, scale, noise, _get_rng(seed)
+    )
+    l_loc = [
+        list(zip(node_vidxs, node_loc))
+        for node_vidxs, node_loc in zip(vidxs.tolist(), loc.tolist())
+    ]
+    l_comps = [
+        [uid, vid1, vid2, crit, rate, 0]
+        for uid, vid1, vid2, rate in zip(*[arr.tolist() for arr in comps])
+    ]
+    return glob, l_loc, s_params, l_comps
+
+
+def generate_columns(
+        nb_vids, nb_users, vids_per_user, criterias=("test",),
+        dens=0.8, scale=0.5, noise=0.1, seed=None, filename=None
+    ):
+    """ Generates fake comparisons of several criterias, as columns
+
+    Each criteria has its own ground truths, users and videos IDs are shared
+
+    nb_vids, nb_users, vids_per_user, dens, scale, noise, seed:
+        see generate_data()
+    criterias (str list): criterias of comparisons
+    filename (str): file where to save columns (see load_columns()),
+                        None not to save them
+
+    Returns:
+        (str list, int array, int array, int array, int array, float array):
+            criterias, users IDs, video IDs 1, video IDs 2, index of
+            criteria and score of each comparison, like get_columns()
+    """
+    rng = _get_rng(seed)
+    l_comps, l_crits = [], []
+    for crit_idx in range(len(criterias)):
+        comps = _generate(
+            nb_vids, nb_users, vids_per_user, dens, scale, noise, rng
+        )[3]
+        l_comps.append(comps)
+        l_crits.append(np.full(len(comps[0]), crit_idx))
+    users, vid1, vid2, scores = (
+        np.concatenate(col) for col in zip(*l_comps)
+    )
+    columns = (
+        list(criterias), users, vid1, vid2, np.concatenate(l_crits), scores
+    )
+    if filename is not None:
+        save_columns(columns, filename)
+    return columns
+
+
+def save_columns(columns, filename):
+    """Saves columns of comparisons (output of get_columns()) in a file"""
+    arrays = dict(zip(("users", "vid1", "vid2", "crits", "scores"), columns[1:]))
+    save_arrays(arrays, {"criterias": list(columns[0])}, filename)
+
+
+def load_columns(filename):
+    """Loads columns of comparisons saved with save_columns()
+
+    Returns:
+        (tuple): columns, see generate_columns()
+    """
+    meta, arrays = load_arrays(filename)
+    return (meta["criterias"],) + tuple(
+        arrays[key] for key in ("users", "vid1", "vid2", "crits", "scores")
+    )
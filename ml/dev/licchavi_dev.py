@@ -2,6 +2,7 @@ import logging
 import torch
 
 from ml.licchavi import Licchavi
+from ml.history import History
 
 
 """ LicchaviDev(Licchavi) class used for experiments only
@@ -28,13 +29,12 @@ class LicchaviDev(Licchavi):
         super().__init__(nb_vids, vid_vidx, crit, device=device, verb=verb)
 
         self.test_mode = test_mode
+        self.history = History(level='full')  # all epochs for plots
         # Inits attributes required for test_mode
         if test_mode:
             self.glob_gt = []  # global scores ground truths
             self.loc_gt = []  # local scores ground truths
             self.s_gt = []  # s parameters ground truths
-            self.history['error_loc'] = []
-            self.history['error_glob'] = []
 
     def set_ground_truths(self, glob_gt, loc_gt, s_gt):
         """ Puts ground truths in Licchavi (for experiments only)
@@ -74,15 +74,16 @@ class LicchaviDev(Licchavi):
             loc_mean_error = loc_error / nb_loc
         return glob_mean_error, loc_mean_error
 
-    def _update_hist(self, epoch, fit, s, gen, reg):
-        """ Updates history (at end of epoch)
+    def _hist_metrics(self):
+        """ Returns metrics of the global model (collected epochs only)
 
-        Inheriting from Licchavi._update_hist()
+        Inheriting from Licchavi._hist_metrics()
          """
-        super()._update_hist(epoch, fit, s, gen, reg)
+        metrics = super()._hist_metrics()
         # additional test mode metrics unsing ground truths
         if self.test_mode:
             factor_glob, factor_loc = 1, 1  # for visualisation only
             glob_error, loc_error = self._test_errors()
-            self.history['error_glob'].append(glob_error * factor_glob)
-            self.history['error_loc'].append(loc_error * factor_loc)
+            metrics['error_glob'] = glob_error * factor_glob
+            metrics['error_loc'] = loc_error * factor_loc
+        return metrics
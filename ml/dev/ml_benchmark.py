@@ -1,83 +1,268 @@
-import timeit
-import torch
+import os
+import sys
+import json
+import argparse
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import product
+from time import time
+import numpy as np
 
-from ml.losses import _bbt_loss, _approx_bbt_loss, get_fit_loss, get_s_loss
-from .fake_data import generate_data
-from ..core import ml_run
+from .fake_data import generate_columns
 
 """
-Module used for testing performances (speed)
+Scaling benchmark of the ml engine (not used in production)
 
 Main file is "ml_train.py"
+
+Structure:
+- GRIDS are the sizes benchmarked: each configuration of the cartesian
+    product of their axes is run once
+- run_config() generates fake data (generate_columns()) and runs ml_run() on it
+    in a new process, so peak memory is the one of this configuration only
+- results are written to JSON and can be compared to a baseline (a previous
+    results file) with compare_results(): a metric regresses when it is
+    more than THRESHOLDS[metric] higher (relative) than in the baseline
+
+USAGE (from the repository root):
+    python -m ml.dev.ml_benchmark --grid small --output bench.json
+    python -m ml.dev.ml_benchmark --grid small --baseline bench.json \
+        --threshold epoch_seconds=0.1
+exits with status 1 if a regression is found
 """
 
+# axes of benchmark grids, the number of comparisons per user grows with
+# vids_per_user (about dens * vids_per_user² / 2)
+GRIDS = {
+    "small": {
+        "users": [20, 100],
+        "videos": [100],
+        "vids_per_user": [10],
+        "criterias": [1, 2],
+        "backend": ["torch", "numpy"],
+    },
+    "medium": {
+        "users": [200, 1000],
+        "videos": [1000],
+        "vids_per_user": [10, 30],
+        "criterias": [1, 3],
+        "backend": ["torch", "numpy"],
+    },
+    "large": {
+        "users": [2000, 10000],
+        "videos": [10000],
+        "vids_per_user": [30, 100],
+        "criterias": [1],
+        "backend": ["torch", "numpy"],
+    },
+}
+CONFIG_KEYS = ("users", "videos", "vids_per_user", "criterias", "backend")
+DENS = 0.8  # density of comparisons of generated data
+EPOCHS = 20  # maximum number of epochs of each run
+SEED = 4242
+# maximum relative increase of each metric before it is a regression
+THRESHOLDS = {
+    "epoch_seconds": 0.2,
+    "ml_run_seconds": 0.2,
+    "uncertainty_seconds": 0.3,
+    "peak_memory_bytes": 0.1,
+}
+
+
+def get_configs(grid):
+    """Returns all configurations of a grid
+
+    grid (dictionnary): {axis: list of values}, like GRIDS values
+
+    Returns:
+        (dictionnary list): one {axis: value} per configuration
+    """
+    return [
+        dict(zip(CONFIG_KEYS, values))
+        for values in product(*[grid[key] for key in CONFIG_KEYS])
+    ]
+
+
+def _run_config_worker(config, epochs):
+    """Runs ml_run() on fake data of a configuration (in a new process)
+
+    Returns:
+        (dictionnary): measurements of this run
+    """
+    from ..core import ml_run, _get_backend
+    from ..monitoring import get_metrics
+
+    columns = generate_columns(  # same data for the same configuration
+        config["videos"], config["users"], config["vids_per_user"],
+        criterias=[f"crit_{idx}" for idx in range(config["criterias"])],
+        dens=DENS, seed=SEED,
+    )
+    criterias = columns[0]
+    _get_backend(config["backend"])  # import time is not measured
+    time_run = time()
+    ml_run(
+        columns, epochs, criterias,
+        save=False, verb=-1, compute_uncertainty=True,
+        backend=config["backend"], workers=1,
+    )
+    ml_run_time = time() - time_run
+    metrics = get_metrics()  # recorded by ml_run() (see monitoring.py)
+    peak_key = ("peak_memory_bytes", (("criteria", "all"),))
+
+    def crit_values(name, **labels):
+        return [
+            metrics[(name, tuple(sorted({**labels, "criteria": crit}.items())))]
+            for crit in criterias
+        ]
 
-def time_this(func, iterations=1, description=""):
-    """Times a function
+    return {
+        "comparisons": len(columns[1]),
+        "epochs": sum(crit_values("epochs")),
+        "ml_run_seconds": ml_run_time,
+        "epoch_seconds": float(np.mean(crit_values("epoch_seconds"))),
+        "uncertainty_seconds": sum(
+            crit_values("stage_seconds", stage="uncertainty")
+        ),
+        "peak_memory_bytes": metrics[peak_key],
+    }
 
-    func (None -> None): function to time
-    iterations (int): number of iterations to average on
-    description (str): name of tested function
+
+def run_config(config, epochs=EPOCHS):
+    """Benchmarks one configuration in a new process
+
+    config (dictionnary): one output of get_configs()
+    epochs (int): maximum number of training epochs
 
     Returns:
-        (None): Prints average time for tested function to run
+        (dictionnary): configuration and its measurements
     """
-    duration = timeit.Timer(func).timeit(number=iterations)
-    avg_duration = duration / iterations
-    print(f"On average {description} took {avg_duration} seconds")
-
-
-# ------ prepare some inputs -----------
-nb_vids, nb_users, vids_per_user = 1000, 30, 30
-FAKE_DATA, _, _ = generate_data(nb_vids, nb_users, vids_per_user, dens=0.8)
-T, R = torch.tensor([-2.1]), torch.tensor([-0.8])
-S = torch.tensor([0.9])
-
-nb_vids = 10
-nb_comps = 20
-MODEL = torch.ones(nb_vids, requires_grad=True)
-one_hot = [False] * 10
-one_hot[2] = True
-A_BATCH = torch.tensor([one_hot for _ in range(nb_comps)])
-B_BATCH = torch.tensor([one_hot for _ in range(nb_comps)])
-R_BATCH = torch.ones(nb_comps)
-
-
-# ================ test functions =================
-def bm_ml_run():
-    epochs = 10
-    _, _ = ml_run(
-        FAKE_DATA,
-        epochs=epochs,
-        criterias=["reliability"],
-        resume=False,
-        save=False,
-        verb=-1,
-        gpu=False,
+    with ProcessPoolExecutor(
+        1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        measures = executor.submit(_run_config_worker, config, epochs).result()
+    return {**config, **measures}
+
+
+def run_benchmark(configs, epochs=EPOCHS, verb=1):
+    """Benchmarks configurations one after another
+
+    configs (dictionnary list): output of get_configs()
+    epochs (int): maximum number of training epochs
+    verb (int): verbosity level
+
+    Returns:
+        (dictionnary): {"meta": environment, "results": one per config}
+    """
+    results = []
+    for config in configs:
+        result = run_config(config, epochs)
+        if verb >= 1:
+            print(_format_result(result))
+        results.append(result)
+    meta = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "epochs": epochs,
+    }
+    return {"meta": meta, "results": results}
+
+
+def _format_result(result):
+    """Returns a one line description of a result"""
+    config = " ".join(f"{key}={result[key]}" for key in CONFIG_KEYS)
+    return (
+        f"{config}: {result['comparisons']} comparisons, "
+        f"{result['epoch_seconds']:.4f} s/epoch, "
+        f"ml_run {result['ml_run_seconds']:.2f} s, "
+        f"uncertainty {result['uncertainty_seconds']:.2f} s, "
+        f"peak memory {result['peak_memory_bytes'] / 2 ** 20:.0f} MiB"
     )
 
 
-# --------------- losses.py --------------------
-def bm_bbt_loss():
-    _ = _bbt_loss(T, R)
+def compare_results(results, baseline, thresholds=THRESHOLDS):
+    """Compares results to a baseline, configuration by configuration
+
+    results (dictionnary): output of run_benchmark()
+    baseline (dictionnary): output of run_benchmark() (previous run)
+    thresholds (dictionnary): {metric: maximum relative increase}
+
+    Returns:
+        (dictionnary list): one {config, metric, baseline, value, ratio}
+            per metric of a configuration higher than its threshold allows
+    """
+    old_results = {
+        tuple(res[key] for key in CONFIG_KEYS): res
+        for res in baseline["results"]
+    }
+    regressions = []
+    for res in results["results"]:
+        old = old_results.get(tuple(res[key] for key in CONFIG_KEYS))
+        if old is None:  # configuration not in baseline
+            continue
+        for metric, threshold in thresholds.items():
+            if old[metric] > 0 and res[metric] > old[metric] * (1 + threshold):
+                regressions.append({
+                    "config": {key: res[key] for key in CONFIG_KEYS},
+                    "metric": metric,
+                    "baseline": old[metric],
+                    "value": res[metric],
+                    "ratio": res[metric] / old[metric],
+                })
+    return regressions
 
 
-def bm_approx_bbt_loss():
-    _ = _approx_bbt_loss(T, R)
+def _parse_thresholds(l_thresh):
+    """Returns THRESHOLDS updated with "metric=value" strings"""
+    thresholds = dict(THRESHOLDS)
+    for thresh in l_thresh:
+        metric, value = thresh.split("=")
+        if metric not in THRESHOLDS:
+            raise ValueError(f"Unknown metric: {metric}")
+        thresholds[metric] = float(value)
+    return thresholds
 
 
-def bm_get_s_loss():
-    _ = get_s_loss(S)
+def main(args=None):
+    """Runs the benchmark from the command line
 
+    Returns:
+        (int): exit status, 1 if a regression was found
+    """
+    parser = argparse.ArgumentParser(description="Scaling benchmark of ml")
+    parser.add_argument("--grid", choices=GRIDS, default="small")
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--output", help="JSON file where to write results")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument(
+        "--threshold", nargs="*", default=[],
+        help="metric=value, maximum relative increase of a metric",
+    )
+    options = parser.parse_args(args)
+    thresholds = _parse_thresholds(options.threshold)
 
-def bm_fit_loss_batch():
-    _ = get_fit_loss(MODEL, S, A_BATCH, B_BATCH, R_BATCH)
+    results = run_benchmark(get_configs(GRIDS[options.grid]), options.epochs)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, thresholds)
+        for reg in regressions:
+            print(
+                f"REGRESSION {reg['metric']} {reg['config']}: "
+                f"{reg['baseline']:.4g} -> {reg['value']:.4g} "
+                f"(x{reg['ratio']:.2f})"
+            )
+        if regressions:
+            return 1
+        print("No regression")
+    return 0
 
 
-# =========== running tests ==================
 if __name__ == "__main__":
-    time_this(bm_ml_run, 1, "ml_run()")
-    time_this(bm_bbt_loss, 10000, "_bbt_loss()")
-    time_this(bm_approx_bbt_loss, 10000, "_approx_bbt_loss()")
-    time_this(bm_get_s_loss, 10000, "get_s_loss()")
-    time_this(bm_fit_loss_batch, 100, "fit_loss_batch()")
+    sys.exit(main())
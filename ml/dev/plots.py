@@ -79,7 +79,7 @@ def _means_bounds(arr):
 # ------------- utility for what follows -------------------------
 def _plot_var(l_hist, l_metrics):
     ''' add curve of asked indexes of history to the plot '''
-    epochs = range(1, len(l_hist[0]['fit']) + 1)
+    epochs = l_hist[0].epochs
     for metric in l_metrics:
         vals = np.asarray(
             [hist[metric] for hist in l_hist]
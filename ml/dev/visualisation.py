@@ -129,7 +129,7 @@ def uncert_stats(licch, loc_uncerts):
 def output_infos(licch, glob, loc, uncertainties):
     """ Prints and plots for dev mode """
     licch_stats(licch)
-    scores_stats(glob[1])
+    scores_stats(torch.as_tensor(glob[1]))
     s_stats(licch)
     if uncertainties[1] is not None:
         uncert_stats(licch, uncertainties[1])
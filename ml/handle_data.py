@@ -1,17 +1,17 @@
-from ml.losses import round_loss
 import numpy as np
-import torch
 import logging
+import gc
+from contextlib import contextmanager
+from itertools import repeat
 
 from .data_utility import (
-    get_batch_r,
     rescale_rating,
     sort_by_first,
     reverse_idxs,
-    get_mask,
     get_all_vids,
+    get_vidxs,
+    get_offsets,
     expand_dic,
-    one_hot_vids,
 )
 
 """
@@ -21,176 +21,234 @@ Main file is "ml_train.py"
 """
 
 
-def select_criteria(comparison_data, crit):
-    """Extracts not None comparisons of one criteria
+def get_columns(comparison_data):
+    """Converts comparisons to columns (output of fetch_data())
 
-    comparison_data: output of fetch_data()
-    crit: str, name of criteria
+    comparison_data (list of lists or tuple): list of [contributor_id: int,
+        video_id_1: int, video_id_2: int, criteria: str, score: float,
+        weight: float], or columns already
 
     Returns:
-    - list of all ratings for this criteria
-        ie list of [contributor_id: int, video_id_1: int, video_id_2: int,
-                    criteria: str (crit), score: float, weight: float]
+        (str list, int array, int array, int array, int array, float array):
+            criterias, users IDs, video IDs 1, video IDs 2, index of
+            criteria and score (nan if None) of each comparison
     """
-    l_ratings = [
-        comp for comp in comparison_data if (comp[3] == crit and comp[4] is not None)
-    ]
-    return l_ratings
+    if isinstance(comparison_data, tuple):  # already columns
+        return comparison_data
+    criterias = list(dict.fromkeys(comp[3] for comp in comparison_data))
+    crit_idx = {crit: idx for idx, crit in enumerate(criterias)}
+    nb = len(comparison_data)
+    ids = np.fromiter(
+        (idx for comp in comparison_data for idx in comp[:3]),
+        dtype=np.int64,
+        count=3 * nb,
+    ).reshape(nb, 3)
+    crits = np.fromiter(
+        (crit_idx[comp[3]] for comp in comparison_data), dtype=np.int64, count=nb
+    )
+    scores = np.fromiter(
+        (np.nan if comp[4] is None else comp[4] for comp in comparison_data),
+        dtype=np.float64,
+        count=nb,
+    )
+    return criterias, ids[:, 0], ids[:, 1], ids[:, 2], crits, scores
 
 
-def shape_data(l_ratings):
-    """Shapes data for distribute_data()/distribute_data_from_save()
+def split_criterias(columns, criterias):
+    """Shapes not None comparisons of each criteria, in one pass
 
-    l_ratings : list of not None ratings ([0,100]) for one criteria, all users
+    columns (tuple): comparisons, output of get_columns()
+    criterias (str list): criterias to select
 
-    Returns : one array with 4 columns : userID, vID1, vID2, rating ([-1,1])
+    Returns:
+        (dictionnary): {criteria: (int array, int array, int array,
+            float array)}, user ID, video IDs 1 and 2 and rating ([-1,1])
+            of each comparison, None if no data for this criteria
     """
-    l_clear = [rating[:3] + [rescale_rating(rating[4])] for rating in l_ratings]
-    return np.asarray(l_clear)
+    names, users, vid1, vid2, crits, scores = columns
+    used = ~np.isnan(scores)
+    order = np.flatnonzero(used)[np.argsort(crits[used], kind="stable")]
+    bounds = np.searchsorted(crits[order], np.arange(len(names) + 1))
+    split = {}
+    for crit in criterias:
+        if crit not in names:
+            split[crit] = None
+            continue
+        cidx = names.index(crit)
+        idxs = order[bounds[cidx] : bounds[cidx + 1]]
+        if len(idxs) == 0:
+            split[crit] = None
+            continue
+        split[crit] = (
+            users[idxs], vid1[idxs], vid2[idxs], rescale_rating(scores[idxs])
+        )
+    return split
 
 
-def _distribute_data_handler(arr, user_ids, vid_vidx, first_of_each, device="cpu"):
-    """Utility for data distribution accross nodes
+def get_criterias_data(comparison_data, criterias):
+    """Selects and shapes comparisons of each criteria, in one pass
 
-    arr (2D array): all ratings for all users for one criteria
-                    (one line is [userID, vID1, vID2, rating])
-    users_ids (array): users IDs
-    vid_vidx (dict): {video ID: video index}
-    first_of_each (int list): index of first comparison of each user in -arr
-    device (str): device to use (cpu/gpu)
+    comparison_data (list of lists or tuple): output of fetch_data()
+    criterias (str list): rating criterias
 
     Returns:
-        (dict): {user ID : tuple of user's data}
+        (dictionnary): {criteria: (int array, int array, int array,
+            float array)}, user ID, video IDs 1 and 2 and rating ([-1,1])
+            of each comparison, None if no data for this criteria
     """
-    nodes_dic = {}
+    crits_data = split_criterias(get_columns(comparison_data), criterias)
+    for criteria, full_data in crits_data.items():
+        if full_data is None:  # if no data for selected criteria
+            logging.warning(f"No comparison for this criteria ({criteria})")
+    return crits_data
 
-    for i, id in enumerate(user_ids):
-        node_arr = arr[first_of_each[i] : first_of_each[i + 1], :]
 
-        batch1 = one_hot_vids(vid_vidx, node_arr[:, 1], device)
-        batch2 = one_hot_vids(vid_vidx, node_arr[:, 2], device)
+def _distribute_data_handler(comps, vid_vidx, offsets):
+    """Utility for data distribution accross nodes
 
-        nodes_dic[id] = (
-            batch1,
-            batch2,
-            get_batch_r(node_arr, device),
-            get_all_vids(node_arr),
-            get_mask(batch1, batch2),
-        )
+    comps (array tuple): all ratings for all users for one criteria,
+        sorted by user, (user IDs, vIDs 1, vIDs 2, ratings)
+    vid_vidx (dict): {video ID: video index}
+    offsets (int array): comparisons of user i are in
+                            [offsets[i], offsets[i + 1][ in -comps
 
-    return nodes_dic
+    Returns:
+        (int array, int array, float array, int array): comparisons of all
+            users grouped by user: (vidx1, vidx2, rating, offsets)
+    """
+    _, vid1, vid2, r = comps
+    vidx1 = get_vidxs(vid_vidx, vid1)
+    vidx2 = get_vidxs(vid_vidx, vid2)
+    r = r.astype(np.float32)
+    return vidx1, vidx2, r, offsets
 
 
-def distribute_data(arr, device="cpu"):
+def distribute_data(comps):
     """Distributes data on nodes according to user IDs for one criteria
         Output is not compatible with previously stored models,
            ie starts from scratch
 
-    arr (2D array): all ratings for all users for one criteria
-                        (one line is [userID, vID1, vID2, rating])
-    device (str): device to use (cpu/gpu)
-
+    comps (array tuple): all ratings for all users for one criteria,
+        (user IDs, vIDs 1, vIDs 2, ratings), see split_criterias()
 
     Returns:
-    - dictionnary {userID: (vID1_batch, vID2_batch,
-                            rating_batch, single_vIDs, mask)}
+    - (vID1 indexes, vID2 indexes, ratings, offsets), comparisons grouped
+        by user, those of user i are in [offsets[i], offsets[i + 1][
     - array of user IDs
     - dictionnary of {vID: video idx}
     """
     logging.info("Preparing data from scratch")
-    arr = sort_by_first(arr)  # sorting by user IDs
-    user_ids, first_of_each = np.unique(arr[:, 0], return_index=True)
-    first_of_each = list(first_of_each)  # to be able to append
-    first_of_each.append(len(arr))  # to have last index too
-    vid_vidx = reverse_idxs(get_all_vids(arr))
-
-    nodes_dic = _distribute_data_handler(
-        arr, user_ids, vid_vidx, first_of_each, device=device
-    )
+    comps = sort_by_first(comps)  # sorting by user IDs
+    user_ids, offsets = get_offsets(comps[0])
+    vid_vidx = reverse_idxs(get_all_vids(comps[1], comps[2]))
+
+    nodes_data = _distribute_data_handler(comps, vid_vidx, offsets)
 
-    return nodes_dic, user_ids, vid_vidx
+    return nodes_data, user_ids, vid_vidx
 
 
-def distribute_data_from_save(arr, fullpath, device):
+def distribute_data_from_save(comps, saved_data):
     """Distributes data on nodes according to user IDs for one criteria
         Output is compatible with previously stored models
 
-    arr: np 2D array of all ratings for all users for one criteria
-            (one line is [userID, vID1, vID2, score])
-    fullpath (str): path of saved previous training state
-    device (str): device to use (cpu/gpu)
+    comps (array tuple): all ratings for all users for one criteria,
+        (user IDs, vIDs 1, vIDs 2, ratings), see split_criterias()
+    saved_data (tuple): previous training state, output of load_checkpoint()
 
     Returns:
-    - dictionnary {userID: (vID1_batch, vID2_batch,
-                            rating_batch, single_vIDs, masks)}
+    - (vID1 indexes, vID2 indexes, ratings, offsets), comparisons grouped
+        by user, those of user i are in [offsets[i], offsets[i + 1][
     - array of user IDs
     - dictionnary of {vID: video idx}
     """
     logging.info("Preparing data from save")
-    _, dic_old, _, _ = torch.load(fullpath)  # loading previous data
+    dic_old = dict(saved_data[1])  # previous videos, not modified
 
-    arr = sort_by_first(arr)  # sorting by user IDs
-    user_ids, first_of_each = np.unique(arr[:, 0], return_index=True)
-    first_of_each = list(first_of_each)  # to be able to append
-    first_of_each.append(len(arr))  # to have last index too
-    vids = get_all_vids(arr)  # all unique video IDs
-    vid_vidx = expand_dic(dic_old, vids)  # update dictionnary
+    comps = sort_by_first(comps)  # sorting by user IDs
+    user_ids, offsets = get_offsets(comps[0])
+    vids = get_all_vids(comps[1], comps[2])  # all unique video IDs
+    vid_vidx = expand_dic(dic_old, vids.tolist())  # update dictionnary
+
+    nodes_data = _distribute_data_handler(comps, vid_vidx, offsets)
+
+    return nodes_data, user_ids, vid_vidx
+
+
+def _as_array(values):
+    """Returns scores as one float numpy array
+
+    values (float array, tensor or list of them): scores, concatenated
+                                                        if in a list
+    """
+    if isinstance(values, (list, tuple)):
+        return np.concatenate([np.zeros(0)] + [_as_array(val) for val in values])
+    if hasattr(values, "detach"):  # torch tensor
+        values = values.detach().cpu().numpy()
+    return np.asarray(values, dtype=np.float64)
 
-    nodes_dic = _distribute_data_handler(
-        arr, user_ids, vid_vidx, first_of_each, device=device
-    )
 
-    return nodes_dic, user_ids, vid_vidx
+@contextmanager
+def _no_gc():
+    """Pauses garbage collection, which would scan again and again
+    the millions of lists created when formatting scores"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _rounded(values, dec=2):
+    """Rounds scores in bulk
+
+    values (float array, tensor or list of them): scores
+    dec (int): number of decimals kept
+
+    Returns:
+        (float list): rounded scores
+    """
+    return np.round(_as_array(values), dec).tolist()
 
 
 def format_out_glob(glob, crit, uncerts):
     """Puts data in list of global scores (one criteria)
 
-    glob: (tensor of all vIDS , tensor of global video scores)
+    glob: (array of all vIDS , array/tensor of global video scores)
     crit (str): criteria
-    uncerts (float list): uncertainty of global scores
-
+    uncerts (float array): uncertainty of global scores, None if not
+                                computed
 
     Returns:
     - list of [video_id: int, criteria_name: str,
                 score: float, uncertainty: float]
     """
-    return [
-        [
-            int(vid),
-            crit,
-            round_loss(score, 2),
-            0 if uncerts is None else round_loss(uncerts[vidx], 2),
-        ]
-        for vid, score, vidx in zip(*glob, range(len(glob[0])))
-    ]
+    vids = np.asarray(glob[0]).astype(np.int64).tolist()
+    scores = _rounded(glob[1])
+    uncerts = repeat(0) if uncerts is None else _rounded(uncerts)
+    with _no_gc():
+        return list(map(list, zip(vids, repeat(crit), scores, uncerts)))
 
 
 def format_out_loc(loc, users_ids, crit, uncerts):
     """Puts data in list of local scores (one criteria)
 
-    loc: (list of tensor of local vIDs , list of tensors of local video scores)
-    users_ids: list/array of user IDs in same order
+    loc: (user index, video ID and score of each local score), flat
+            arrays grouped by user, see output_flat_scores()
+    users_ids: array of user IDs in same order
     crit (str): criteria
-    uncerts (float list list): uncertainty of local scores
+    uncerts (float array list): uncertainty of local scores of each user,
+                                    None if not computed
 
     Returns :
     - list of [contributor_id: int, video_id: int, criteria_name: str,
                 score: float, uncertainty: float]
     """
-    l_out = []
-    vids, scores = loc
-    for user_id, user_vids, user_scores, uidx in zip(
-        users_ids, vids, scores, range(len(loc[0]))
-    ):
-        for i in range(len(user_vids)):
-            out = [
-                int(user_id),
-                int(user_vids[i].item()),
-                crit,
-                round_loss(user_scores[i], 2),
-                0 if uncerts is None else round_loss(uncerts[uidx][i], 2),
-            ]
-            l_out.append(out)
-
-    return l_out
+    uidxs, vids, scores = loc
+    users = np.asarray(users_ids)[uidxs].astype(np.int64).tolist()
+    vids = np.asarray(vids).astype(np.int64).tolist()
+    scores = _rounded(scores)
+    uncerts = repeat(0) if uncerts is None else _rounded(uncerts)
+    with _no_gc():
+        return list(map(list, zip(users, vids, repeat(crit), scores, uncerts)))
@@ -0,0 +1,96 @@
+import numpy as np
+import gin
+
+"""
+Training history of Licchavi, used in "licchavi_base.py"
+
+Main file is "ml_train.py"
+
+Structure:
+- History collects metrics at the end of some epochs, depending on its level:
+-- "off": nothing is collected (production)
+-- "sampled": metrics are collected every -freq epochs
+-- "full": metrics are collected at every epoch (dev mode)
+- values are stored in preallocated arrays, history[key] is the array of
+    values of a metric, history.epochs the epochs when they were collected
+"""
+
+HIST_KEYS = ("fit", "s", "gen", "reg", "l2_norm", "grad_sp", "grad_norm")
+LEVELS = ("off", "sampled", "full")
+
+
+@gin.configurable
+class History:
+    """Metrics collected during training, one value per collected epoch"""
+
+    def __init__(self, keys=HIST_KEYS, level="off", freq=10):
+        """
+        keys (str iterable): metrics collected (others are added when
+                                first recorded)
+        level (str): "off", "sampled" or "full"
+        freq (int): number of epochs between collections ("sampled" level)
+        """
+        if level not in LEVELS:
+            raise ValueError(f"Unknown history level: {level}")
+        self.level = level
+        self.freq = freq
+        self.size = 0  # number of collected epochs
+        self._epochs = np.zeros(0, dtype=np.int64)
+        self._values = {key: np.zeros(0) for key in keys}
+
+    def wants(self, epoch):
+        """Returns True if metrics are collected at this epoch"""
+        if self.level == "full":
+            return True
+        return self.level == "sampled" and epoch % self.freq == 0
+
+    def reserve(self, nb_epochs):
+        """Preallocates arrays for the next -nb_epochs epochs"""
+        if self.level == "off":
+            return
+        nb = nb_epochs if self.level == "full" else nb_epochs // self.freq
+        self._grow(self.size + nb)
+
+    def _grow(self, capacity):
+        """Expands arrays to hold at least -capacity epochs"""
+        if capacity <= len(self._epochs):
+            return
+        nb_new = capacity - len(self._epochs)
+        self._epochs = np.append(self._epochs, np.zeros(nb_new, dtype=np.int64))
+        for key, values in self._values.items():
+            self._values[key] = np.append(values, np.full(nb_new, np.nan))
+
+    def record(self, epoch, **values):
+        """Stores metrics of one epoch, missing ones are nan
+
+        epoch (int): epoch (or iteration) of metrics
+        values (float or scalar tensor/array): value of each metric
+        """
+        if self.size == len(self._epochs):
+            self._grow(max(2 * self.size, 1))
+        for key in values:
+            if key not in self._values:
+                self._values[key] = np.full(len(self._epochs), np.nan)
+        self._epochs[self.size] = epoch
+        for key, value in values.items():
+            if hasattr(value, "item"):  # tensor or numpy scalar
+                value = value.item()
+            self._values[key][self.size] = value
+        self.size += 1
+
+    @property
+    def epochs(self):
+        """Epochs at which metrics were collected"""
+        return self._epochs[: self.size]
+
+    def __getitem__(self, key):
+        return self._values[key][: self.size]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def keys(self):
+        return self._values.keys()
+
+    def values(self):
+        return (self[key] for key in self._values)
@@ -1,22 +1,28 @@
+import numpy as np
 import torch
 from copy import deepcopy
-from time import time
 import logging
 from logging import info as loginf
-import gin
 
-from .losses import model_norm, round_loss, predict, loss_fit_s_gen, loss_gen_reg
+from .licchavi_base import LicchaviBase
+from .losses import (
+    model_norm,
+    get_s_loss,
+    loss_fit_s_gen,
+    loss_gen_reg,
+    _batched_fit_loss,
+    _batched_gen_loss,
+)
 from .metrics import (
     extract_grad,
     get_uncertainty_loc,
     get_uncertainty_glob,
-    check_equilibrium_glob,
-    check_equilibrium_loc,
+    get_fit_derivs,
     scalar_product,
 )
-from .data_utility import expand_tens, one_hot_vids
+from .data_utility import round_loss, save_checkpoint
+from .monitoring import torch_trace
 from .nodes import Node
-from .dev.visualisation import disp_one_by_line
 
 """
 Machine Learning algorithm, used in "core.py"
@@ -29,6 +35,7 @@ Structure:
 - Licchavi class is the structure designed to include
     a global model and one for each node
 -- read Licchavi __init__ comments to better understand
+-- training loop and hyperparameters are in LicchaviBase ("licchavi_base.py")
 
 USAGE:
 - hardcode training hyperparameters in "hyperparameters.py"
@@ -43,29 +50,33 @@ def get_model(nb_vids, device="cpu"):
     return torch.zeros(nb_vids, requires_grad=True, device=device)
 
 
-def get_s(device="cpu"):
-    return torch.ones(1, requires_grad=True, device=device)
-
-
-@gin.configurable
-class Licchavi:
-    """Training structure including local models and general one"""
-
-    def __init__(
-        self,
-        nb_vids,
-        vid_vidx,
-        crit,
-        device="cpu",
-        verb=1,
-        # configured with gin in "hyperparameters.gin"
-        lr_node=None,
-        lr_s=None,
-        lr_gen=None,
-        gen_freq=None,
-        w0=None,
-        w=None,
-    ):
+def get_s(device="cpu", nb_nodes=1):
+    return torch.ones(nb_nodes, requires_grad=True, device=device)
+
+
+# used for updating models after loading
+def expand_tens(tens, nb_new, device="cpu"):
+    """Expands a tensor to include scores for new videos
+
+    tens (tensor): a detached tensor
+    nb_new (int): number of parameters to add
+    device (str): device used (cpu/gpu)
+
+    Returns:
+        (tensor): expanded tensor requiring gradients
+    """
+    expanded = torch.cat([tens, torch.zeros(nb_new, device=device)])
+    expanded.requires_grad = True
+    return expanded
+
+
+class Licchavi(LicchaviBase):
+    """Training structure including local models and general one
+
+    Gradients are computed with torch autograd
+    """
+
+    def __init__(self, nb_vids, vid_vidx, crit, device="cpu", verb=1):
         """
         nb_vids (int): number of different videos rated by
                         at least one contributor for this criteria
@@ -74,126 +85,144 @@ class Licchavi:
         device (str): device used (cpu/gpu)
         verb (float): verbosity level
         """
-        self.verb = verb
-        self.nb_vids = nb_vids  # number of parameters of the model
-        self.vid_vidx = vid_vidx  # {video ID : video index}
-        self.criteria = crit  # criteria learnt by this Licchavi
-        self.device = device  # device used (cpu/gpu)
+        # hyperparameters are set in LicchaviBase
+        super().__init__(nb_vids, vid_vidx, crit, device=device, verb=verb)
+        if self.shards > 1:
+            logging.warning("Sharded local steps require the numpy backend")
 
         self.opt = torch.optim.SGD  # optimizer
 
-        # defined in "hyperparameters.gin"
-        self.lr_node = lr_node  # local learning rate (local scores)
-        self.lr_s = lr_s  # local learning rate for s parameter
-        self.lr_gen = lr_gen  # global learning rate (global scores)
-        self.gen_freq = gen_freq  # generalisation frequency (>=1)
-        self.w0 = w0  # regularisation strength
-        self.w = w  # default weight for a node
-
         self.get_model = get_model  # neural network to use
         self.global_model = self.get_model(nb_vids, device)
         self.init_model = deepcopy(self.global_model)  # saved for metrics
-        self.last_grad = None
         self.opt_gen = self.opt([self.global_model], lr=self.lr_gen)
 
-        self.nb_nodes = 0
-        self.nodes = {}
-        self.history = {
-            "fit": [],
-            "s": [],
-            "gen": [],
-            "reg": [],  # metrics
-            "l2_norm": [],
-            "grad_sp": [],
-            "grad_norm": [],
-        }
-
-        self.users = []  # user IDs
-
-    def _show(self, msg, level):
-        """Utility for handling logging messages
-
-        msg (str): info message
-        level (float): minimum level of verbosity to show -msg
-        """
-        if self.verb >= level:
-            loginf(msg)
+        # parameters of all nodes, one line or coordinate for each node
+        self.s = get_s(device, 0)  # s parameters
+        # local scores of all nodes for the videos they rated, concatenated
+        self.models = self.get_model(0, device)
+        self.ages = torch.zeros(0, dtype=torch.long)  # nb of epochs trained
+        self.weights = torch.zeros(0, device=device)  # nodes weights
+        self.lr_s_nodes = torch.zeros(0, device=device)  # lr of s parameters
+        self.opt_loc = None  # optimizer of all local parameters
 
     # ------------ input and output --------------------
-    def _get_default(self):
-        """Returns: - (default s, default model, default age)"""
-        model_plus = (
-            get_s(self.device),  # s
-            self.get_model(self.nb_vids, self.device),  # model
-            0,  # age
+    def _set_params(self, s, models, ages):
+        """Sets parameters of all nodes and their optimizer
+
+        s (float tensor): s parameter of each node
+        models (float tensor): local scores of all nodes, concatenated
+        ages (int tensor): number of epochs each node has been trained
+        """
+        nbn = len(s)
+        self.s, self.models, self.ages = s, models, ages
+        self.weights = torch.full((nbn,), self.w, device=self.device)
+        nb_comps = torch.as_tensor(np.diff(self.offsets), device=self.device)
+        self.lr_s_nodes = self.lr_s / nb_comps
+        self.opt_loc = self.opt(
+            [
+                {"params": [self.models]},
+                # per node learning rates are applied to gradients of s
+                {"params": [self.s], "lr": 1},
+            ],
+            lr=self.lr_node,
         )
-        return model_plus
 
-    def _get_saved(self, loc_models_old, id, nb_new):
+    def _get_default(self, nbn):
+        """Returns default parameters for -nbn nodes
+
+        Returns:
+            (float tensor, float tensor, int tensor): s, models, ages
+        """
+        return (
+            get_s(self.device, nbn),
+            self.get_model(len(self.rated_vidxs), self.device),
+            torch.zeros(nbn, dtype=torch.long),
+        )
+
+    def _get_saved(self, loc_models_old, users_ids):
         """Returns saved parameters updated or default
 
-        loc_models_old (dictionnary): saved parameters in dictionnary of tuples
-                                        {user ID: (s, model, age)}
-        id (int): id of node (user)
-        nb_new (int): number of new videos (since save)
+        loc_models_old (array, array, int array, int array, array, array
+            (, uint64 array)): saved (users IDs, s, rated offsets,
+            rated vidxs, models, ages (, fingerprints of comparisons))
+        users_ids (int array): users IDs
 
         Returns:
-            (s, model, age), updated or default
+            (float tensor, float tensor, int tensor): s, models, ages
+                updated for known users and videos, default for others
         """
-        if id in loc_models_old:
-            s, mod, age = loc_models_old[id]
-            mod = expand_tens(mod, nb_new, self.device)
-            triple = (s, mod, age)
-        else:
-            triple = self._get_default()
-        return triple
+        _, s_old, _, _, models_old, ages_old = loc_models_old[:6]
+        (new_idxs, old_idxs), (new_pairs, old_pairs) = self._match_saved(
+            loc_models_old, users_ids,
+            self.rated_uidxs.cpu().numpy(), self.rated_vidxs.cpu().numpy()
+        )
+        new_idxs = torch.as_tensor(new_idxs, device=self.device)
+        new_pairs = torch.as_tensor(new_pairs, device=self.device)
+        s, models, ages = self._get_default(len(users_ids))
+        with torch.no_grad():
+            s[new_idxs] = torch.as_tensor(s_old[old_idxs], device=self.device)
+            models[new_pairs] = torch.as_tensor(
+                models_old[old_pairs], device=self.device
+            )
+        ages[new_idxs.cpu()] = torch.as_tensor(ages_old[old_idxs])
+        return s, models, ages
 
-    def set_allnodes(self, data_dic, users_ids):
+    def _set_data(self, nodes_data):
+        """Stores comparisons of all nodes as concatenated tensors
+
+        nodes_data (int array, int array, float array, int array):
+            (vID1 indexes, vID2 indexes, ratings, offsets), comparisons
+            of user i are in [offsets[i], offsets[i + 1][
+        """
+        super()._set_data(nodes_data)
+        for key in (
+            "vid1", "vid2", "r", "comp_uidxs",
+            "rated_uidxs", "rated_vidxs", "pos1", "pos2",
+        ):
+            tens = torch.as_tensor(getattr(self, key), device=self.device)
+            setattr(self, key, tens)
+
+    def set_allnodes(self, nodes_data, users_ids):
         """Puts data in Licchavi and create a model for each node
 
-        data_dic (dictionnary): {userID: (vID1_batch, vID2_batch,
-                                            rating_batch, single_vIDs, masks)}
+        nodes_data (int array, int array, float array, int array):
+            (vID1 indexes, vID2 indexes, ratings, offsets), comparisons
+            of user i are in [offsets[i], offsets[i + 1][
         users_ids (int array): users IDs
         """
-        nb = len(data_dic)
+        nb = len(users_ids)
         self.nb_nodes = nb
         self.users = users_ids
-        self.nodes = {
-            id: Node(
-                *data, *self._get_default(), self.w, self.lr_node, self.lr_s, self.opt
-            )
-            for id, data in zip(users_ids, data_dic.values())
-        }
+        self._set_data(nodes_data)
+        self._set_params(*self._get_default(nb))
+        self.nodes = {id: Node(self, uidx) for uidx, id in enumerate(users_ids)}
         self._show("Total number of nodes : {}".format(self.nb_nodes), 1)
 
-    def load_and_update(self, data_dic, user_ids, fullpath):
+    def load_and_update(self, nodes_data, user_ids, saved_data):
         """Loads models and expands them as required
 
-        data_dic (dictionnary):  {userID: (vID1_batch, vID2_batch,
-                                    rating_batch, single_vIDs, masks)}
+        nodes_data (int array, int array, float array, int array):
+            (vID1 indexes, vID2 indexes, ratings, offsets), comparisons
+            of user i are in [offsets[i], offsets[i + 1][
         user_ids (int array): users IDs
+        saved_data (tuple): checkpoint, output of load_checkpoint()
         """
         loginf("Loading models")
-        saved_data = torch.load(fullpath)
         self.criteria, dic_old, gen_model_old, loc_models_old = saved_data
         nb_new = self.nb_vids - len(dic_old)  # number of new videos
         # initialize scores for new videos
-        self.global_model = expand_tens(gen_model_old, nb_new, self.device)
+        self.global_model = expand_tens(
+            torch.tensor(gen_model_old, device=self.device), nb_new, self.device
+        )
         self.opt_gen = self.opt([self.global_model], lr=self.lr_gen)
         self.users = user_ids
         nbn = len(user_ids)
         self.nb_nodes = nbn
-        self.nodes = {
-            id: Node(
-                *data,
-                *self._get_saved(loc_models_old, id, nb_new),
-                self.w,
-                self.lr_node,
-                self.lr_s,
-                self.opt,
-            )
-            for id, data in zip(user_ids, data_dic.values())
-        }
+        self._set_data(nodes_data)
+        self._set_params(*self._get_saved(loc_models_old, user_ids))
+        self._set_touched(loc_models_old, user_ids)
+        self.nodes = {id: Node(self, uidx) for uidx, id in enumerate(user_ids)}
         self._show(f"Total number of nodes : {self.nb_nodes}", 1)
         loginf("Models updated")
 
@@ -204,44 +233,65 @@ class Licchavi:
         - (tensor of all vIDS , tensor of global video scores)
         - (list of tensor of local vIDs, list of tensors of local video scores)
         """
-        loc_scores = []
-        list_vids_batchs = []
-
+        sizes = np.diff(self.rated_offsets).tolist()
         with torch.no_grad():
             glob_scores = self.global_model
-            for node in self.nodes.values():
-                input = one_hot_vids(self.vid_vidx, node.vids, self.device)
-                output = predict(input, node.model)
-                loc_scores.append(output)
-                list_vids_batchs.append(node.vids)
-            vids_batch = list(self.vid_vidx.keys())
-
+            loc_scores = list(torch.split(self.models, sizes))
+        list_vids_batchs = np.split(self.rated_vids, self.rated_offsets[1:-1])
+        vids_batch = list(self.vid_vidx.keys())
         return (vids_batch, glob_scores), (list_vids_batchs, loc_scores)
 
     def save_models(self, fullpath):
-        """Saves age and global and local weights, detached (no gradients)"""
+        """Saves age and global and local weights, as numpy arrays
+
+        Checkpoints don't depend on the backend used
+        """
         loginf("Saving models")
-        local_data = {
-            id: (node.s, node.model.detach(), node.age)  # s  # model  # age
-            for id, node in self.nodes.items()
-        }
+        local_data = (
+            np.asarray(self.users),  # users IDs
+            self.s.detach().cpu().numpy(),
+            self.rated_offsets,
+            self.rated_vidxs.cpu().numpy(),
+            self.models.detach().cpu().numpy(),
+            self.ages.numpy(),
+            self.comp_hashes,  # to find nodes changed (incremental training)
+        )
         saved_data = (
             self.criteria,
             self.vid_vidx,
-            self.global_model.detach(),
+            self.global_model.detach().cpu().numpy(),
             local_data,
         )
-        torch.save(saved_data, fullpath)
+        save_checkpoint(saved_data, fullpath)
         loginf("Models saved")
 
-    # --------- utility --------------
-    def all_nodes(self, key):
-        """Returns a generator of one parameter for all nodes"""
-        for node in self.nodes.values():
-            yield getattr(node, key)
+    def get_state(self):
+        """Returns copies of parameters as numpy arrays
+
+        Returns:
+            (float array, float array, float array, int array):
+                global scores, s parameters, local scores and ages
+        """
+        return tuple(
+            tens.detach().cpu().numpy().copy()
+            for tens in (self.global_model, self.s, self.models, self.ages)
+        )
+
+    def set_state(self, global_model, s, models, ages):
+        """Sets parameters from numpy arrays, as returned by get_state()"""
+        with torch.no_grad():
+            for tens, arr in zip(
+                (self.global_model, self.s, self.models), (global_model, s, models)
+            ):
+                tens.copy_(torch.as_tensor(arr, device=self.device))
+        self.ages = torch.as_tensor(ages, dtype=torch.long)
 
+    # --------- utility --------------
     def stat_s(self):
         """Prints s stats"""
+        # dev module, resets plots folder when imported
+        from .dev.visualisation import disp_one_by_line
+
         l_s = [
             (round_loss(s, 2), id)
             for s, id in zip(self.all_nodes("s"), self.nodes.keys())
@@ -260,188 +310,258 @@ class Licchavi:
     # ---------- methods for training ------------
     def _set_lr(self):
         """Sets learning rates of optimizers"""
-        for node in self.nodes.values():
-            node.opt.param_groups[0]["lr"] = self.lr_node  # node optimizer
-            # FIXME update lr_s (not useful currently)
+        self.opt_loc.param_groups[0]["lr"] = self.lr_node  # local optimizer
+        # FIXME update lr_s (not useful currently)
         self.opt_gen.param_groups[0]["lr"] = self.lr_gen
 
-    @gin.configurable
-    def _lr_schedule(
-        self,
-        epoch,
-        # configured with gin in "hyperparameters.gin"
-        decay_rush,
-        decay_fine,
-        precision,
-        epsilon,
-        min_lr_fine,
-        lr_rush_duration,
-    ):
-        """Changes learning rates in a (hopefully) smart way
-
-        epoch (int): current epoch
-        verb (int): verbosity level
+    def _get_conv_values(self):
+        """Returns parameters and gradients of the last steps, numpy arrays
 
         Returns:
-            (bool): True for an early stopping
+            (float array, float array, float array, float array):
+                local scores, global scores and their gradients,
+                weights of nodes
         """
+        return tuple(
+            tens.detach().cpu().numpy()  # no copy on cpu
+            for tens in (
+                self.models, self.global_model, self.global_model.grad,
+                self.weights,
+            )
+        )
+
+    def _get_fit_derivs(self, comps):
+        """Returns derivatives of the fitting loss for each local score
 
-        # phase 1  : rush (high lr to increase l2 norm fast)
-        if epoch <= lr_rush_duration:
-            self.lr_gen *= decay_rush
-            self.lr_node *= decay_rush
-        # phase 2 : fine tuning (low lr), we monitor equilibrium for early stop
-        elif epoch % 2 == 0:
-            if self.lr_node >= min_lr_fine / decay_fine:
-                self.lr_gen *= decay_fine
-                self.lr_node *= decay_fine
-            frac_glob = check_equilibrium_glob(epsilon, self)
-            self._show(f"Global eq({epsilon}): {round(frac_glob, 3)}", 1)
-            if frac_glob > precision:
-                frac_loc = check_equilibrium_loc(epsilon, self)
-                self._show(f"Local eq({epsilon}): {round(frac_loc, 3)}", 1)
-                if frac_loc > precision:
-                    loginf("Early Stopping")
-                    return True
-        return False
+        comps (int array): comparisons used
+
+        Returns:
+            (float array, float array): first and second derivatives
+        """
+        comps = torch.as_tensor(comps, device=self.device)
+        grad, hess = get_fit_derivs(self, comps)
+        return grad.cpu().numpy(), hess.cpu().numpy()
+
+    def _trace(self, path):
+        """Returns a context manager tracing torch operators run in it
+
+        path (str): path of the trace, without extension
+        """
+        return torch_trace(path)
 
     def _zero_opt(self):
         """Sets gradients of all models"""
-        for node in self.nodes.values():
-            node.opt.zero_grad(set_to_none=True)  # node optimizer
+        self.opt_loc.zero_grad(set_to_none=True)  # local optimizer
         self.opt_gen.zero_grad(set_to_none=True)  # general optimizer
 
-    def _update_hist(self, epoch, fit, s, gen, reg):
-        """Updates history (at end of epoch)"""
-        self.history["fit"].append(round_loss(fit))
-        self.history["s"].append(round_loss(s))
-        self.history["gen"].append(round_loss(gen))
-        self.history["reg"].append(round_loss(reg))
+    def _hist_metrics(self):
+        """Returns metrics of the global model (collected epochs only)
+
+        Returns:
+            (dictionnary): l2 norm, scalar product with the gradient of
+                the previous collected epoch and norm of the gradient
+        """
         norm = model_norm(self.global_model, pow=(2, 0.5))
-        self.history["l2_norm"].append(round_loss(norm, 3))
         grad_gen = extract_grad(self.global_model)
-        if epoch > 1:  # no previous model for first epoch
+        if self.last_grad is not None:  # no previous gradient at first epoch
             scal_grad = scalar_product(self.last_grad, grad_gen)
-            self.history["grad_sp"].append(scal_grad)
         else:
-            self.history["grad_sp"].append(0)  # default value for first epoch
-        self.last_grad = deepcopy(extract_grad(self.global_model))
+            scal_grad = 0
+        self.last_grad = deepcopy(grad_gen)
         grad_norm = scalar_product(grad_gen, grad_gen)
-        self.history["grad_norm"].append(grad_norm)
+        return {"l2_norm": norm, "grad_sp": scal_grad, "grad_norm": grad_norm}
 
     def _old(self, years):
         """Increments age of nodes (during training)"""
-        for node in self.nodes.values():
-            node.age += years
+        self.ages += years
+
+    def _mask_grads(self, tensors):
+        """Zeroes gradients of parameters not trained (incremental training)
+
+        tensors (tensor list): parameters, in the order of self.masks
+        """
+        if self.masks is None:
+            return
+        with torch.no_grad():
+            for tens, mask in zip(tensors, self.masks):
+                if tens is not None:
+                    tens.grad *= torch.as_tensor(mask, device=self.device)
 
     def _do_step(self, fit_step):
         """Makes step for appropriate optimizer(s)"""
         if fit_step:  # updating local or global alternatively
-            for node in self.nodes.values():
-                node.opt.step()  # node optimizer
+            self._mask_grads((self.models, self.s))
+            with torch.no_grad():
+                self.s.grad *= self.lr_s_nodes  # per node learning rates
+            self.opt_loc.step()  # local optimizer
         else:
+            self._mask_grads((None, None, self.global_model))
             self.opt_gen.step()
 
-    def _regul_s(self):
-        """regulate s parameters"""
-        for node in self.nodes.values():
-            if node.s <= 0:
-                with torch.no_grad():
-                    node.s[0] = 0.4
-                    logging.warning("Regulating negative s")
-
-    def _print_losses(self, tot, fit, s, gen, reg):
-        """Prints losses into log info"""
-        fit, s = round_loss(fit, 2), round_loss(s, 2)
-        gen, reg = round_loss(gen, 2), round_loss(reg, 2)
-
-        loginf(
-            f"total loss : {tot}\nfitting : {fit}, "
-            f"s : {s}, generalisation : {gen}, regularisation : {reg}"
+    def _fit_step(self):
+        """Makes one gradient descent step on local parameters
+
+        Returns:
+            (float tensor, float tensor, float tensor): fitting, s
+                                        and generalisation losses
+        """
+        self._zero_opt()  # resetting gradients
+        fit_loss, s_loss, gen_loss = loss_fit_s_gen(self)
+        loss = fit_loss + s_loss + gen_loss
+        loss.backward()
+        self._do_step(True)
+        return fit_loss, s_loss, gen_loss
+
+    def _solve_local(self, tol, max_iters):
+        """Solves the problem of each node trained, global scores fixed,
+        with the numpy kernel of LicchaviNumpy on copies of parameters
+
+        Returns:
+            (float, float, float): fitting, s and generalisation losses
+        """
+        from .licchavi_numpy import _solve_local  # imported when used
+
+        models, s, glob, weights = (
+            tens.detach().cpu().numpy().copy()
+            for tens in (self.models, self.s, self.global_model, self.weights)
+        )
+        data = tuple(
+            tens.cpu().numpy() for tens in (
+                self.r, self.pos1, self.pos2,
+                self.comp_uidxs, self.rated_uidxs, self.rated_vidxs,
+            )
+        )
+        nodes = None if self.masks is None else self.masks[1] > 0
+        losses, kink_signs, nb_iters = _solve_local(
+            models, s, glob, weights, data, tol, max_iters, nodes
+        )
+        with torch.no_grad():
+            self.models.copy_(torch.as_tensor(models))
+            self.s.copy_(torch.as_tensor(s))
+        self.kink_signs = torch.as_tensor(
+            kink_signs, dtype=torch.float32, device=self.device
+        )
+        self._show(f"local problems solved in {nb_iters} iterations", 2)
+        return losses
+
+    def _add_kink_grads(self):
+        """Adds to the gradient of global scores the derivatives of local
+        scores equal to their global score (0 with autograd), given by
+        the "block" solver (see licchavi_numpy._solve_nodes())
+        """
+        with torch.no_grad():
+            at_kink = self.models == self.global_model[self.rated_vidxs]
+            derivs = self.weights[self.rated_uidxs] * self.kink_signs
+            self.global_model.grad.index_add_(
+                0, self.rated_vidxs, -derivs * at_kink
+            )
+
+    def _gen_step(self):
+        """Makes one gradient descent step on global parameters
+
+        Returns:
+            (float tensor, float tensor): generalisation and
+                                            regularisation losses
+        """
+        self._zero_opt()  # resetting gradients
+        gen_loss, reg_loss = loss_gen_reg(self)
+        loss = gen_loss + reg_loss
+        loss.backward()
+        if self.solver == "block" and self.kink_signs is not None:
+            self._add_kink_grads()
+        self._do_step(False)
+        return gen_loss, reg_loss
+
+    def _solve_global(self):
+        """Sets global scores trained to their exact minimum, local scores
+        fixed, with the numpy kernel of LicchaviNumpy
+
+        Returns:
+            (float tensor, float tensor): generalisation and
+                                            regularisation losses
+        """
+        from .licchavi_numpy import _solve_global  # imported when used
+
+        glob = _solve_global(
+            self.models.detach().cpu().numpy(),
+            self.weights[self.rated_uidxs].cpu().numpy(),
+            self.rated_vidxs.cpu().numpy(), self.nb_vids, self.w0,
+        )
+        glob = torch.as_tensor(glob, dtype=torch.float32, device=self.device)
+        with torch.no_grad():
+            if self.masks is not None:  # only some global scores trained
+                trained = torch.as_tensor(self.masks[2], device=self.device)
+                glob = torch.where(trained > 0, glob, self.global_model)
+            self.global_model.copy_(glob)
+        self._zero_opt()  # gradient at new global scores, for convergence
+        gen_loss, reg_loss = loss_gen_reg(self)
+        (gen_loss + reg_loss).backward()
+        self._mask_grads((None, None, self.global_model))
+        return gen_loss, reg_loss
+
+    def _get_flat_params(self):
+        """Returns local scores, s parameters and global scores concatenated
+
+        Returns:
+            (float array): all parameters
+        """
+        params = torch.cat([self.models, self.s, self.global_model])
+        return params.detach().cpu().numpy()
+
+    def _set_flat_params(self, params):
+        """Sets local scores, s parameters and global scores from one array
+
+        params (float array): all parameters, as in _get_flat_params()
+        """
+        params = torch.as_tensor(params, dtype=torch.float32, device=self.device)
+        models, s, glob = torch.split(
+            params, [len(self.models), self.nb_nodes, self.nb_vids]
         )
+        with torch.no_grad():
+            self.models.copy_(models)
+            self.s.copy_(s)
+            self.global_model.copy_(glob)
 
-    # ====================  TRAINING ==================
+    def _full_loss_grad(self, smoothing):
+        """Computes all terms of loss and gradient of all parameters
 
-    def train(self, nb_epochs=1, compute_uncertainty=False):
-        """training loop
+        smoothing (float): smoothing of l1 generalisation term
 
-        nb_epochs (int): (maximum) number of training epochs
-        compute_uncertainty (bool): wether to compute uncertainty
-            at the end or not (takes time)
+        Returns:
+            (float, float, float, float): fitting, s, generalisation
+                                            and regularisation losses
+            (float array): gradient of parameters, same order as
+                                _get_flat_params()
+        """
+        self._zero_opt()  # resetting gradients
+        fit_loss = _batched_fit_loss(self, self.models, self.s)
+        s_loss = get_s_loss(self.s).sum()
+        gen_loss = _batched_gen_loss(
+            self, self.models, self.weights, smoothing=smoothing
+        )
+        reg_loss = self.w0 * model_norm(self.global_model)
+        losses = (fit_loss, s_loss, gen_loss, reg_loss)
+        sum(losses).backward()
+        grad = torch.cat(
+            [self.models.grad, self.s.grad, self.global_model.grad]
+        )
+        return tuple(loss.item() for loss in losses), grad.cpu().numpy()
+
+    def _regul_s(self):
+        """regulate s parameters"""
+        negative = self.s <= 0
+        if negative.any():
+            with torch.no_grad():
+                self.s[negative] = 0.4
+            logging.warning("Regulating negative s")
+
+    def _get_uncertainty(self):
+        """Returns uncertainty of global scores and of local scores
 
         Returns:
-            (float list list, float list): uncertainty of local scores
-                                            (None, None) if not computed
+            (float tensor): uncertainty of global scores
+            (float tensor list list): uncertainty of local scores
         """
-        loginf("STARTING TRAINING")
-        time_train = time()
-
-        # initialisation to avoid undefined variables at epoch 1
-        loss, fit_loss, s_loss, gen_loss, reg_loss = 0, 0, 0, 0, 0
-
-        # training loop
-        nb_steps = self.gen_freq + 1  # one fitting step
-        for epoch in range(1, nb_epochs + 1):
-            early_stop = self._lr_schedule(epoch)
-            if early_stop:
-                break  # don't do this epoch nor any other
-            self._set_lr()
-            self._regul_s()
-
-            self._show("epoch {}/{}".format(epoch, nb_epochs), 1)
-            time_ep = time()
-
-            for step in range(1, nb_steps + 1):
-                fit_step = step == 1  # fitting on first step only
-
-                self._show(
-                    f"step : {step}/{nb_steps} " f'{"(fit)" if fit_step else "(gen)"}',
-                    2,
-                )
-                self._zero_opt()  # resetting gradients
-
-                # ----------------    Licchavi loss  -------------------------
-                # only first 3 terms of loss updated
-                if fit_step:
-                    fit_loss, s_loss, gen_loss = loss_fit_s_gen(self)
-                    loss = fit_loss + s_loss + gen_loss
-                # only last 2 terms of loss updated
-                else:
-                    gen_loss, reg_loss = loss_gen_reg(self)
-                    loss = gen_loss + reg_loss
-
-                if self.verb >= 2:
-                    total_loss = round_loss(fit_loss + s_loss + gen_loss + reg_loss)
-                    self._print_losses(total_loss, fit_loss, s_loss, gen_loss, reg_loss)
-                # Gradient descent
-                loss.backward()
-                self._do_step(fit_step)
-
-            self._update_hist(epoch, fit_loss, s_loss, gen_loss, reg_loss)
-            self._old(1)  # aging all nodes of 1 epoch
-            self._show(f"epoch time :{round(time() - time_ep, 2)}", 1.5)
-
-        # ----------------- end of training -------------------------------
-        loginf("END OF TRAINING")
-        loginf(f"training time :{round(time() - time_train, 2)}")
-        if compute_uncertainty:
-            time_uncert = time()
-            uncert_loc = get_uncertainty_loc(self)
-            uncert_glob = get_uncertainty_glob(self)
-            loginf(f"Uncertainty time: {time() - time_uncert}")
-            return uncert_glob, uncert_loc  # self.train() returns uncertainty
-        return None, None  # if uncertainty not computed
-
-    # ------------ to check for problems --------------------------
-    def check(self):
-        """Performs some tests on internal parameters adequation"""
-        # population check
-        b1 = self.nb_nodes == len(self.nodes)
-        # history check
-        reference = self.history["fit"]
-        b2 = all([len(v) == len(reference) for v in self.history.values()])
-
-        if b1 and b2:
-            loginf("No Problem")
-        else:
-            logging.warning("Coherency problem in Licchavi object ")
+        uncert_loc = get_uncertainty_loc(self)
+        uncert_glob = get_uncertainty_glob(self)
+        return uncert_glob, uncert_loc
@@ -0,0 +1,840 @@
+import abc
+import numpy as np
+from time import time
+import logging
+from logging import info as loginf
+from contextlib import nullcontext
+import gin
+
+from .data_utility import (
+    round_loss, get_comp_uidxs, get_rated_pairs, get_pairs_positions,
+    get_vid_index, get_comps_hashes,
+)
+from .history import History
+from .monitoring import cprofile_trace, profile_path
+
+"""
+Training structure shared by Licchavi backends, used in "core.py"
+
+Main file is "ml_train.py"
+
+Structure:
+- LicchaviBase holds hyperparameters, data and the training loop,
+    it doesn't depend on torch
+- backends inherit from it and implement training steps:
+-- Licchavi ("licchavi.py") uses torch autograd
+-- LicchaviNumpy ("licchavi_numpy.py") uses analytic gradients with numpy
+"""
+
+S_MIN = 1e-3  # lower bound of s parameters for L-BFGS
+
+
+class _EquilibriumReached(Exception):
+    """Raised to stop L-BFGS iterations once parameters are at equilibrium"""
+
+
+@gin.configurable
+class LicchaviBase(abc.ABC):
+    """Training structure including local models and general one"""
+
+    def __init__(
+        self,
+        nb_vids,
+        vid_vidx,
+        crit,
+        device="cpu",
+        verb=1,
+        # configured with gin in "hyperparameters.gin"
+        lr_node=None,
+        lr_s=None,
+        lr_gen=None,
+        gen_freq=None,
+        w0=None,
+        w=None,
+        solver="sgd",
+        glob_update="sgd",
+        conv_sample=1,
+        profile_epoch=None,
+        shards=1,
+    ):
+        """
+        nb_vids (int): number of different videos rated by
+                        at least one contributor for this criteria
+        vid_vidx (dictionnary): dictionnary of {video ID: video index}
+        crit (str): comparison criteria learnt
+        device (str): device used (cpu/gpu)
+        verb (float): verbosity level
+        """
+        self.verb = verb
+        self.nb_vids = nb_vids  # number of parameters of the model
+        self.vid_vidx = vid_vidx  # {video ID : video index}
+        self.criteria = crit  # criteria learnt by this Licchavi
+        self.device = device  # device used (cpu/gpu)
+
+        # defined in "hyperparameters.gin"
+        self.lr_node = lr_node  # local learning rate (local scores)
+        self.lr_s = lr_s  # local learning rate for s parameter
+        self.lr_gen = lr_gen  # global learning rate (global scores)
+        self.gen_freq = gen_freq  # generalisation frequency (>=1)
+        self.w0 = w0  # regularisation strength
+        self.w = w  # default weight for a node
+        self.solver = solver  # "sgd", "lbfgs" (quasi-Newton) or "block" (local problems)
+        self.glob_update = glob_update  # "sgd" (gradient steps) or "exact" (closed form)
+        self.conv_sample = conv_sample  # fraction of scores monitored
+        self.profile_epoch = profile_epoch  # epoch traced (None for none)
+        self.shards = shards  # processes doing local steps (numpy backend)
+
+        self.nb_nodes = 0
+        self.nb_iters = 0  # number of epochs (or L-BFGS iterations) done
+        self.nb_evals = 0  # number of loss and gradient evaluations
+        self.history = History()  # metrics, level configured with gin
+        self.last_grad = None  # global gradient of last collected epoch
+        self.times = {}  # durations of last training ("train", "uncertainty")
+        self.profiled = False  # wether profile_epoch was traced
+        self.kink_signs = None  # see licchavi_numpy._solve_nodes() ("block")
+
+        self.users = []  # user IDs
+        self.nodes = {}  # {user ID: Node()}, views on data and parameters
+        self.s = None  # s parameter of each node
+
+        # comparisons of all nodes, concatenated (see _set_data())
+        self.offsets = None
+        self.vid1, self.vid2, self.r, self.comp_uidxs = None, None, None, None
+        self.rated_offsets, self.rated_uidxs, self.rated_vidxs = None, None, None
+        self.pos1, self.pos2 = None, None
+        self.vid_order, self.vid_offsets = None, None
+        self.all_vids = None  # video IDs, by video index
+        self.rated_vids = None  # video IDs of all local scores
+        self.comp_hashes = None  # fingerprint of comparisons of each node
+
+        # incremental training (see _train_incremental())
+        self.touched = None  # nodes whose comparisons changed since save
+        self.touched_vids = None  # videos rated by removed nodes
+        self.masks = None  # masks of gradients (local, s, global)
+
+        # convergence monitoring (see _check_convergence())
+        self.conv_idxs = None  # local and global scores monitored
+        self.last_lr_gen = 0  # learning rate of last global step
+
+    def _show(self, msg, level):
+        """Utility for handling logging messages
+
+        msg (str): info message
+        level (float): minimum level of verbosity to show -msg
+        """
+        if self.verb >= level:
+            loginf(msg)
+
+    # ------------ input and output --------------------
+    def _set_data(self, nodes_data):
+        """Stores comparisons of all nodes as concatenated arrays
+
+        nodes_data (int array, int array, float array, int array):
+            (vID1 indexes, vID2 indexes, ratings, offsets), comparisons
+            of user i are in [offsets[i], offsets[i + 1][
+        """
+        vidx1, vidx2, r, offsets = nodes_data
+        comp_uidxs = get_comp_uidxs(offsets)
+        rated_uidxs, rated_vidxs = get_rated_pairs(
+            comp_uidxs, vidx1, vidx2, self.nb_vids
+        )
+        pos1, _ = get_pairs_positions(
+            rated_uidxs, rated_vidxs, comp_uidxs, vidx1, self.nb_vids
+        )
+        pos2, _ = get_pairs_positions(
+            rated_uidxs, rated_vidxs, comp_uidxs, vidx2, self.nb_vids
+        )
+        nbn = len(offsets) - 1
+        self.all_vids = np.fromiter(
+            self.vid_vidx.keys(), dtype=np.int64, count=len(self.vid_vidx)
+        )
+        self.offsets = offsets  # comparisons of node i in [off[i], off[i+1][
+        self.vid1, self.vid2, self.r = vidx1, vidx2, r
+        self.comp_uidxs = comp_uidxs
+        # (user index, video index) of all videos rated, sorted by user,
+        # local scores of node i are in [rated_off[i], rated_off[i+1][
+        self.rated_offsets = np.searchsorted(rated_uidxs, np.arange(nbn + 1))
+        self.rated_uidxs, self.rated_vidxs = rated_uidxs, rated_vidxs
+        self.rated_vids = self.all_vids[rated_vidxs]
+        self.comp_hashes = get_comps_hashes(
+            self.all_vids[vidx1], self.all_vids[vidx2], r, offsets
+        )
+        # positions of compared videos in local models
+        self.pos1, self.pos2 = pos1, pos2
+        # video to contributors index, local scores of video j are at
+        # positions vid_order[vid_offsets[j]:vid_offsets[j+1]]
+        self.vid_order, self.vid_offsets = get_vid_index(
+            rated_vidxs, self.nb_vids
+        )
+
+    def _match_saved(self, loc_models_old, users_ids, rated_uidxs, rated_vidxs):
+        """Matches saved users and (user, video) couples with current ones
+
+        loc_models_old (array, array, int array, int array, array, array):
+            saved (users IDs, s, rated offsets, rated vidxs, models, ages)
+        users_ids (int array): users IDs
+        rated_uidxs (int array): user index of each current local score
+        rated_vidxs (int array): video index of each current local score
+
+        Returns:
+            (int array, int array): indexes of known users,
+                                        and their indexes in saved data
+            (int array, int array): positions in local models of known
+                (user, video) couples, and their positions in saved data
+        """
+        users_old, _, offsets_old, vidxs_old = loc_models_old[:4]
+        # matching users
+        pos = np.searchsorted(users_old, users_ids).clip(max=len(users_old) - 1)
+        known = users_old[pos] == users_ids  # users already in saved models
+        # matching (user, video) couples, new ones are not in saved couples
+        old_uidxs = np.repeat(np.arange(len(users_old)), np.diff(offsets_old))
+        rated_pos, rated_known = get_pairs_positions(
+            old_uidxs, vidxs_old, pos[rated_uidxs], rated_vidxs, self.nb_vids
+        )
+        rated_known &= known[rated_uidxs]
+        return (
+            (np.flatnonzero(known), pos[known]),
+            (np.flatnonzero(rated_known), rated_pos[rated_known]),
+        )
+
+    def _set_touched(self, loc_models_old, users_ids):
+        """Finds nodes whose comparisons changed since the checkpoint
+
+        New users are touched, as all users if the checkpoint has no
+        fingerprints of comparisons. Videos rated by removed users are
+        touched.
+
+        loc_models_old (array, array, int array, int array, array, array
+            (, uint64 array)): saved (users IDs, s, rated offsets,
+            rated vidxs, models, ages (, fingerprints of comparisons))
+        users_ids (int array): users IDs
+        """
+        users_old, _, offsets_old, vidxs_old = loc_models_old[:4]
+        pos = np.searchsorted(users_old, users_ids).clip(max=len(users_old) - 1)
+        known = users_old[pos] == users_ids
+        self.touched = np.ones(len(users_ids), dtype=bool)
+        if len(loc_models_old) > 6:  # fingerprints saved
+            hashes_old = loc_models_old[6]
+            self.touched[known] = (
+                hashes_old[pos[known]] != self.comp_hashes[known]
+            )
+        kept = np.zeros(len(users_old), dtype=bool)
+        kept[pos[known]] = True
+        removed_vidxs = vidxs_old[np.repeat(~kept, np.diff(offsets_old))]
+        self.touched_vids = np.zeros(self.nb_vids, dtype=bool)
+        self.touched_vids[removed_vidxs] = True
+
+    # --------- utility --------------
+    def all_nodes(self, key):
+        """Returns a generator of one parameter for all nodes"""
+        for node in self.nodes.values():
+            yield getattr(node, key)
+
+    # ---------- methods for training ------------
+    @gin.configurable
+    def _lr_schedule(
+        self,
+        epoch,
+        # configured with gin in "hyperparameters.gin"
+        decay_rush,
+        decay_fine,
+        precision,
+        epsilon,
+        min_lr_fine,
+        lr_rush_duration,
+    ):
+        """Changes learning rates in a (hopefully) smart way
+
+        epoch (int): current epoch
+        verb (int): verbosity level
+
+        Returns:
+            (bool): True for an early stopping
+        """
+
+        # phase 1  : rush (high lr to increase l2 norm fast)
+        if epoch <= lr_rush_duration:
+            self.lr_gen *= decay_rush
+            self.lr_node *= decay_rush
+        # phase 2 : fine tuning (low lr), we monitor equilibrium for early stop
+        elif epoch % 2 == 0:
+            if self.lr_node >= min_lr_fine / decay_fine:
+                self.lr_gen *= decay_fine
+                self.lr_node *= decay_fine
+            if self._at_equilibrium(precision, epsilon):
+                loginf("Early Stopping")
+                return True
+        return False
+
+    def _rated_idxs(self):
+        """Returns user and video indexes of local scores, numpy arrays
+
+        Returns:
+            (int array, int array): user index and video index
+                                        of each local score
+        """
+        rated_uidxs = np.repeat(
+            np.arange(self.nb_nodes), np.diff(self.rated_offsets)
+        )
+        rated_vidxs = np.empty(len(rated_uidxs), dtype=np.int64)
+        rated_vidxs[self.vid_order] = np.repeat(
+            np.arange(self.nb_vids), np.diff(self.vid_offsets)
+        )
+        return rated_uidxs, rated_vidxs
+
+    def _set_masks(self, nodes=None, vids=None, loc=None):
+        """Sets parameters trained, the others keep their values
+
+        nodes (bool array): nodes trained (s parameters and local scores),
+                                None to train all parameters
+        vids (bool array): global scores trained
+        loc (bool array): local scores trained (those of -nodes if None)
+        """
+        self.conv_idxs = None  # monitored scores are drawn again
+        if nodes is None:
+            self.masks = None
+            return
+        if loc is None:
+            loc = np.repeat(nodes, np.diff(self.rated_offsets))
+        self.masks = tuple(
+            mask.astype(np.float32) for mask in (loc, nodes, vids)
+        )
+
+    def _sample_convergence(self):
+        """Draws nodes and videos whose scores are monitored for convergence
+
+        Returns:
+            (int array, int array, int array, int array): positions of
+                monitored local scores, their user indexes, video indexes
+                and comparisons of monitored nodes
+            (int array, int array, int array, int array): monitored
+                videos, positions of their local scores, index of their
+                video among monitored ones and user indexes
+        """
+        counts = np.diff(self.vid_offsets)
+        rated_uidxs, rated_vidxs = self._rated_idxs()
+        nodes = np.random.rand(self.nb_nodes) < self.conv_sample
+        vids = np.random.rand(self.nb_vids) < self.conv_sample
+        if self.masks is not None:  # only trained scores are monitored
+            nodes &= self.masks[1] > 0
+            vids &= self.masks[2] > 0
+        loc = np.flatnonzero(nodes[rated_uidxs])
+        comps = np.flatnonzero(np.repeat(nodes, np.diff(self.offsets)))
+        glob = np.flatnonzero(vids)
+        glob_pos = self.vid_order[np.repeat(vids, counts)]  # grouped by video
+        glob_seg = np.repeat(np.arange(len(glob)), counts[glob])
+        return (
+            (loc, rated_uidxs[loc], rated_vidxs[loc], comps),
+            (glob, glob_pos, glob_seg, rated_uidxs[glob_pos]),
+        )
+
+    def _check_convergence(self, epsilon):
+        """Returns proportions of monitored scores which have converged
+
+        A score has converged if the derivative of the loss points towards
+        it at -epsilon on both sides.
+        Derivatives for global scores are the gradients of the last
+        training step plus the jumps of the L1 generalisation term, there
+        is no approximation. Derivatives for local scores use the closed
+        form first and second derivatives of the fitting term on the
+        comparisons of monitored nodes. No loss is evaluated nor
+        backpropagated here.
+
+        epsilon (float): strength of equilibrium asked
+
+        Returns:
+            (float, float): fractions of local and global scores
+                                at equilibrium
+        """
+        if self.conv_idxs is None:
+            self.conv_idxs = self._sample_convergence()
+        loc, loc_uidxs, loc_vidxs, comps = self.conv_idxs[0]
+        glob, pos, seg, pos_uidxs = self.conv_idxs[1]
+        models, glob_model, glob_grad, weights = self._get_conv_values()
+
+        # local scores
+        fit_grad, fit_hess = self._get_fit_derivs(comps)
+        loc_x, loc_w = models[loc], weights[loc_uidxs]
+        loc_glob = glob_model[loc_vidxs]
+
+        def loc_deriv(incr):
+            return (
+                fit_grad[loc]
+                + fit_hess[loc] * incr
+                + loc_w * np.sign(loc_x + incr - loc_glob)
+            )
+
+        # global scores, with local scores of each video
+        glob_x = glob_model[glob]
+        glob_eval = glob_x + self.last_lr_gen * glob_grad[glob]  # before step
+        l_scores, l_w = models[pos], weights[pos_uidxs]
+        jumps_eval = np.sign(glob_eval[seg] - l_scores)
+
+        def glob_deriv(incr):
+            jumps = np.sign(glob_x[seg] + incr - l_scores) - jumps_eval
+            return (
+                glob_grad[glob]
+                + np.bincount(seg, l_w * jumps, len(glob))
+                + 2 * self.w0 * (glob_x + incr - glob_eval)
+            )
+
+        fracs = []
+        for deriv in (loc_deriv, glob_deriv):
+            converged = (deriv(epsilon) > 0) & (deriv(-epsilon) < 0)
+            fracs.append(converged.mean() if len(converged) else 1.0)
+        return tuple(fracs)
+
+    def _at_equilibrium(self, precision, epsilon):
+        """Checks if enough global and local scores have converged
+
+        precision (float): proportion of scores at equilibrium required
+        epsilon (float): strength of equilibrium asked
+
+        Returns:
+            (bool): True if both global and local scores are at equilibrium
+        """
+        frac_loc, frac_glob = self._check_convergence(epsilon)
+        self._show(f"Global eq({epsilon}): {round(frac_glob, 3)}", 1)
+        self._show(f"Local eq({epsilon}): {round(frac_loc, 3)}", 1)
+        return frac_glob > precision and frac_loc > precision
+
+    def _print_losses(self, tot, fit, s, gen, reg):
+        """Prints losses into log info"""
+        fit, s = round_loss(fit, 2), round_loss(s, 2)
+        gen, reg = round_loss(gen, 2), round_loss(reg, 2)
+
+        loginf(
+            f"total loss : {tot}\nfitting : {fit}, "
+            f"s : {s}, generalisation : {gen}, regularisation : {reg}"
+        )
+
+    # ---------- implemented by backends ------------
+    @abc.abstractmethod
+    def set_allnodes(self, nodes_data, users_ids):
+        """Puts data in Licchavi and create a model for each node"""
+
+    @abc.abstractmethod
+    def load_and_update(self, nodes_data, user_ids, saved_data):
+        """Loads models and expands them as required"""
+
+    @abc.abstractmethod
+    def output_scores(self):
+        """Returns video scores both global and local"""
+
+    def output_flat_scores(self):
+        """Returns video scores both global and local, as flat numpy arrays
+
+        Returns:
+            (float array, float array): video IDs and global scores
+            (int array, float array, float array): user index, video ID
+                and score of each local score (grouped by user)
+        """
+        glob, _, models, _ = self.get_state()
+        rated_uidxs = np.repeat(
+            np.arange(self.nb_nodes), np.diff(self.rated_offsets)
+        )
+        return (self.all_vids, glob), (rated_uidxs, self.rated_vids, models)
+
+    @abc.abstractmethod
+    def save_models(self, fullpath):
+        """Saves age and global and local weights"""
+
+    @abc.abstractmethod
+    def get_state(self):
+        """Returns copies of parameters as numpy arrays
+
+        Returns:
+            (float array, float array, float array, int array):
+                global scores, s parameters, local scores and ages
+        """
+
+    @abc.abstractmethod
+    def set_state(self, global_model, s, models, ages):
+        """Sets parameters from numpy arrays, as returned by get_state()"""
+
+    @abc.abstractmethod
+    def _set_lr(self):
+        """Sets learning rates of optimizers"""
+
+    @abc.abstractmethod
+    def _regul_s(self):
+        """regulate s parameters"""
+
+    @abc.abstractmethod
+    def _old(self, years):
+        """Increments age of nodes (during training)"""
+
+    @abc.abstractmethod
+    def _fit_step(self):
+        """Makes one step on local parameters
+
+        Returns:
+            (float, float, float): fitting, s and generalisation losses
+        """
+
+    @abc.abstractmethod
+    def _solve_local(self, tol, max_iters):
+        """Solves the problem of each node trained, global scores fixed
+
+        tol (float): largest step of a parameter to stop
+        max_iters (int): maximum number of iterations
+
+        Returns:
+            (float, float, float): fitting, s and generalisation losses
+        """
+
+    @abc.abstractmethod
+    def _gen_step(self):
+        """Makes one step on global parameters
+
+        Returns:
+            (float, float): generalisation and regularisation losses
+        """
+
+    @abc.abstractmethod
+    def _solve_global(self):
+        """Sets global scores trained to their exact minimum, local scores
+        fixed, and computes their gradient there
+
+        Returns:
+            (float, float): generalisation and regularisation losses
+        """
+
+    @abc.abstractmethod
+    def _hist_metrics(self):
+        """Returns metrics of the global model (collected epochs only)
+
+        Returns:
+            (dictionnary): l2 norm, scalar product with the gradient of
+                the previous collected epoch and norm of the gradient
+        """
+
+    @abc.abstractmethod
+    def _get_conv_values(self):
+        """Returns parameters and gradients of the last steps, numpy arrays
+
+        Returns:
+            (float array, float array, float array, float array):
+                local scores, global scores and their gradients,
+                weights of nodes
+        """
+
+    @abc.abstractmethod
+    def _get_fit_derivs(self, comps):
+        """Returns derivatives of the fitting loss for each local score
+
+        comps (int array): comparisons used
+
+        Returns:
+            (float array, float array): first and second derivatives
+        """
+
+    @abc.abstractmethod
+    def _get_uncertainty(self):
+        """Returns uncertainty of global scores and of local scores"""
+
+    @abc.abstractmethod
+    def _get_flat_params(self):
+        """Returns local scores, s parameters and global scores concatenated"""
+
+    @abc.abstractmethod
+    def _set_flat_params(self, params):
+        """Sets local scores, s parameters and global scores from one array"""
+
+    @abc.abstractmethod
+    def _full_loss_grad(self, smoothing):
+        """Computes all terms of loss and gradient of all parameters
+
+        Returns:
+            (float, float, float, float): fitting, s, generalisation
+                                            and regularisation losses
+            (float array): gradient of parameters, same order as
+                                _get_flat_params()
+        """
+
+    def _update_hist(self, epoch, fit, s, gen, reg):
+        """Updates history (at end of epoch), if metrics are collected
+
+        epoch (int): epoch (or L-BFGS iteration)
+        fit, s, gen, reg (float or scalar tensor): terms of the loss
+        """
+        if not self.history.wants(epoch):
+            return  # no metrics work
+        self.history.record(
+            epoch, fit=fit, s=s, gen=gen, reg=reg, **self._hist_metrics()
+        )
+
+    def _trace(self, path):
+        """Returns a context manager tracing the code run in it
+
+        path (str): path of the trace, without extension
+        """
+        return cprofile_trace(path)
+
+    def _profile(self, epoch):
+        """Returns a context manager tracing -epoch if it is profile_epoch
+
+        epoch (int): epoch (or L-BFGS iteration) about to be run
+        """
+        if epoch != self.profile_epoch or self.profiled:
+            return nullcontext()
+        self.profiled = True  # traced once (first evaluation for L-BFGS)
+        return self._trace(profile_path(self.criteria, epoch))
+
+    # ====================  TRAINING ==================
+
+    @gin.configurable
+    def _local_step(
+        self,
+        # configured with gin in "hyperparameters.gin"
+        tol,
+        max_iters,
+    ):
+        """Local step of an epoch: one gradient step on local parameters
+        ("sgd" solver), or the problem of each node solved with global
+        scores fixed ("block" solver, nodes are independent then)
+
+        tol (float): largest step of a parameter to stop ("block")
+        max_iters (int): maximum number of iterations ("block")
+
+        Returns:
+            (float, float, float): fitting, s and generalisation losses
+        """
+        if self.solver == "block":
+            return self._solve_local(tol, max_iters)
+        return self._fit_step()
+
+    def _exact_global(self):
+        """Returns True if global steps are exact minimums ("exact"
+        glob_update, with the "sgd" solver)"""
+        return self.glob_update == "exact" and self.solver == "sgd"
+
+    def _global_step(self):
+        """Global step of an epoch: a gradient step on global scores, or
+        their exact minimum with local scores fixed ("exact" glob_update)
+
+        Returns:
+            (float, float): generalisation and regularisation losses
+        """
+        if self._exact_global():
+            return self._solve_global()
+        return self._gen_step()
+
+    def _train_sgd(self, nb_epochs):
+        """Gradient descent training loop, alternating local and global steps
+        (local problems solved at each epoch with the "block" solver, one
+        exact global step with the "exact" glob_update)
+
+        nb_epochs (int): (maximum) number of training epochs
+        """
+        # initialisation to avoid undefined variables at epoch 1
+        fit_loss, s_loss, gen_loss, reg_loss = 0, 0, 0, 0
+
+        # training loop
+        exact_glob = self._exact_global()  # a second exact step does nothing
+        nb_steps = (1 if exact_glob else self.gen_freq) + 1  # one fitting step
+        for epoch in range(1, nb_epochs + 1):
+            early_stop = self._lr_schedule(epoch)
+            if early_stop:
+                break  # don't do this epoch nor any other
+            self._set_lr()
+            self._regul_s()
+
+            with self._profile(epoch):  # nothing if epoch isn't profiled
+                self._show("epoch {}/{}".format(epoch, nb_epochs), 1)
+                time_ep = time()
+
+                for step in range(1, nb_steps + 1):
+                    fit_step = step == 1  # fitting on first step only
+
+                    self._show(
+                        f"step : {step}/{nb_steps} "
+                        f'{"(fit)" if fit_step else "(gen)"}',
+                        2,
+                    )
+                    # ----------------    Licchavi loss  ---------------------
+                    # only first 3 terms of loss updated
+                    if fit_step:
+                        fit_loss, s_loss, gen_loss = self._local_step()
+                    # only last 2 terms of loss updated
+                    else:
+                        gen_loss, reg_loss = self._global_step()
+                    self.nb_evals += 1
+
+                    if self.verb >= 2:
+                        total_loss = round_loss(
+                            fit_loss + s_loss + gen_loss + reg_loss
+                        )
+                        self._print_losses(
+                            total_loss, fit_loss, s_loss, gen_loss, reg_loss
+                        )
+
+                self._update_hist(epoch, fit_loss, s_loss, gen_loss, reg_loss)
+                # exact global gradients are at current global scores
+                self.last_lr_gen = 0 if exact_glob else self.lr_gen
+                self._old(1)  # aging all nodes of 1 epoch
+                self.nb_iters += 1
+                self._show(f"epoch time :{round(time() - time_ep, 2)}", 1.5)
+
+    @gin.configurable
+    def _train_lbfgs(
+        self,
+        nb_epochs,
+        # configured with gin in "hyperparameters.gin"
+        history_size,
+        smoothing,
+        check_freq,
+        precision,
+        epsilon,
+    ):
+        """Full batch L-BFGS training on all parameters at once
+
+        The L1 generalisation term is smoothed to be differentiable,
+        one epoch is one L-BFGS iteration
+
+        nb_epochs (int): (maximum) number of L-BFGS iterations
+        history_size (int): number of corrections stored by L-BFGS
+        smoothing (float): |x| is replaced by sqrt(x² + smoothing²) - smoothing
+        check_freq (int): number of iterations between equilibrium checks
+        precision (float): proportion of scores at equilibrium to stop
+        epsilon (float): strength of equilibrium asked
+        """
+        from scipy.optimize import minimize  # only required for L-BFGS
+
+        nb_loc = len(self.models)
+        bounds = (
+            [(None, None)] * nb_loc
+            + [(S_MIN, None)] * self.nb_nodes  # s parameters stay positive
+            + [(None, None)] * self.nb_vids
+        )
+        last_losses = [(0, 0, 0, 0)]
+
+        def fun(params):
+            self._set_flat_params(params)
+            with self._profile(self.nb_iters + 1):
+                losses, grad = self._full_loss_grad(smoothing)
+            if self.masks is not None:
+                grad = grad * np.concatenate(self.masks)
+            self.nb_evals += 1
+            last_losses[0] = losses
+            return float(sum(losses)), grad.astype(np.float64)
+
+        def callback(params):
+            self._set_flat_params(params)
+            self.nb_iters += 1
+            self._update_hist(self.nb_iters, *last_losses[0])
+            self._old(1)  # aging all nodes of 1 iteration
+            self._show(f"iteration {self.nb_iters}/{nb_epochs}", 1)
+            if self.nb_iters % check_freq == 0:
+                if self._at_equilibrium(precision, epsilon):
+                    raise _EquilibriumReached
+
+        try:
+            result = minimize(
+                fun,
+                self._get_flat_params().astype(np.float64),
+                jac=True,
+                method="L-BFGS-B",
+                bounds=bounds,
+                callback=callback,
+                options={"maxiter": nb_epochs, "maxcor": history_size},
+            )
+            self._set_flat_params(result.x)
+            loginf(f"L-BFGS stopped: {result.message}")
+        except _EquilibriumReached:
+            loginf("Early Stopping")
+
+    def _train(self, nb_epochs):
+        """Trains parameters with the solver chosen
+
+        nb_epochs (int): (maximum) number of training epochs
+        """
+        self.history.reserve(nb_epochs)
+        if self.solver == "lbfgs":
+            if nb_epochs > 0:
+                self._train_lbfgs(nb_epochs)
+        else:
+            self._train_sgd(nb_epochs)
+
+    def _train_incremental(self, nb_epochs):
+        """Trains only nodes whose comparisons changed since the checkpoint
+
+        Touched nodes and global scores of videos they rate (or removed
+        nodes rated) are trained, other parameters keep saved values.
+        All global scores are then set to their exact minimum with local
+        scores fixed. Nothing is trained if no comparison changed.
+
+        nb_epochs (int): (maximum) number of training epochs
+        """
+        rated_uidxs, rated_vidxs = self._rated_idxs()
+        loc = self.touched[rated_uidxs]
+        vids = self.touched_vids.copy()
+        vids[rated_vidxs[loc]] = True
+        loginf(
+            f"Incremental training: {self.touched.sum()}/{self.nb_nodes} "
+            f"nodes, {vids.sum()}/{self.nb_vids} videos"
+        )
+        if not vids.any():
+            return  # saved scores are already trained
+        self._set_masks(self.touched, vids, loc)
+        self._train(nb_epochs)
+        self._set_masks()
+        # not a new learning rate schedule, saved global scores would move
+        self._solve_global()
+
+    def train(self, nb_epochs=1, compute_uncertainty=False, incremental=False):
+        """training loop
+
+        nb_epochs (int): (maximum) number of training epochs
+        compute_uncertainty (bool): wether to compute uncertainty
+            at the end or not
+        incremental (bool): wether to train only nodes whose comparisons
+            changed since the checkpoint loaded (all nodes if no
+            checkpoint was loaded)
+
+        Returns:
+            (float list list, float list): uncertainty of local scores
+                                            (None, None) if not computed
+        """
+        loginf("STARTING TRAINING")
+        time_train = time()
+        self.nb_iters, self.nb_evals = 0, 0
+        self.conv_idxs = None
+        self.last_lr_gen = 0  # L-BFGS gradients are at current parameters
+        self.last_grad = None
+        self.profiled = False
+
+        if incremental and self.touched is not None:
+            self._train_incremental(nb_epochs)
+        else:
+            self._train(nb_epochs)
+
+        # ----------------- end of training -------------------------------
+        loginf("END OF TRAINING")
+        self.times = {"train": time() - time_train}
+        loginf(f"training time :{round(self.times['train'], 2)}")
+        loginf(
+            f"{self.solver}: {self.nb_iters} iterations, "
+            f"{self.nb_evals} loss evaluations"
+        )
+        if compute_uncertainty:
+            time_uncert = time()
+            uncert_glob, uncert_loc = self._get_uncertainty()
+            self.times["uncertainty"] = time() - time_uncert
+            loginf(f"Uncertainty time: {self.times['uncertainty']}")
+            return uncert_glob, uncert_loc  # self.train() returns uncertainty
+        return None, None  # if uncertainty not computed
+
+    # ------------ to check for problems --------------------------
+    def check(self):
+        """Performs some tests on internal parameters adequation"""
+        # population check
+        b1 = self.nb_nodes == len(self.nodes) == len(self.s)
+        # history check
+        reference = self.history.epochs
+        b2 = all([len(v) == len(reference) for v in self.history.values()])
+
+        if b1 and b2:
+            loginf("No Problem")
+        else:
+            logging.warning("Coherency problem in Licchavi object ")
@@ -0,0 +1,818 @@
+import numpy as np
+import logging
+import sys
+from logging import info as loginf
+
+from .licchavi_base import LicchaviBase
+from .data_utility import (
+    save_checkpoint, _global_uncerts
+)
+from .nodes import Node
+
+"""
+Torch-free Licchavi backend, used in "core.py"
+
+Main file is "ml_train.py"
+
+Structure:
+- same objective and training loop as Licchavi ("licchavi.py")
+- gradients of the loss are computed analytically with numpy
+- checkpoints are compatible with Licchavi ones
+
+USAGE:
+- select it with "ml_run.backend = 'numpy'" in "hyperparameters.gin"
+"""
+
+# local solver ("block" solver, see _solve_nodes())
+HESS_MIN = 1e-2  # damping of the Hessian of local scores
+LINE_SEARCH_STEPS = 10  # maximum number of halvings of the step of a node
+
+
+def _bbt_regions(t):
+    """Returns masks of the 3 regions of the approximated BBT loss
+
+    t (float array): batch of (s * (ya - yb))
+
+    Returns:
+        (bool array, bool array, bool array): small, medium and big |t|
+    """
+    abs_t = np.abs(t)
+    small = abs_t <= 0.01
+    big = abs_t >= 10
+    return small, ~(small | big), big
+
+
+def _approx_bbt_loss(t, r):
+    """Approximated Binomial Bradley-Terry loss function
+
+    Same as losses._approx_bbt_loss()
+
+    t (float array): batch of (s * (ya - yb))
+    r (float array): batch of ratings given by users
+
+    Returns:
+        (float): sum of empirical losses for all comparisons
+    """
+    return _approx_bbt_losses(t, r).sum()
+
+
+def _approx_bbt_losses(t, r):
+    """Approximated Binomial Bradley-Terry loss of each comparison
+
+    t (float array): batch of (s * (ya - yb))
+    r (float array): batch of ratings given by users
+
+    Returns:
+        (float array): empirical loss of each comparison
+    """
+    small, medium, big = _bbt_regions(t)
+    tm = np.where(medium, t, 1)  # trick to avoid zeros so NaNs
+    tb = np.abs(np.where(big, t, 10))
+    loss = np.where(small, t ** 2 / 6 + np.log(2), 0)
+    loss += np.where(medium, np.log(2 * np.sinh(tm) / tm), 0)
+    loss += np.where(big, tb - np.log(tb), 0)
+    return loss + r * t
+
+
+def _approx_bbt_deriv(t, r):
+    """Derivative of the approximated BBT loss with respect to t
+
+    t (float array): batch of (s * (ya - yb))
+    r (float array): batch of ratings given by users
+
+    Returns:
+        (float array): derivative for each comparison
+    """
+    small, medium, big = _bbt_regions(t)
+    tm = np.where(medium, t, 1)
+    tb = np.where(big, t, 10)
+    deriv = np.where(small, t / 3, 0)
+    deriv += np.where(medium, 1 / np.tanh(tm) - 1 / tm, 0)
+    deriv += np.where(big, np.sign(tb) - 1 / tb, 0)
+    return deriv + r
+
+
+def _approx_bbt_deriv2(t):
+    """Second derivative of the approximated BBT loss with respect to t
+
+    t (float array): batch of (s * (ya - yb))
+
+    Returns:
+        (float array): second derivative for each comparison (float64)
+    """
+    t = t.astype(np.float64)  # 1/t² - 1/sinh²(t) is unstable in float32
+    small, medium, big = _bbt_regions(t)
+    tm = np.where(medium, t, 1)
+    tb = np.where(big, t, 10)
+    deriv2 = np.where(small, 1 / 3, 0)
+    deriv2 += np.where(medium, 1 / tm ** 2 - 1 / np.sinh(tm) ** 2, 0)
+    deriv2 += np.where(big, 1 / tb ** 2, 0)
+    return deriv2
+
+
+def _smooth_abs(x, smoothing=0):
+    """Differentiable approximation of absolute value and its derivative
+
+    x (float array): input
+    smoothing (float): |x| is replaced by sqrt(x² + smoothing²) - smoothing
+                            (0 for exact absolute value)
+
+    Returns:
+        (float array): (approximated) absolute value of input
+        (float array): derivative
+    """
+    if smoothing == 0:
+        return np.abs(x), np.sign(x)
+    root = np.sqrt(x ** 2 + smoothing ** 2)
+    return root - smoothing, x / root
+
+
+def _local_terms(
+    models, s, glob_rated, w_rated, r, pos1, pos2, comp_uidxs, smoothing=0
+):
+    """Computes local and generalisation terms of loss and gradients of
+    a group of nodes (all nodes, or a shard of nodes in sharding.py)
+
+    models (float array): local scores of the nodes, concatenated
+    s (float array): s parameters of the nodes
+    glob_rated (float array): global score of the video of each local score
+    w_rated (float array): weight of the node of each local score
+    r (float array): rating of each comparison
+    pos1, pos2 (int array): positions of compared local scores in -models
+    comp_uidxs (int array): position of the node of each comparison in -s
+    smoothing (float): smoothing of l1 generalisation term
+
+    Returns:
+        (float, float, float): fitting, s and generalisation losses
+        (float array): gradient of local scores
+        (float array): gradient of s parameters
+    """
+    s_comps = s[comp_uidxs]
+    diffs = models[pos1] - models[pos2]
+    t = s_comps * diffs
+    derivs = _approx_bbt_deriv(t, r)
+    dists, signs = _smooth_abs(models - glob_rated, smoothing)
+
+    fit_loss = _approx_bbt_loss(t, r)
+    s_loss = (0.5 * s ** 2 - np.log(s)).sum()
+    gen_loss = (w_rated * dists).sum()
+
+    nb_loc = len(models)
+    grad_models = (
+        np.bincount(pos1, s_comps * derivs, nb_loc)
+        - np.bincount(pos2, s_comps * derivs, nb_loc)
+        + w_rated * signs
+    )
+    grad_s = np.bincount(comp_uidxs, derivs * diffs, len(s))
+    grad_s += s - 1 / s
+    return (fit_loss, s_loss, gen_loss), grad_models, grad_s
+
+
+def _gen_terms(
+    models, glob_rated, w_rated, rated_vidxs, nb_vids, smoothing=0,
+    kink_signs=None,
+):
+    """Computes generalisation term of loss of a group of nodes and the sum
+    of derivatives of its node terms for each video
+
+    models, glob_rated, w_rated, smoothing: see _local_terms()
+    rated_vidxs (int array): video index of each local score
+    nb_vids (int): number of videos
+    kink_signs (float array): derivative used for local scores equal to
+        their global score (0 if None), see _solve_nodes()
+
+    Returns:
+        (float): generalisation loss
+        (float array): for each video, sum of derivatives of node terms
+            wrt local scores (gradient of global scores is minus this)
+    """
+    dists, signs = _smooth_abs(models - glob_rated, smoothing)
+    if kink_signs is not None:
+        signs = np.where(models == glob_rated, kink_signs, signs)
+    gen_loss = (w_rated * dists).sum()
+    return gen_loss, np.bincount(rated_vidxs, w_rated * signs, nb_vids)
+
+
+def _node_losses(models, s, glob_rated, w_rated, r, pos1, pos2, idxs):
+    """Computes the terms of the loss of each node of a group of nodes
+
+    models, s, glob_rated, w_rated, r, pos1, pos2: see _local_terms()
+    idxs (int array, int array): position of the node of each comparison
+                                    and of each local score in -s
+
+    Returns:
+        (float array, float array, float array): fitting, s and
+                                generalisation losses of each node
+    """
+    comp_uidxs, rated_uidxs = idxs
+    t = s[comp_uidxs] * (models[pos1] - models[pos2])
+    fit = np.bincount(comp_uidxs, _approx_bbt_losses(t, r), len(s))
+    gen = np.bincount(
+        rated_uidxs, w_rated * np.abs(models - glob_rated), len(s)
+    )
+    return fit, 0.5 * s ** 2 - np.log(s), gen
+
+
+def _solve_nodes(
+    models, s, glob_rated, w_rated, r, pos1, pos2, idxs, tol, max_iters
+):
+    """Minimizes the loss of each node of a group of nodes, global scores
+    fixed, by updating -models and -s in place
+
+    Each iteration does, for all nodes at once:
+    - a proximal step on local scores, with the diagonal of the Hessian of
+        the fitting term and the exact proximal operator of the L1
+        generalisation term (scores can stay at their global score)
+    - a Newton step on s parameters
+    - a backtracking line search on the loss of each node: the step of a
+        node is halved until its loss decreases (no step if it doesn't)
+    Iterations stop when all steps are smaller than -tol
+
+    A local score equal to its global score has a subgradient of its
+    generalisation term balancing its fitting gradient: it is the
+    derivative of the solved loss with respect to the global score
+    (envelope theorem), used by global steps instead of 0
+
+
+    models, s, glob_rated, w_rated, r, pos1, pos2, idxs: see _node_losses()
+    tol (float): largest step of a parameter to stop
+    max_iters (int): maximum number of iterations
+
+    Returns:
+        (float, float, float): fitting, s and generalisation losses
+        (float array): subgradient of the L1 distance of each local score
+        (int): number of iterations done
+    """
+    comp_uidxs, rated_uidxs = idxs
+    args = (glob_rated, w_rated, r, pos1, pos2, idxs)
+    x, y = models.astype(np.float64), s.astype(np.float64)
+    nb_loc, nb_nodes = len(x), len(y)
+    losses = _node_losses(x, y, *args)
+    loss = sum(losses)
+    nb_iters = 0
+    while nb_iters < max_iters:
+        nb_iters += 1
+        s_comps = y[comp_uidxs]
+        diffs = x[pos1] - x[pos2]
+        t = s_comps * diffs
+        derivs, derivs2 = _approx_bbt_deriv(t, r), _approx_bbt_deriv2(t)
+        # local scores, proximal step
+        grad = s_comps * derivs
+        grad = np.bincount(pos1, grad, nb_loc) - np.bincount(
+            pos2, grad, nb_loc
+        )
+        curv = s_comps ** 2 * derivs2
+        hess = np.bincount(pos1, curv, nb_loc) + np.bincount(
+            pos2, curv, nb_loc
+        )
+        hess += HESS_MIN
+        dist = x - grad / hess - glob_rated
+        shrunk = np.sign(dist) * np.maximum(np.abs(dist) - w_rated / hess, 0)
+        step_x = glob_rated + shrunk - x
+        # s parameters, Newton step keeping them positive
+        grad_s = np.bincount(comp_uidxs, derivs * diffs, nb_nodes) + y - 1 / y
+        hess_s = np.bincount(comp_uidxs, derivs2 * diffs ** 2, nb_nodes)
+        hess_s += 1 + 1 / y ** 2
+        step_s = np.maximum(-grad_s / hess_s, -y / 2)
+        # line search, one step length per node
+        alpha = np.ones(nb_nodes)
+        for _ in range(LINE_SEARCH_STEPS):
+            new_losses = _node_losses(
+                x + alpha[rated_uidxs] * step_x, y + alpha * step_s, *args
+            )
+            worse = sum(new_losses) > loss
+            if not worse.any():
+                break
+            alpha[worse] /= 2
+        alpha[worse] = 0  # nodes whose loss doesn't decrease don't move
+        step_x *= alpha[rated_uidxs]
+        step_s *= alpha
+        x += step_x
+        y += step_s
+        losses = tuple(
+            np.where(worse, old, new) for old, new in zip(losses, new_losses)
+        )
+        loss = sum(losses)
+        largest = max(
+            np.abs(step_x).max(initial=0), np.abs(step_s).max(initial=0)
+        )
+        if largest < tol:
+            break
+    models[:] = x
+    s[:] = y
+    s_comps = y[comp_uidxs]
+    grad = s_comps * _approx_bbt_deriv(s_comps * (x[pos1] - x[pos2]), r)
+    grad = np.bincount(pos1, grad, nb_loc) - np.bincount(pos2, grad, nb_loc)
+    kink_signs = np.divide(
+        -grad, w_rated, out=np.zeros(nb_loc), where=w_rated > 0
+    )
+    losses = tuple(float(term.sum()) for term in losses)
+    return losses, np.clip(kink_signs, -1, 1), nb_iters
+
+
+def _solve_local(
+    models, s, glob, weights, data, tol, max_iters, nodes=None
+):
+    """Minimizes the loss of each node, global scores fixed, in place
+    ("block" solver, used by both backends)
+
+    models (float array): local scores of all nodes, concatenated
+    s (float array): s parameters of all nodes
+    glob (float array): global scores
+    weights (float array): weight of each node
+    data (6 int/float arrays): r, pos1, pos2, comp_uidxs, rated_uidxs,
+                                rated_vidxs of all nodes
+    tol, max_iters: see _solve_nodes()
+    nodes (bool array): nodes trained (all if None)
+
+    Returns:
+        (float, float, float): fitting, s and generalisation losses
+                                        (of trained nodes only)
+        (float array): subgradient of the L1 distance of each local
+                            score, see _solve_nodes() (0 if not trained)
+        (int): number of iterations done
+    """
+    r, pos1, pos2, comp_uidxs, rated_uidxs, rated_vidxs = data
+    if nodes is None:
+        return _solve_nodes(
+            models, s, glob[rated_vidxs], weights[rated_uidxs],
+            r, pos1, pos2, (comp_uidxs, rated_uidxs), tol, max_iters,
+        )
+    # problems of trained nodes only, with positions among them
+    comps, loc = nodes[comp_uidxs], nodes[rated_uidxs]
+    new_pos, new_uidxs = np.cumsum(loc) - 1, np.cumsum(nodes) - 1
+    models_sub, s_sub = models[loc], s[nodes]
+    losses, signs_sub, nb_iters = _solve_nodes(
+        models_sub, s_sub,
+        glob[rated_vidxs[loc]], weights[rated_uidxs[loc]], r[comps],
+        new_pos[pos1[comps]], new_pos[pos2[comps]],
+        (new_uidxs[comp_uidxs[comps]], new_uidxs[rated_uidxs[loc]]),
+        tol, max_iters,
+    )
+    models[loc], s[nodes] = models_sub, s_sub
+    kink_signs = np.zeros(len(models))
+    kink_signs[loc] = signs_sub
+    return losses, kink_signs, nb_iters
+
+
+def _solve_global(models, w_rated, rated_vidxs, nb_vids, w0):
+    """Minimizes generalisation and regularisation terms of the loss,
+    local scores fixed, for all videos at once
+
+    For a video, w0 * g² + sum of w * |x - g| over its local scores x is
+    convex, its derivative 2 * w0 * g + (weight of scores below g) -
+    (weight of scores above g) is increasing. With scores of the video
+    sorted, the minimum is between the last score where the right
+    derivative is negative and the next score, where the derivative is
+    linear in g (or at one of these scores)
+
+    models (float array): local scores of all nodes, concatenated
+    w_rated (float array): weight of the node of each local score
+    rated_vidxs (int array): video index of each local score
+    nb_vids (int): number of videos
+    w0 (float): regularisation strength
+
+    Returns:
+        (float array): global scores (0 for videos without local scores)
+    """
+    order = np.argsort(models)  # sorted by video, then by score
+    order = order[np.argsort(rated_vidxs[order], kind="stable")]
+    scores = models[order].astype(np.float64)
+    w_sorted, vidxs = w_rated[order], rated_vidxs[order]
+    counts = np.bincount(rated_vidxs, minlength=nb_vids)
+    starts = np.cumsum(counts) - counts
+    total = np.bincount(rated_vidxs, w_rated, nb_vids)
+    cum_w = np.concatenate(([0], np.cumsum(w_sorted)))
+    below = cum_w[1:] - cum_w[starts][vidxs]  # weight up to each score
+    right_deriv = 2 * w0 * scores + 2 * below - total[vidxs]
+    nb_below = np.bincount(vidxs, right_deriv < 0, nb_vids).astype(np.int64)
+    w_below = cum_w[starts + nb_below] - cum_w[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):  # weighted median
+        glob = np.nan_to_num((total - 2 * w_below) / (2 * w0))  # if w0 is 0
+    padded = np.concatenate(([-np.inf], scores, [np.inf]))
+    lower = np.where(nb_below > 0, padded[starts + nb_below], -np.inf)
+    upper = np.where(nb_below < counts, padded[starts + nb_below + 1], np.inf)
+    return np.clip(glob, lower, upper)
+
+
+class LicchaviNumpy(LicchaviBase):
+    """Training structure including local models and general one
+
+    Gradients are computed analytically, parameters are float32 arrays
+    """
+
+    def __init__(self, nb_vids, vid_vidx, crit, device="cpu", verb=1):
+        """
+        nb_vids (int): number of different videos rated by
+                        at least one contributor for this criteria
+        vid_vidx (dictionnary): dictionnary of {video ID: video index}
+        crit (str): comparison criteria learnt
+        device (str): unused, computations are done on cpu
+        verb (float): verbosity level
+        """
+        # hyperparameters are set in LicchaviBase
+        super().__init__(nb_vids, vid_vidx, crit, device="cpu", verb=verb)
+
+        self.global_model = np.zeros(nb_vids, dtype=np.float32)
+        self.glob_grad = None  # last gradient of global model
+
+        # parameters of all nodes, one coordinate for each node
+        self.s = np.ones(0, dtype=np.float32)  # s parameters
+        # local scores of all nodes for the videos they rated, concatenated
+        self.models = np.zeros(0, dtype=np.float32)
+        self.ages = np.zeros(0, dtype=np.int64)  # nb of epochs trained
+        self.weights = np.zeros(0, dtype=np.float32)  # nodes weights
+        self.lr_s_nodes = np.zeros(0, dtype=np.float32)  # lr of s parameters
+        self.shard_pool = None  # workers doing local steps (see sharding.py)
+
+    # ------------ input and output --------------------
+    def _set_params(self, s, models, ages):
+        """Sets parameters of all nodes
+
+        s (float array): s parameter of each node
+        models (float array): local scores of all nodes, concatenated
+        ages (int array): number of epochs each node has been trained
+        """
+        self.s, self.models, self.ages = s, models, ages
+        self.weights = np.full(len(s), self.w, dtype=np.float32)
+        self.lr_s_nodes = (self.lr_s / np.diff(self.offsets)).astype(np.float32)
+
+    def _get_default(self, nbn):
+        """Returns default parameters for -nbn nodes
+
+        Returns:
+            (float array, float array, int array): s, models, ages
+        """
+        return (
+            np.ones(nbn, dtype=np.float32),
+            np.zeros(len(self.rated_vidxs), dtype=np.float32),
+            np.zeros(nbn, dtype=np.int64),
+        )
+
+    def _get_saved(self, loc_models_old, users_ids):
+        """Returns saved parameters updated or default
+
+        loc_models_old (array, array, int array, int array, array, array
+            (, uint64 array)): saved (users IDs, s, rated offsets,
+            rated vidxs, models, ages (, fingerprints of comparisons))
+        users_ids (int array): users IDs
+
+        Returns:
+            (float array, float array, int array): s, models, ages
+                updated for known users and videos, default for others
+        """
+        _, s_old, _, _, models_old, ages_old = loc_models_old[:6]
+        (new_idxs, old_idxs), (new_pairs, old_pairs) = self._match_saved(
+            loc_models_old, users_ids, self.rated_uidxs, self.rated_vidxs
+        )
+        s, models, ages = self._get_default(len(users_ids))
+        s[new_idxs] = s_old[old_idxs]
+        models[new_pairs] = models_old[old_pairs]
+        ages[new_idxs] = ages_old[old_idxs]
+        return s, models, ages
+
+    def set_allnodes(self, nodes_data, users_ids):
+        """Puts data in Licchavi and create a model for each node
+
+        nodes_data (int array, int array, float array, int array):
+            (vID1 indexes, vID2 indexes, ratings, offsets), comparisons
+            of user i are in [offsets[i], offsets[i + 1][
+        users_ids (int array): users IDs
+        """
+        nb = len(users_ids)
+        self.nb_nodes = nb
+        self.users = users_ids
+        self._set_data(nodes_data)
+        self._set_params(*self._get_default(nb))
+        self.nodes = {id: Node(self, uidx) for uidx, id in enumerate(users_ids)}
+        self._show("Total number of nodes : {}".format(self.nb_nodes), 1)
+
+    def load_and_update(self, nodes_data, user_ids, saved_data):
+        """Loads models and expands them as required
+
+        nodes_data (int array, int array, float array, int array):
+            (vID1 indexes, vID2 indexes, ratings, offsets), comparisons
+            of user i are in [offsets[i], offsets[i + 1][
+        user_ids (int array): users IDs
+        saved_data (tuple): checkpoint, output of load_checkpoint()
+        """
+        loginf("Loading models")
+        self.criteria, dic_old, gen_model_old, loc_models_old = saved_data
+        nb_new = self.nb_vids - len(dic_old)  # number of new videos
+        # initialize scores for new videos
+        self.global_model = np.concatenate(
+            [gen_model_old, np.zeros(nb_new)]
+        ).astype(np.float32)
+        self.users = user_ids
+        self.nb_nodes = len(user_ids)
+        self._set_data(nodes_data)
+        self._set_params(*self._get_saved(loc_models_old, user_ids))
+        self._set_touched(loc_models_old, user_ids)
+        self.nodes = {id: Node(self, uidx) for uidx, id in enumerate(user_ids)}
+        self._show(f"Total number of nodes : {self.nb_nodes}", 1)
+        loginf("Models updated")
+
+    def output_scores(self):
+        """Returns video scores both global and local
+
+        Returns :
+        - (list of all vIDS , array of global video scores)
+        - (list of arrays of local vIDs, list of arrays of local video scores)
+        """
+        splits = self.rated_offsets[1:-1]
+        loc_scores = np.split(self.models, splits)
+        list_vids_batchs = np.split(self.rated_vids, splits)
+        vids_batch = list(self.vid_vidx.keys())
+        return (vids_batch, self.global_model), (list_vids_batchs, loc_scores)
+
+    def save_models(self, fullpath):
+        """Saves age and global and local weights, as numpy arrays
+
+        Checkpoints don't depend on the backend used
+        """
+        loginf("Saving models")
+        local_data = (
+            np.asarray(self.users),  # users IDs
+            self.s,
+            self.rated_offsets,
+            self.rated_vidxs,
+            self.models,
+            self.ages,
+            self.comp_hashes,  # to find nodes changed (incremental training)
+        )
+        saved_data = (self.criteria, self.vid_vidx, self.global_model, local_data)
+        save_checkpoint(saved_data, fullpath)
+        loginf("Models saved")
+
+    def get_state(self):
+        """Returns copies of parameters as numpy arrays
+
+        Returns:
+            (float array, float array, float array, int array):
+                global scores, s parameters, local scores and ages
+        """
+        return (
+            self.global_model.copy(), self.s.copy(),
+            self.models.copy(), self.ages.copy(),
+        )
+
+    def set_state(self, global_model, s, models, ages):
+        """Sets parameters from numpy arrays, as returned by get_state()"""
+        self.global_model = np.array(global_model, dtype=np.float32)
+        self.s = np.array(s, dtype=np.float32)
+        self.models = np.array(models, dtype=np.float32)
+        self.ages = np.array(ages, dtype=np.int64)
+
+    # ---------- loss and gradients ------------
+    def _local_loss_grad(self, models=None, smoothing=0):
+        """Computes local and generalisation terms of loss and gradients
+
+        models (float array): local scores to use (current ones if None)
+        smoothing (float): smoothing of l1 generalisation term
+
+        Returns:
+            (float, float, float): fitting, s and generalisation losses
+            (float array): gradient of local scores
+            (float array): gradient of s parameters
+        """
+        models = self.models if models is None else models
+        return _local_terms(
+            models, self.s,
+            self.global_model[self.rated_vidxs],
+            self.weights[self.rated_uidxs],
+            self.r, self.pos1, self.pos2, self.comp_uidxs,
+            smoothing,
+        )
+
+    def _global_loss_grad(self, global_model=None, smoothing=0):
+        """Computes generalisation and regularisation terms of loss and gradient
+
+        global_model (float array): global scores to use (current if None)
+        smoothing (float): smoothing of l1 generalisation term
+
+        Returns:
+            (float, float): generalisation and regularisation losses
+            (float array): gradient of global scores
+        """
+        glob = self.global_model if global_model is None else global_model
+        if self.shard_pool is not None and global_model is None:
+            gen_loss, sums = self.shard_pool.gen_sums()  # summed by shards
+        else:
+            gen_loss, sums = _gen_terms(
+                self.models,
+                glob[self.rated_vidxs],
+                self.weights[self.rated_uidxs],
+                self.rated_vidxs, self.nb_vids,
+                smoothing,
+                self.kink_signs if self.solver == "block" else None,
+            )
+        reg_loss = self.w0 * (glob ** 2).sum()
+        grad = -sums + 2 * self.w0 * glob
+        return (gen_loss, reg_loss), grad
+
+    def _full_loss_grad(self, smoothing):
+        """Computes all terms of loss and gradient of all parameters
+
+        smoothing (float): smoothing of l1 generalisation term
+
+        Returns:
+            (float, float, float, float): fitting, s, generalisation
+                                            and regularisation losses
+            (float array): gradient of parameters, same order as
+                                _get_flat_params()
+        """
+        losses, grad_models, grad_s = self._local_loss_grad(smoothing=smoothing)
+        (_, reg_loss), grad_glob = self._global_loss_grad(smoothing=smoothing)
+        self.glob_grad = grad_glob.astype(np.float32)
+        grad = np.concatenate([grad_models, grad_s, grad_glob])
+        return (*losses, reg_loss), grad
+
+    def _get_flat_params(self):
+        """Returns local scores, s parameters and global scores concatenated
+
+        Returns:
+            (float array): all parameters
+        """
+        return np.concatenate([self.models, self.s, self.global_model])
+
+    def _set_flat_params(self, params):
+        """Sets local scores, s parameters and global scores from one array
+
+        params (float array): all parameters, as in _get_flat_params()
+        """
+        nb_loc = len(self.models)
+        params = params.astype(np.float32)
+        self.models = params[:nb_loc]
+        self.s = params[nb_loc : nb_loc + self.nb_nodes]
+        self.global_model = params[nb_loc + self.nb_nodes :]
+
+    # ---------- methods for training ------------
+    def _set_lr(self):
+        """Sets learning rates (read at each step, nothing to do)"""
+
+    def _get_conv_values(self):
+        """Returns parameters and gradients of the last steps
+
+        Returns:
+            (float array, float array, float array, float array):
+                local scores, global scores and their gradients,
+                weights of nodes
+        """
+        return self.models, self.global_model, self.glob_grad, self.weights
+
+    def _get_fit_derivs(self, comps):
+        """Returns derivatives of the fitting loss for each local score
+
+        comps (int array): comparisons used
+
+        Returns:
+            (float array, float array): first and second derivatives
+        """
+        pos1, pos2 = self.pos1[comps], self.pos2[comps]
+        s_comps = self.s[self.comp_uidxs[comps]].astype(np.float64)
+        t = s_comps * (self.models[pos1] - self.models[pos2])
+        deriv = s_comps * _approx_bbt_deriv(t, self.r[comps])
+        deriv2 = s_comps ** 2 * _approx_bbt_deriv2(t)
+        nb_loc = len(self.models)
+        grad = np.bincount(pos1, deriv, nb_loc) - np.bincount(pos2, deriv, nb_loc)
+        hess = np.bincount(pos1, deriv2, nb_loc)
+        return grad, hess + np.bincount(pos2, deriv2, nb_loc)
+
+    def _hist_metrics(self):
+        """Returns metrics of the global model (collected epochs only)
+
+        Returns:
+            (dictionnary): l2 norm, scalar product with the gradient of
+                the previous collected epoch and norm of the gradient
+        """
+        norm = (self.global_model ** 2).sum() ** 0.5
+        grad_gen = self.glob_grad
+        if self.last_grad is not None:  # no previous gradient at first epoch
+            scal_grad = (self.last_grad * grad_gen).sum()
+        else:
+            scal_grad = 0
+        self.last_grad = grad_gen.copy()
+        grad_norm = (grad_gen * grad_gen).sum()
+        return {"l2_norm": norm, "grad_sp": scal_grad, "grad_norm": grad_norm}
+
+    def _old(self, years):
+        """Increments age of nodes (during training)"""
+        self.ages += years
+
+    def _train_sgd(self, nb_epochs):
+        """Gradient descent training loop, local steps are done by
+        LicchaviBase.shards worker processes if more than one
+
+        nb_epochs (int): (maximum) number of training epochs
+        """
+        if (
+            self.shards <= 1 or self.solver == "block"
+            or self.masks is not None or self.nb_nodes < 2
+        ):
+            super()._train_sgd(nb_epochs)
+            return
+        if sys.version_info < (3, 8):  # no shared_memory
+            logging.warning("Python >= 3.8 is required to use several shards")
+            super()._train_sgd(nb_epochs)
+            return
+        from .sharding import ShardPool  # imported when used
+
+        with ShardPool(self, self.shards) as pool:
+            self.shard_pool = pool
+            try:
+                super()._train_sgd(nb_epochs)
+            finally:
+                self.shard_pool = None
+
+    def _fit_step(self):
+        """Makes one gradient descent step on local parameters
+
+        Returns:
+            (float, float, float): fitting, s and generalisation losses
+        """
+        if self.shard_pool is not None:  # steps done by shards
+            return self.shard_pool.fit_step(self.lr_node)
+        losses, grad_models, grad_s = self._local_loss_grad()
+        if self.masks is not None:  # only some nodes trained
+            grad_models *= self.masks[0]
+            grad_s *= self.masks[1]
+        self.models -= self.lr_node * grad_models
+        self.s -= self.lr_s_nodes * grad_s  # per node learning rates
+        return losses
+
+    def _solve_local(self, tol, max_iters):
+        """Solves the problem of each node trained, global scores fixed,
+        see _solve_local()
+
+        Returns:
+            (float, float, float): fitting, s and generalisation losses
+        """
+        nodes = None if self.masks is None else self.masks[1] > 0
+        data = (
+            self.r, self.pos1, self.pos2,
+            self.comp_uidxs, self.rated_uidxs, self.rated_vidxs,
+        )
+        losses, self.kink_signs, nb_iters = _solve_local(
+            self.models, self.s, self.global_model, self.weights,
+            data, tol, max_iters, nodes,
+        )
+        self._show(f"local problems solved in {nb_iters} iterations", 2)
+        return losses
+
+    def _gen_step(self):
+        """Makes one gradient descent step on global parameters
+
+        Returns:
+            (float, float): generalisation and regularisation losses
+        """
+        losses, grad = self._global_loss_grad()
+        self.glob_grad = grad.astype(np.float32)
+        if self.masks is not None:  # only some global scores trained
+            self.glob_grad *= self.masks[2]
+        self.global_model -= self.lr_gen * self.glob_grad
+        return losses
+
+    def _solve_global(self):
+        """Sets global scores trained to their exact minimum, local scores
+        fixed, see _solve_global()
+
+        Returns:
+            (float, float): generalisation and regularisation losses
+        """
+        glob = _solve_global(
+            self.models, self.weights[self.rated_uidxs],
+            self.rated_vidxs, self.nb_vids, self.w0,
+        )
+        if self.masks is not None:  # only some global scores trained
+            glob = np.where(self.masks[2] > 0, glob, self.global_model)
+        self.global_model[:] = glob  # in place, shared when sharded
+        losses, grad = self._global_loss_grad()
+        self.glob_grad = grad.astype(np.float32)
+        if self.masks is not None:
+            self.glob_grad *= self.masks[2]
+        return losses
+
+    def _regul_s(self):
+        """regulate s parameters"""
+        negative = self.s <= 0
+        if negative.any():
+            self.s[negative] = 0.4
+            logging.warning("Regulating negative s")
+
+    def _get_uncertainty(self):
+        """Returns uncertainty of global scores and of local scores
+
+        Local uncertainty is the inverse square root of the second
+        derivative of the loss with respect to each local score
+
+        Returns:
+            (float array): uncertainty of global scores
+            (float array list): uncertainty of local scores
+        """
+        loginf("Computing uncertainty")
+        _, hess = self._get_fit_derivs(np.arange(len(self.comp_uidxs)))
+        uncert_loc = np.split(hess ** (-0.5), self.rated_offsets[1:-1])
+
+        dists = np.abs(self.models - self.global_model[self.rated_vidxs])
+        uncert_glob = _global_uncerts(dists, self.vid_order, self.vid_offsets)
+        return uncert_glob, uncert_loc
@@ -1,3 +1,4 @@
+import math
 import torch
 
 """
@@ -6,23 +7,24 @@ Losses used in "licchavi.py"
 Main file is "ml_train.py"
 """
 
+SMALL_T, BIG_T = 0.01, 10  # bounds of regions of the approximated BBT loss
+LOG_2 = math.log(2)
+
 
 def predict(input, tens, mask=None):
     """Predicts score according to a model
 
     Args:
-        input (bool 2D tensor): one line is a one-hot encoded video index
+        input (long tensor): indexes of the videos
         tens (float tensor): tensor = model
         mask (bool tensor): one element is bool for using this comparison
 
     Returns:
-        (2D float tensor): score of the videos according to the model
+        (float tensor): score of the videos according to the model
     """
-    if input.shape[1] == 0:  # if empty input
-        return torch.zeros((1, 1))
     if mask is not None:
-        return torch.where(mask, torch.matmul(input.float(), tens), torch.zeros(1))
-    return torch.matmul(input.float(), tens)
+        return torch.where(mask, tens[input], torch.zeros(1))
+    return tens[input]
 
 
 # losses (used in licchavi.py)
@@ -43,7 +45,74 @@ def _bbt_loss(t, r):
     return sum(losses)
 
 
-@torch.jit.script  # to optimize computation time
+def _approx_bbt_loss_terms(t):
+    """Approximated BBT loss of each comparison, without the r * t term
+
+    Each branch is computed on |t| clamped to its region so that no NaN
+    nor inf is produced, one of them is selected for each comparison
+
+    Args:
+        t (float tensor): batch of (s * (ya - yb))
+
+    Returns:
+        (float tensor): loss of each comparison, minus r * t
+    """
+    abs_t = t.abs()
+    tm = abs_t.clamp(SMALL_T, BIG_T)
+    tb = abs_t.clamp(min=BIG_T)
+    return torch.where(
+        abs_t <= SMALL_T,
+        abs_t ** 2 / 6 + LOG_2,
+        torch.where(abs_t >= BIG_T, tb - tb.log(), (2 * tm.sinh() / tm).log()),
+    )
+
+
+def _approx_bbt_deriv(t, r):
+    """Derivative of the approximated BBT loss with respect to t
+
+    Args:
+        t (float tensor): batch of (s * (ya - yb))
+        r (float tensor): batch of ratings given by user.
+
+    Returns:
+        (float tensor): derivative for each comparison
+    """
+    abs_t = t.abs()
+    tm = abs_t.clamp(SMALL_T, BIG_T).double()  # coth(t) - 1/t cancels
+    tb = abs_t.clamp(min=BIG_T)                 # in float32 near SMALL_T
+    deriv = torch.where(
+        abs_t <= SMALL_T,
+        abs_t / 3,
+        torch.where(
+            abs_t >= BIG_T, 1 - 1 / tb, (1 / tm.tanh() - 1 / tm).to(t.dtype)
+        ),
+    )
+    return t.sign() * deriv + r  # loss is even so its derivative is odd
+
+
+class _ApproxBBTLoss(torch.autograd.Function):
+    """Sum of approximated BBT losses with a closed form backward pass
+
+    Only inputs are saved for backward (instead of every intermediate
+    result recorded by autograd), the derivative is computed from them
+    """
+
+    @staticmethod
+    def forward(ctx, t, r):
+        ctx.save_for_backward(t, r)
+        return (_approx_bbt_loss_terms(t) + r * t).sum()
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        t, r = ctx.saved_tensors
+        grad_t = grad_r = None
+        if ctx.needs_input_grad[0]:
+            grad_t = grad_out * _approx_bbt_deriv(t, r)
+        if ctx.needs_input_grad[1]:
+            grad_r = grad_out * t
+        return grad_t, grad_r
+
+
 def _approx_bbt_loss(t, r):
     """Approximated Binomial Bradley-Terry loss function (used in Licchavi)
 
@@ -54,21 +123,29 @@ def _approx_bbt_loss(t, r):
     Returns:
         (float tensor): sum of empirical losses for all comparisons of one user
     """
+    return _ApproxBBTLoss.apply(t, r)
 
-    small = abs(t) <= 0.01
-    medium = torch.logical_and((abs(t) < 10), (abs(t) > 0.01))
-    big = abs(t) >= 10
-    zer = torch.zeros(1)
-    loss = 0
 
-    loss += torch.where(
-        small, t ** 2 / 6 + r * t + torch.log(torch.tensor(2)), zer
-    ).sum()
-    tt = torch.where(t != 0, t, torch.ones(1))  # trick to avoid zeros so NaNs
-    loss += torch.where(medium, torch.log(2 * torch.sinh(tt) / tt) + r * tt, zer).sum()
-    loss += torch.where(big, abs(tt) - torch.log(abs(tt)) + r * tt, zer).sum()
+def _approx_bbt_deriv2(t):
+    """Second derivative of the approximated BBT loss with respect to t
 
-    return loss
+    Args:
+        t (float tensor): batch of (s * (ya - yb))
+
+    Returns:
+        (float tensor): second derivative for each comparison (float64)
+    """
+    t = t.double()  # 1/t² - 1/sinh²(t) is unstable in float32
+    small = abs(t) <= 0.01
+    big = abs(t) >= 10
+    medium = torch.logical_not(torch.logical_or(small, big))
+    zer = torch.zeros_like(t)
+    tm = torch.where(medium, t, torch.ones_like(t))  # avoids NaNs
+    tb = torch.where(big, t, torch.full_like(t, 10))
+    deriv2 = torch.where(small, torch.full_like(t, 1 / 3), zer)
+    deriv2 += torch.where(medium, 1 / tm ** 2 - 1 / torch.sinh(tm) ** 2, zer)
+    deriv2 += torch.where(big, 1 / tb ** 2, zer)
+    return deriv2
 
 
 def get_fit_loss(model, s, a_batch, b_batch, r_batch, vidx=-1):
@@ -77,34 +154,23 @@ def get_fit_loss(model, s, a_batch, b_batch, r_batch, vidx=-1):
     Args:
         model (float tensor): node local model.
         s (float tensor): s parameter.
-        a_batch (bool 2D tensor): first videos compared by user.
-        b_batch (bool 2D tensor): second videos compared by user.
+        a_batch (long tensor): indexes of first videos compared by user.
+        b_batch (long tensor): indexes of second videos compared by user.
         r_batch (float tensor): rating provided by user.
+        vidx (int): video index if only comparisons of one video are used
+                        (-1 for all)
 
     Returns:
         (float scalar tensor): fitting loss.
     """
     if vidx != -1:  # loss for only one video (for uncertainty computation)
-
-        idxs = torch.tensor(
-            [
-                idx
-                for idx, ab in enumerate(zip(a_batch, b_batch))
-                if (ab[0][vidx] or ab[1][vidx])
-            ],
-            dtype=torch.long,
-        )
-
-        if idxs.shape[0] == 0:  # if user didnt rate video
+        used = torch.logical_or(a_batch == vidx, b_batch == vidx)
+        if not used.any():  # if user didnt rate video
             return torch.scalar_tensor(0)
-
-        ya_batch = predict(a_batch[idxs], model)
-        yb_batch = predict(b_batch[idxs], model)
-        loss = _approx_bbt_loss(s * (ya_batch - yb_batch), r_batch[idxs])
-    else:
-        ya_batch = predict(a_batch, model)
-        yb_batch = predict(b_batch, model)
-        loss = _approx_bbt_loss(s * (ya_batch - yb_batch), r_batch)
+        a_batch, b_batch, r_batch = a_batch[used], b_batch[used], r_batch[used]
+    ya_batch = predict(a_batch, model)
+    yb_batch = predict(b_batch, model)
+    loss = _approx_bbt_loss(s * (ya_batch - yb_batch), r_batch)
     return loss
 
 
@@ -161,6 +227,66 @@ def model_norm(model, pow=(2, 1), vidx=-1):
     return (model ** q).abs().sum() ** p
 
 
+def smooth_abs(tens, smoothing=0):
+    """Differentiable approximation of absolute value
+
+    Args:
+        tens (float tensor): input
+        smoothing (float): |x| is replaced by sqrt(x² + smoothing²) - smoothing
+                                (0 for exact absolute value)
+
+    Returns:
+        (float tensor): (approximated) absolute value of input
+    """
+    if smoothing == 0:
+        return tens.abs()
+    return (tens ** 2 + smoothing ** 2).sqrt() - smoothing
+
+
+def _batched_gen_loss(licch, models, weights, vidx=-1, smoothing=0):
+    """Generalisation term of loss for all nodes at once
+
+    Args:
+        licch (Licchavi()): licchavi object
+        models (float tensor): local scores of all nodes, concatenated
+        weights (float tensor): weight of each node
+        vidx (int): video index if we are interested in partial loss
+                                    (-1 for all indexes)
+        smoothing (float): smoothing of l1 distance (0 for none)
+
+    Returns:
+        (float tensor): generalisation term of loss
+    """
+    uidxs, vidxs = licch.rated_uidxs, licch.rated_vidxs
+    if vidx != -1:
+        used = vidxs == vidx
+        uidxs, vidxs, models = uidxs[used], vidxs[used], models[used]
+    dists = smooth_abs(models - licch.global_model[vidxs], smoothing)
+    return (weights[uidxs] * dists).sum()
+
+
+def _batched_fit_loss(licch, models, s, vidx=-1):
+    """Fitting term of loss for all nodes at once
+
+    Args:
+        licch (Licchavi()): licchavi object
+        models (float tensor): local scores of all nodes, concatenated
+        s (float tensor): s parameter of each node
+        vidx (int): video index if we are interested in partial loss
+                                    (-1 for all indexes)
+
+    Returns:
+        (float tensor): fitting term of loss
+    """
+    uidxs, pos1, pos2, r = licch.comp_uidxs, licch.pos1, licch.pos2, licch.r
+    if vidx != -1:
+        used = torch.logical_or(licch.vid1 == vidx, licch.vid2 == vidx)
+        uidxs, pos1, pos2, r = uidxs[used], pos1[used], pos2[used], r[used]
+    ya_batch = models[pos1]
+    yb_batch = models[pos2]
+    return _approx_bbt_loss(s[uidxs] * (ya_batch - yb_batch), r)
+
+
 # losses used in "licchavi.py"
 def loss_fit_s_gen(licch, vidx=-1, uid=-1):
     """Computes local and generalisation terms of loss
@@ -168,7 +294,8 @@ def loss_fit_s_gen(licch, vidx=-1, uid=-1):
     Args:
         licch (Licchavi()): licchavi object
         vidx (int): video index if we are interested in partial loss
-                                    (-1 for all indexes)
+                        (-1 for all indexes), position of the video in
+                        the local model if -uid is given
         uid (int): user ID if we are interested in partial loss
                                     (-1 for all users)
 
@@ -192,30 +319,15 @@ def loss_fit_s_gen(licch, vidx=-1, uid=-1):
             s_loss += get_s_loss(node.s)  # FIXME not accessed?
         g = models_dist(
             node.model,  # local model
-            licch.global_model,  # general model
-            mask=node.mask,  # mask
-            vidx=vidx,  # video index if we want partial loss
+            licch.global_model[node.vidxs],  # general model, videos rated
+            vidx=vidx,  # video position if we want partial loss
         )
         gen_loss += node.w * g  # node weight  * generalisation term
-    else:  # if we want all users
-        for node in licch.nodes.values():
-            fit_loss += get_fit_loss(
-                node.model,  # local model
-                node.s,  # s
-                node.vid1,  # id_batch1
-                node.vid2,  # id_batch2
-                node.r,  # r_batch
-                vidx,
-            )
-            if vidx == -1:  # only if all loss is computed
-                s_loss += get_s_loss(node.s)
-            g = models_dist(
-                node.model,  # local model
-                licch.global_model,  # general model
-                mask=node.mask,  # mask
-                vidx=vidx,  # video index if we want partial loss
-            )
-            gen_loss += node.w * g  # node weight  * generalisation term
+    else:  # if we want all users, batched over all comparisons
+        fit_loss = _batched_fit_loss(licch, licch.models, licch.s, vidx)
+        if vidx == -1:  # only if all loss is computed
+            s_loss = get_s_loss(licch.s).sum()
+        gen_loss = _batched_gen_loss(licch, licch.models, licch.weights, vidx)
     return fit_loss, s_loss, gen_loss
 
 
@@ -231,22 +343,6 @@ def loss_gen_reg(licch, vidx=-1):
         (float tensor): generalisation term of loss
         (float tensor): regularisation loss (of general model)
     """
-    gen_loss, reg_loss = 0, 0
-    for node in licch.nodes.values():
-        g = models_dist(
-            node.model,  # local model
-            licch.global_model,  # general model
-            mask=node.mask,  # mask
-            vidx=vidx,
-        )
-        gen_loss += node.w * g  # node weight * generalisation term
+    gen_loss = _batched_gen_loss(licch, licch.models, licch.weights, vidx)
     reg_loss = licch.w0 * model_norm(licch.global_model, vidx=vidx)
     return gen_loss, reg_loss
-
-
-def round_loss(tens, dec=0):
-    """from an input scalar tensor or int/float returns rounded int/float"""
-    if type(tens) is int or type(tens) is float:
-        return round(tens, dec)
-    else:
-        return round(tens.item(), dec)
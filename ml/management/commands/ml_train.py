@@ -1,15 +1,23 @@
 import logging
+import time
+from itertools import islice
 
+import gin
+import numpy as np
 from tournesol.models.video import (
     ComparisonCriteriaScore,
     ContributorRating,
     ContributorRatingCriteriaScore,
+    ContributorScoresRefresh,
     VideoCriteriaScore,
 )
 from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
 
 from settings.settings import CRITERIAS
 from ml.core import ml_run, TOURNESOL_DEV
+from ml.monitoring import timed, export_metrics, clear_metrics
+from ml.online import refresh_user
 
 """
 Machine Learning main python file
@@ -39,102 +47,375 @@ Structure:
 - fetch_data() provides data from the database
 - ml_run() uses this data as input, trains via shape_train_predict()
      and returns video scores
-- save_data() takes these scores and save them to the database
+- save_data() takes these scores and save the changed ones to the database
 - these 3 are called by Django at the end of this file
+- timings and sizes of each stage are exported for Prometheus at the end
+    (see "monitoring.py")
 
 USAGE:
 - set env variable TOURNESOL_DEV to 1 for experimenting, don't for production
     mode
 - run "python manage.py ml_train"
+- options (default values are in "hyperparameters.gin"):
+    --workers N: number of processes training criterias concurrently
+    --criteria C1 C2 ...: subset of criterias to train
+    --epochs N: (maximum) number of training epochs
+    --resume: resume from previously saved models
+    --incremental: resume training only contributors whose comparisons
+        changed since models were saved
+    --profile-epoch N: save a trace of training epoch N in ml/profiles/
+    --user ID: only refresh local scores of this contributor, global
+        scores fixed (see "online.py")
+    --refresh-pending: keep refreshing contributors whose refresh was
+        requested (ContributorScoresRefresh), see refresh_pending()
+- with ML_ONLINE_REFRESH in the server settings, each comparison submitted
+    requests a refresh of its contributor, done by refresh_pending()
 """
 
+CHUNK_SIZE = 100000  # number of rows fetched at once from database
+SCORE_TOLERANCE = 0.005  # smaller changes of scores are not saved
+REFRESH_POLL = 0.5  # seconds between checks of pending refreshes
 
-def fetch_data():
-    """Fetches the data from the Comparisons model
+
+def fetch_data(user_id=None):
+    """Fetches the data from the Comparisons model, streamed by chunks
+
+    Rows are read with a server-side cursor, without creating model
+    instances, and put in typed numpy columns
+
+    user_id (int): only fetch comparisons of this contributor (all if None)
 
     Returns:
-    - comparison_data: list of
-        [   contributor_id: int, video_id_1: int, video_id_2: int,
-            criteria: str, score: float, weight: float  ]
+    - comparison_data: columns (see handle_data.get_columns())
+        (   criterias: str list, contributor_id: int array,
+            video_id_1: int array, video_id_2: int array,
+            criteria index: int array, score: float array (nan if None)  )
     """
-    comparison_data = [
-        [
-            ccs.comparison.user_id,
-            ccs.comparison.video_1_id,
-            ccs.comparison.video_2_id,
-            ccs.criteria,
-            ccs.score,
-            ccs.weight,
-        ]
-        for ccs in ComparisonCriteriaScore.objects.all().prefetch_related("comparison")
+    queryset = ComparisonCriteriaScore.objects
+    if user_id is not None:
+        queryset = queryset.filter(comparison__user_id=user_id)
+    rows = queryset.values_list(
+        "comparison__user_id",
+        "comparison__video_1_id",
+        "comparison__video_2_id",
+        "criteria",
+        "score",
+    ).iterator(chunk_size=CHUNK_SIZE)
+    return _to_columns(rows)
+
+
+def _to_columns(rows, chunk_size=CHUNK_SIZE):
+    """Puts rows in typed numpy columns, -chunk_size rows at a time
+
+    rows (iterable): tuples of (contributor_id, video_id_1, video_id_2,
+                                criteria, score)
+
+    Returns:
+        (tuple): columns, see fetch_data()
+    """
+    rows = iter(rows)
+    crit_idx = {}  # {criteria: criteria index}
+    dtypes = [np.int64] * 4 + [np.float64]
+    chunks = [[] for _ in dtypes]
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        users, vids1, vids2, crits, scores = zip(*chunk)
+        crits = [crit_idx.setdefault(crit, len(crit_idx)) for crit in crits]
+        for l_col, col, dtype in zip(
+            chunks, (users, vids1, vids2, crits, scores), dtypes
+        ):
+            l_col.append(np.array(col, dtype=dtype))  # None score is nan
+    columns = [
+        np.concatenate(l_col) if l_col else np.zeros(0, dtype=dtype)
+        for l_col, dtype in zip(chunks, dtypes)
     ]
-    return comparison_data
+    return (list(crit_idx), *columns)
+
+
+class _LinesFile:
+    """Read-only file-like object over an iterator of text lines (for COPY)"""
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ""
 
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = "".join(chunks)
+        size = len(data) if size < 0 else size
+        self.buffer = data[size:]
+        return data[:size]
 
-def save_data(video_scores, contributor_rating_scores):
+
+def _copy_to_staging(cursor, table, columns, rows):
+    """Streams rows into a new temporary table with COPY
+
+    cursor (CursorWrapper): database cursor
+    table (str): name of temporary table, dropped at end of transaction
+    columns (str list): "name type" of each column
+    rows (iterable): tuples of values, in the order of -columns
     """
-    Saves in the scores for Videos and ContributorRatings
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {table} ({', '.join(columns)}) ON COMMIT DROP"
+    )
+    lines = ("\t".join(map(str, row)) + "\n" for row in rows)
+    cursor.copy_expert(f"COPY {table} FROM STDIN", _LinesFile(lines))
+    cursor.execute(f"ANALYZE {table}")
+
+
+def _publish_video_scores(cursor, video_scores, criterias):
+    """Upserts changed global scores and deletes disappeared ones
+
+    cursor (CursorWrapper): database cursor
+    video_scores (iterable): output of ml_run()
+    criterias (str list): criterias trained, scores of others are kept
     """
-    VideoCriteriaScore.objects.all().delete()
-    VideoCriteriaScore.objects.bulk_create(
+    table = VideoCriteriaScore._meta.db_table
+    _copy_to_staging(
+        cursor,
+        "ml_video_scores",
         [
-            VideoCriteriaScore(
-                video_id=video_id,
-                criteria=criteria,
-                score=score,
-                uncertainty=uncertainty,
-            )
-            for video_id, criteria, score, uncertainty in video_scores
-        ]
+            "video_id bigint", "criteria text",
+            "score double precision", "uncertainty double precision",
+        ],
+        video_scores,
     )
-
-    rating_ids = {
-        (contributor_id, video_id): rating_id
-        for rating_id, contributor_id, video_id in ContributorRating.objects.all().values_list(
-            "id", "user_id", "video_id"
+    cursor.execute(
+        f"""
+        DELETE FROM {table} t
+        WHERE t.criteria = ANY(%s) AND NOT EXISTS (
+            SELECT 1 FROM ml_video_scores s
+            WHERE s.video_id = t.video_id AND s.criteria = t.criteria
         )
-    }
-    ratings_to_create = set(
-        (contributor_id, video_id)
-        for contributor_id, video_id, _, _, _ in contributor_rating_scores
-        if (contributor_id, video_id) not in rating_ids
+        """,
+        [list(criterias)],
     )
-    created_ratings = ContributorRating.objects.bulk_create(
+    cursor.execute(
+        f"""
+        INSERT INTO {table} AS t (video_id, criteria, score, uncertainty, quantile)
+        SELECT video_id, criteria, score, uncertainty, 1.0 FROM ml_video_scores
+        ON CONFLICT (video_id, criteria) DO UPDATE
+        SET score = EXCLUDED.score, uncertainty = EXCLUDED.uncertainty
+        WHERE abs(t.score - EXCLUDED.score) > %(tol)s
+            OR abs(t.uncertainty - EXCLUDED.uncertainty) > %(tol)s
+        """,
+        {"tol": SCORE_TOLERANCE},
+    )
+
+
+def _publish_contributor_scores(
+    cursor, contributor_rating_scores, criterias, user_id=None
+):
+    """Upserts changed local scores and deletes disappeared ones
+
+    Missing ContributorRatings are created (not public)
+
+    cursor (CursorWrapper): database cursor
+    contributor_rating_scores (iterable): output of ml_run()
+    criterias (str list): criterias trained, scores of others are kept
+    user_id (int): contributor refreshed, scores of others are kept
+                        (None if all contributors were trained)
+    """
+    table = ContributorRatingCriteriaScore._meta.db_table
+    ratings = ContributorRating._meta.db_table
+    user_filter = ""
+    if user_id is not None:
+        user_filter = (
+            f"AND t.contributor_rating_id IN "
+            f"(SELECT id FROM {ratings} WHERE user_id = %(user_id)s)"
+        )
+    _copy_to_staging(
+        cursor,
+        "ml_contributor_scores",
         [
-            ContributorRating(
-                video_id=video_id,
-                user_id=contributor_id,
-                is_public=False,
-            )
-            for contributor_id, video_id in ratings_to_create
-        ]
+            "user_id bigint", "video_id bigint", "criteria text",
+            "score double precision", "uncertainty double precision",
+        ],
+        contributor_rating_scores,
     )
-    rating_ids.update(
-        {(rating.user_id, rating.video_id): rating.id for rating in created_ratings}
+    cursor.execute(
+        f"""
+        INSERT INTO {ratings} (user_id, video_id, is_public)
+        SELECT DISTINCT user_id, video_id, false FROM ml_contributor_scores
+        ON CONFLICT (user_id, video_id) DO NOTHING
+        """
     )
-    ContributorRatingCriteriaScore.objects.all().delete()
-    ContributorRatingCriteriaScore.objects.bulk_create(
-        [
-            ContributorRatingCriteriaScore(
-                contributor_rating_id=rating_ids[(contributor_id, video_id)],
-                criteria=criteria,
-                score=score,
-                uncertainty=uncertainty,
-            )
-            for contributor_id, video_id, criteria, score, uncertainty in contributor_rating_scores
-        ]
+    cursor.execute(
+        f"""
+        DELETE FROM {table} t
+        WHERE t.criteria = ANY(%(crits)s) {user_filter} AND NOT EXISTS (
+            SELECT 1 FROM ml_contributor_scores s
+            JOIN {ratings} r
+                ON r.user_id = s.user_id AND r.video_id = s.video_id
+            WHERE r.id = t.contributor_rating_id AND s.criteria = t.criteria
+        )
+        """,
+        {"crits": list(criterias), "user_id": user_id},
+    )
+    cursor.execute(
+        f"""
+        INSERT INTO {table} AS t
+            (contributor_rating_id, criteria, score, uncertainty)
+        SELECT r.id, s.criteria, s.score, s.uncertainty
+        FROM ml_contributor_scores s
+        JOIN {ratings} r ON r.user_id = s.user_id AND r.video_id = s.video_id
+        ON CONFLICT (contributor_rating_id, criteria) DO UPDATE
+        SET score = EXCLUDED.score, uncertainty = EXCLUDED.uncertainty
+        WHERE abs(t.score - EXCLUDED.score) > %(tol)s
+            OR abs(t.uncertainty - EXCLUDED.uncertainty) > %(tol)s
+        """,
+        {"tol": SCORE_TOLERANCE},
     )
 
 
+def save_data(video_scores, contributor_rating_scores, criterias=CRITERIAS):
+    """
+    Saves in the scores for Videos and ContributorRatings
+
+    Scores are streamed with COPY into temporary tables, then only scores
+    changed by more than SCORE_TOLERANCE are written and scores of
+    -criterias which disappeared are deleted, in one transaction
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        _publish_video_scores(cursor, video_scores, criterias)
+        _publish_contributor_scores(cursor, contributor_rating_scores, criterias)
+
+
+def refresh_contributor(user_id, criterias=CRITERIAS):
+    """Refreshes and saves the local scores of one contributor only
+
+    Local scores are trained from the last checkpoints, global scores
+    fixed (see "online.py"), criterias without checkpoint are skipped
+
+    user_id (int): contributor ID
+    criterias (str list): criterias refreshed
+    """
+    loc_scores = refresh_user(fetch_data(user_id), user_id, criterias)
+    if not loc_scores:
+        return
+    refreshed = sorted({crit for _, _, crit, _, _ in loc_scores})
+    with transaction.atomic(), connection.cursor() as cursor:
+        _publish_contributor_scores(cursor, loc_scores, refreshed, user_id)
+
+
+def _refresh_pending_once(criterias=CRITERIAS):
+    """Refreshes contributors whose refresh is pending, oldest first
+
+    A request is deleted before its refresh, a comparison submitted during
+    the refresh requests a new one. Requests deleted meanwhile (by another
+    consumer) are skipped.
+
+    criterias (str list): criterias refreshed
+
+    Returns:
+        (int): number of contributors refreshed
+    """
+    pending = ContributorScoresRefresh.objects.order_by("datetime_add")
+    nb_refreshed = 0
+    for pk, user_id in pending.values_list("id", "user_id"):
+        deleted, _ = ContributorScoresRefresh.objects.filter(pk=pk).delete()
+        if not deleted:
+            continue
+        try:
+            refresh_contributor(user_id, criterias)
+        except (OSError, ValueError, DatabaseError):
+            # next ml_train run updates these scores anyway
+            logging.exception(f"Refresh of contributor {user_id} failed")
+        nb_refreshed += 1
+    return nb_refreshed
+
+
+def refresh_pending(criterias=CRITERIAS, poll=REFRESH_POLL):
+    """Refreshes contributors whose refresh is requested, until interrupted
+
+    One long-lived consumer loads the ml once, a refresh then takes
+    a few tens of milliseconds
+
+    criterias (str list): criterias refreshed
+    poll (float): seconds between checks when no refresh is pending
+    """
+    while True:
+        if not _refresh_pending_once(criterias):
+            time.sleep(poll)
+
+
 class Command(BaseCommand):
     help = "Runs the ml"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int,
+            help="number of processes training criterias concurrently",
+        )
+        parser.add_argument(
+            "--criteria", nargs="+", choices=CRITERIAS, default=CRITERIAS,
+            help="criterias to train (all by default)",
+        )
+        parser.add_argument(
+            "--epochs", type=int, help="(maximum) number of training epochs"
+        )
+        parser.add_argument(
+            "--resume", action="store_true", default=None,
+            help="resume from previously saved models",
+        )
+        parser.add_argument(
+            "--incremental", action="store_true", default=None,
+            help="train only contributors whose comparisons changed "
+            "since models were saved",
+        )
+        parser.add_argument(
+            "--profile-epoch", type=int,
+            help="save a trace (torch profiler or cProfile) of this epoch",
+        )
+        parser.add_argument(
+            "--user", type=int,
+            help="only refresh local scores of this contributor "
+            "(global scores fixed)",
+        )
+        parser.add_argument(
+            "--refresh-pending", action="store_true",
+            help="keep refreshing contributors whose refresh is requested",
+        )
+
     def handle(self, *args, **options):
-        comparison_data = fetch_data()
+        if options["user"] is not None:
+            refresh_contributor(options["user"], options["criteria"])
+            return
+        if options["refresh_pending"]:
+            refresh_pending(options["criteria"])
+            return
+        # options not given keep values of "hyperparameters.gin"
+        run_options = {
+            key: options[key]
+            for key in ("workers", "epochs", "resume", "incremental")
+            if options[key] is not None
+        }
+        if options["profile_epoch"] is not None:
+            gin.bind_parameter(
+                "LicchaviBase.profile_epoch", options["profile_epoch"]
+            )
+        clear_metrics()  # gauges of a previous run would be exported again
+        with timed("fetch"):
+            comparison_data = fetch_data()
         if TOURNESOL_DEV:
             logging.error('You must turn TOURNESOL_DEV to 0 to use this')
         else:  # production mode
             glob_scores, loc_scores = ml_run(
-                comparison_data, criterias=CRITERIAS, save=True, verb=-1
+                comparison_data,
+                criterias=options["criteria"],
+                save=True,
+                verb=-1,
+                **run_options
             )
-            save_data(glob_scores, loc_scores)
+            with timed("publish"):
+                save_data(glob_scores, loc_scores, options["criteria"])
+            export_metrics()
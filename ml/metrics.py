@@ -1,10 +1,11 @@
-from torch.autograd.functional import hessian
+import numpy as np
 import torch
-from copy import deepcopy
 import logging
-from statistics import median
 
-from .losses import round_loss, loss_fit_s_gen, loss_gen_reg, models_dist
+from .losses import (
+    loss_fit_s_gen, loss_gen_reg, _approx_bbt_deriv, _approx_bbt_deriv2
+)
+from .data_utility import round_loss, _global_uncerts
 
 """
 Metrics used for training monitoring in "licchavi.py"
@@ -40,37 +41,7 @@ def scalar_product(l_grad1, l_grad2):
     return round_loss(s, 4)
 
 
-def replace_coordinate(tens, score, idx):
-    """Replaces one coordinate of the tensor
-
-    Args:
-        tens (float tensor): local model
-        score (scalar tensor): score to put in tens
-        idx (int): index of score to replace
-
-    Returns:
-        (float tensor): same tensor as input but backward pointing to -score
-    """
-    size = len(tens)
-    left, _, right = torch.split(tens, [idx, 1, size - idx - 1])
-    return torch.cat([left, score, right])
-
-
 # ------ to compute uncertainty -------
-def _global_uncert(values, prior=4, weight=5):
-    """Returns posterior value of median
-
-    prior(float): value of prior median
-    weight (int): weight of prior
-    values (float list): data to take median of
-
-    Returns:
-        (float): global uncertainty for one video
-    """
-    full_values = values + [prior] * weight
-    return median(full_values) / len(values) ** 0.5
-
-
 def get_uncertainty_glob(licch):
     """Returns uncertainty for all global scores
 
@@ -81,69 +52,62 @@ def get_uncertainty_glob(licch):
         (float tensor): uncertainty for all global scores
     """
     with torch.no_grad():
-        uncerts = torch.empty(licch.nb_vids)  # all global uncertainties
-        all_vids = list(licch.vid_vidx.keys())  # all video IDs
-        for vidx in range(licch.nb_vids):  # for each video
-            distances = []
-            for node in licch.nodes.values():
-                if all_vids[vidx] in node.vids:
-                    dist = models_dist(node.model, licch.global_model, vidx=vidx)
-                    distances.append(dist.item())
-            uncerts[vidx] = _global_uncert(distances)
-    return uncerts
+        dists = (licch.models - licch.global_model[licch.rated_vidxs]).abs()
+    uncerts = _global_uncerts(
+        dists.cpu().numpy(), licch.vid_order, licch.vid_offsets
+    )
+    return torch.as_tensor(uncerts, dtype=torch.float32)
 
 
-def _get_hessian_fun_loc(licch, uid, vidx):
-    """Gives loss in function of local model for hessian computation
+def get_fit_derivs(licch, comps=None):
+    """Returns derivatives of the fitting loss for each local score
+
+    Computed in closed form, second derivatives are the diagonal
+    of the hessian
 
     Args:
         licch (Licchavi()): licchavi object
-        id_node (int): id of user
-        vidx (int): index of video, ie index of parameter
+        comps (long tensor): comparisons used (None for all)
 
     Returns:
-        (scalar tensor -> float) function giving loss according to one score
+        (float64 tensor): derivative for all local scores
+        (float64 tensor): second derivative for all local scores
     """
-
-    def get_loss(score):
-        """Used to compute its second derivative to get uncertainty
-
-        input (float scalar tensor): one score
-
-        Returns:
-            (float scalar tensor): partial loss for 1 user, 1 video
-        """
-        new_model = replace_coordinate(licch.nodes[uid].model, score, vidx)
-        licch.nodes[uid].model = new_model
-        fit_loss, _, gen_loss = loss_fit_s_gen(licch, vidx, uid)
-        return fit_loss + gen_loss
-
-    return get_loss
+    uidxs, pos1, pos2 = licch.comp_uidxs, licch.pos1, licch.pos2
+    r = licch.r
+    if comps is not None:
+        uidxs, pos1, pos2, r = uidxs[comps], pos1[comps], pos2[comps], r[comps]
+    with torch.no_grad():
+        s_comps = licch.s[uidxs].double()
+        models = licch.models.double()
+        t = s_comps * (models[pos1] - models[pos2])
+        deriv = s_comps * _approx_bbt_deriv(t, r.double())
+        deriv2 = s_comps ** 2 * _approx_bbt_deriv2(t)
+        grad, hess = torch.zeros_like(models), torch.zeros_like(models)
+        grad.index_add_(0, pos1, deriv)
+        grad.index_add_(0, pos2, -deriv)
+        hess.index_add_(0, pos1, deriv2)
+        hess.index_add_(0, pos2, deriv2)
+    return grad, hess
 
 
 def get_uncertainty_loc(licch):
     """Returns uncertainty for all local scores
 
+    Uncertainty is the inverse square root of the second derivative of the
+    loss with respect to each local score, computed in closed form for all
+    scores at once (the L1 generalisation term has no curvature)
+
     Args:
         licch (Licchavi()): licchavi object
 
     Returns:
-        (float tensor list): uncertainty for all local scores
+        (float tensor list): uncertainty for all local scores, one tensor
+                                    for each node
     """
     logging.info("Computing uncertainty")
-    local_uncert = []
-    for uid, node in licch.nodes.items():  # for all nodes
-        local_uncerts = []
-        for vid in node.vids:  # for all videos of the node
-            vidx = licch.vid_vidx[vid]  # video index
-            score = node.model[vidx : vidx + 1].detach()
-            score = deepcopy(score)
-            fun = _get_hessian_fun_loc(licch, uid, vidx)
-            deriv2 = hessian(fun, score)
-            uncert = deriv2 ** (-0.5)
-            local_uncerts.append(uncert)
-        local_uncert.append(local_uncerts)
-    return local_uncert
+    uncerts = (get_fit_derivs(licch)[1] ** (-0.5)).float()
+    return list(torch.split(uncerts, np.diff(licch.rated_offsets).tolist()))
 
 
 # -------- to check equilibrium ------
@@ -174,8 +138,7 @@ def check_equilibrium_glob(epsilon, licch):
 
     def _one_side_glob(increment):
         """increment (float tensor): coordinates are +/- epsilon"""
-        for node in licch.nodes.values():
-            node.opt.zero_grad(set_to_none=True)  # node optimizer
+        licch.opt_loc.zero_grad(set_to_none=True)  # local optimizer
         licch.opt_gen.zero_grad(set_to_none=True)  # general optimizer
 
         # adding epsilon to scores
@@ -208,31 +171,25 @@ def check_equilibrium_loc(epsilon, licch):
         (float): fraction of scores at equilibrium
     """
     nbvid = len(licch.vid_vidx)
-    nbn = len(licch.nodes)
     incr = _random_signs(epsilon, nbvid)
 
     def _one_side_loc(increment):
         """increment (float tensor): coordinates are +/- epsilon"""
-        l_derivs = torch.empty(nbn, nbvid)
         # resetting gradients
-        for node in licch.nodes.values():
-            node.opt.zero_grad(set_to_none=True)  # node optimizer
+        licch.opt_loc.zero_grad(set_to_none=True)  # local optimizer
         licch.opt_gen.zero_grad(set_to_none=True)  # general optimizer
         # adding epsilon to scores
+        increment = increment[licch.rated_vidxs]  # for each local score
         with torch.no_grad():
-            for node in licch.nodes.values():
-                node.model += increment
+            licch.models += increment
         # computing gradients
         fit_loss, _, gen_loss = loss_fit_s_gen(licch)
         loss = fit_loss + gen_loss
         loss.backward()
-        # adding derivatives
-        for uidx, node in enumerate(licch.nodes.values()):
-            l_derivs[uidx] = node.model.grad * increment
+        l_derivs = licch.models.grad * increment
         # removing epsilon from score
         with torch.no_grad():
-            for node in licch.nodes.values():
-                node.model -= increment
+            licch.models -= increment
         return l_derivs
 
     derivs1 = _one_side_loc(incr)
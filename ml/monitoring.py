@@ -0,0 +1,207 @@
+import os
+import logging
+import cProfile
+import resource
+from contextlib import contextmanager
+from time import time
+import gin
+
+"""
+Monitoring of the ml pipeline, used in "core.py" and "ml_train.py"
+
+Main file is "ml_train.py"
+
+Structure:
+- metrics are gauges stored in _SAMPLES, {(name, labels): value}:
+-- timed() records the duration of a stage (fetch, shape, distribute, train,
+    uncertainty, save, publish) for a criteria ("all" if shared)
+-- set_metric() records counts (nodes, videos, comparisons, epochs)
+-- record_peak_memory() records the peak memory of the process
+- worker processes return their metrics with get_metrics(), merged in the
+    main process with update_metrics()
+- export_metrics() writes them in Prometheus text format (node exporter
+    textfile collector) and/or pushes them to a Prometheus pushgateway
+- cprofile_trace() and torch_trace() trace one training epoch to disk
+    (LicchaviBase.profile_epoch in "hyperparameters.gin")
+"""
+
+PREFIX = "ml_train_"  # prefix of exported metrics names
+PROFILE_FOLDER = "ml/profiles/"  # traces of profiled epochs
+METRICS_HELP = {
+    "stage_seconds": "Duration of a stage of ml_train",
+    "epoch_seconds": "Mean duration of a training epoch",
+    "epochs": "Number of training epochs (or L-BFGS iterations)",
+    "nodes": "Number of contributors trained",
+    "videos": "Number of videos scored",
+    "comparisons": "Number of comparisons used",
+    "peak_memory_bytes": "Peak resident memory of a process",
+}
+
+_SAMPLES = {}  # {(metric name, ((label, value), ...)): value}
+
+
+def set_metric(name, value, **labels):
+    """Records the value of a gauge
+
+    name (str): metric name, key of METRICS_HELP
+    value (float): value of the metric
+    labels (str): labels of the sample (criteria, stage)
+    """
+    _SAMPLES[(name, tuple(sorted(labels.items())))] = float(value)
+
+
+@contextmanager
+def timed(stage, criteria="all"):
+    """Records the duration of the code run in this context
+
+    stage (str): name of the stage timed
+    criteria (str): criteria concerned ("all" if shared)
+    """
+    start = time()
+    try:
+        yield
+    finally:
+        duration = time() - start
+        set_metric("stage_seconds", duration, stage=stage, criteria=criteria)
+        logging.info(f"{stage} time ({criteria}): {round(duration, 2)}")
+
+
+def record_peak_memory(criteria="all"):
+    """Records the peak resident memory of the current process (or of its
+    largest terminated child process, like workers, if higher)
+
+    criteria (str): criteria which was just processed ("all" if shared)
+    """
+    peak = max(
+        resource.getrusage(who).ru_maxrss * 1024  # in kB on linux
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
+    set_metric("peak_memory_bytes", peak, criteria=criteria)
+
+
+def get_metrics():
+    """Returns a copy of metrics recorded in this process"""
+    return dict(_SAMPLES)
+
+
+def update_metrics(samples):
+    """Adds metrics recorded in another process (output of get_metrics())"""
+    _SAMPLES.update(samples)
+
+
+def clear_metrics():
+    """Forgets all metrics recorded"""
+    _SAMPLES.clear()
+
+
+def format_metrics(samples=None):
+    """Formats metrics in Prometheus text exposition format
+
+    samples (dictionnary): output of get_metrics() (recorded ones if None)
+
+    Returns:
+        (str): one HELP and TYPE line per metric, one line per sample
+    """
+    samples = _SAMPLES if samples is None else samples
+    lines = []
+    for name in sorted({name for name, _ in samples}):
+        lines.append(f"# HELP {PREFIX}{name} {METRICS_HELP.get(name, name)}")
+        lines.append(f"# TYPE {PREFIX}{name} gauge")
+        for (sample_name, labels), value in sorted(samples.items()):
+            if sample_name == name:
+                labels_str = ",".join(f'{key}="{val}"' for key, val in labels)
+                lines.append(f"{PREFIX}{name}{{{labels_str}}} {value!r}")
+    return "\n".join(lines) + "\n"
+
+
+def _push_metrics(gateway, job):
+    """Pushes recorded metrics to a Prometheus pushgateway
+
+    gateway (str): address of the pushgateway
+    job (str): job label of the metrics
+    """
+    try:  # installed with django_prometheus
+        from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+    except ImportError:
+        logging.warning("prometheus_client is required to push metrics")
+        return
+    registry = CollectorRegistry()
+    gauges = {}
+    for (name, labels), value in _SAMPLES.items():
+        if name not in gauges:
+            gauges[name] = Gauge(
+                PREFIX + name, METRICS_HELP.get(name, name),
+                [key for key, _ in labels], registry=registry,
+            )
+        gauges[name].labels(*[val for _, val in labels]).set(value)
+    push_to_gateway(gateway, job=job, registry=registry)
+
+
+@gin.configurable
+def export_metrics(textfile=None, gateway=None, job="ml_train"):
+    """Exports recorded metrics
+
+    textfile (str): file written in Prometheus text format (for the node
+                        exporter textfile collector), None not to write it
+    gateway (str): address of a Prometheus pushgateway, None not to push
+    job (str): job label of pushed metrics
+    """
+    if textfile is not None:
+        tmp_name = textfile + ".tmp"  # collector must not read partial files
+        with open(tmp_name, "w") as f:
+            f.write(format_metrics())
+        os.replace(tmp_name, textfile)
+    if gateway is not None:
+        try:
+            _push_metrics(gateway, job)
+        except OSError as err:  # monitoring doesn't stop training
+            logging.warning(f"Metrics not pushed to {gateway}: {err}")
+
+
+# ------------ profiling --------------------
+def profile_path(criteria, epoch):
+    """Returns the path of the trace of an epoch (without extension)
+
+    criteria (str or str list): criteria(s) trained
+    epoch (int): epoch traced
+    """
+    if not isinstance(criteria, str):  # all criterias in one Licchavi
+        criteria = "multi"
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    return f"{PROFILE_FOLDER}{criteria}_epoch{epoch}"
+
+
+@contextmanager
+def cprofile_trace(path):
+    """Traces python calls in this context with cProfile
+
+    path (str): path of the trace, without extension (".prof" is added,
+                    read it with pstats or snakeviz)
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path + ".prof")
+        logging.info(f"Profile saved in {path}.prof")
+
+
+@contextmanager
+def torch_trace(path):
+    """Traces torch operators in this context with torch.profiler
+
+    path (str): path of the trace, without extension (".json" is added,
+                    a chrome trace readable in chrome://tracing)
+    """
+    from torch.profiler import profile, ProfilerActivity
+    import torch
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities, record_shapes=True) as prof:
+        yield
+    prof.export_chrome_trace(path + ".json")
+    logging.info(f"Profile saved in {path}.json")
@@ -0,0 +1,226 @@
+import numpy as np
+import logging
+
+from .data_utility import (
+    rescale_rating,
+    reverse_idxs,
+    get_pairs_positions,
+    save_checkpoint,
+    load_checkpoint,
+    checkpoint_exists,
+)
+from .handle_data import format_out_glob, format_out_loc
+
+"""
+Training of all criterias in one Licchavi, used in "core.py"
+
+Main file is "ml_train.py"
+
+Structure:
+- the criteria axis is folded into Licchavi axes: a (criteria, video) couple
+    is one video (global score) and a (criteria, user) couple is one node
+- comparisons of all criterias are indexed once (distribute_data_multi())
+- global scores and nodes are grouped by criteria: those of criteria i are
+    in [offsets[i], offsets[i + 1][ (criteria axis, only couples appearing
+    in comparisons are stored)
+- checkpoints are saved per criteria, same as one criteria training
+
+Layout (output of distribute_data_multi()):
+    (criterias, node offsets, node users IDs, global offsets, global vIDs)
+"""
+
+
+def distribute_data_multi(columns, criterias):
+    """Distributes data of all criterias on (criteria, user) nodes, one pass
+
+    columns (tuple): comparisons, output of get_columns()
+    criterias (str list): criterias to train
+
+    Returns:
+    - (vID1 indexes, vID2 indexes, ratings, offsets), comparisons grouped
+        by criteria and user, video indexes are those of (criteria, video)
+        couples, comparisons of node i are in [offsets[i], offsets[i + 1][
+    - layout (str list, int array, int array, int array, int array):
+        criterias, boundaries of nodes of each criteria, user ID of each
+        node, boundaries of global scores of each criteria, video ID
+        of each global score
+    - None if no data for these criterias
+    """
+    names, users, vid1, vid2, crits, scores = columns
+    crit_idx = np.array([
+        criterias.index(name) if name in criterias else -1 for name in names
+    ], dtype=np.int64)
+    crits = crit_idx[crits]
+    used = (crits >= 0) & ~np.isnan(scores)  # used comparisons
+    if not used.any():
+        return None
+    order = np.flatnonzero(used)
+    order = order[np.lexsort((users[order], crits[order]))]  # by criteria, user
+    users, vid1, vid2 = users[order], vid1[order], vid2[order]
+    crits, scores = crits[order], scores[order]
+    nbc = len(criterias)
+
+    # indexing users and videos once for all criterias
+    users, uidxs = np.unique(users, return_inverse=True)
+    vids, vidxs = np.unique(
+        np.stack((vid1, vid2), axis=1).ravel(), return_inverse=True
+    )
+    vidxs = vidxs.reshape(-1, 2)
+
+    # nodes, ie (criteria, user) couples
+    node_keys = crits * len(users) + uidxs
+    node_keys, first_of_each = np.unique(node_keys, return_index=True)
+    offsets = np.append(first_of_each, len(crits)).astype(np.int64)
+    node_crits = node_keys // len(users)
+    node_users = users[node_keys % len(users)]
+
+    # global scores, ie (criteria, video) couples
+    glob_keys, gidxs = np.unique(
+        (crits[:, None] * len(vids) + vidxs).ravel(), return_inverse=True
+    )
+    gidxs = gidxs.reshape(-1, 2)
+    glob_crits = glob_keys // len(vids)
+    glob_vids = vids[glob_keys % len(vids)]
+
+    nodes_data = (
+        gidxs[:, 0],
+        gidxs[:, 1],
+        rescale_rating(scores).astype(np.float32),
+        offsets,
+    )
+    layout = (
+        criterias,
+        np.searchsorted(node_crits, np.arange(nbc + 1)),
+        node_users,
+        np.searchsorted(glob_crits, np.arange(nbc + 1)),
+        glob_vids,
+    )
+    return nodes_data, layout
+
+
+def _crit_slices(licch, layout, cidx):
+    """Returns slices of one criteria
+
+    licch (LicchaviBase()): multi-criteria licchavi object
+    layout (tuple): output of distribute_data_multi()
+    cidx (int): criteria index
+
+    Returns:
+        (slice, slice, slice): nodes, global scores and local scores
+    """
+    _, node_offsets, _, glob_offsets, _ = layout
+    nodes = slice(*node_offsets[cidx : cidx + 2])
+    glob = slice(*glob_offsets[cidx : cidx + 2])
+    loc = slice(*licch.rated_offsets[[nodes.start, nodes.stop]])
+    return nodes, glob, loc
+
+
+def save_models_multi(licch, layout, path):
+    """Saves models of each criteria, as a one criteria Licchavi does
+
+    licch (LicchaviBase()): multi-criteria licchavi object
+    layout (tuple): output of distribute_data_multi()
+    path (str): path of checkpoints, criteria name is appended
+    """
+    logging.info("Saving models")
+    criterias, _, node_users, glob_offsets, glob_vids = layout
+    glob, s, models, ages = licch.get_state()
+    rated_gidxs = licch.rated_vids.astype(np.int64)  # (criteria, video) index
+    for cidx, crit in enumerate(criterias):
+        nodes, gl, loc = _crit_slices(licch, layout, cidx)
+        local_data = (
+            node_users[nodes],
+            s[nodes],
+            licch.rated_offsets[nodes.start : nodes.stop + 1] - loc.start,
+            rated_gidxs[loc] - gl.start,  # video indexes in this criteria
+            models[loc],
+            ages[nodes],
+        )
+        saved_data = (crit, reverse_idxs(glob_vids[gl]), glob[gl], local_data)
+        save_checkpoint(saved_data, f"{path}_{crit}")
+    logging.info("Models saved")
+
+
+def load_models_multi(licch, layout, path):
+    """Loads models of each criteria saved, keeps default for new ones
+
+    licch (LicchaviBase()): multi-criteria licchavi object, with data
+    layout (tuple): output of distribute_data_multi()
+    path (str): path of checkpoints, criteria name is appended
+    """
+    logging.info("Loading models")
+    criterias, _, node_users, _, glob_vids = layout
+    glob, s, models, ages = licch.get_state()
+    rated_gidxs = licch.rated_vids.astype(np.int64)
+    for cidx, crit in enumerate(criterias):
+        fullpath = f"{path}_{crit}"
+        if not checkpoint_exists(fullpath):
+            logging.warning(f"No saved models for this criteria ({crit})")
+            continue
+        _, dic_old, glob_old, loc_models_old = load_checkpoint(fullpath)
+        users_old, s_old, offsets_old, vidxs_old, models_old, ages_old = (
+            loc_models_old[:6]
+        )
+        nodes, gl, loc = _crit_slices(licch, layout, cidx)
+        # global scores of known videos
+        vidxs = np.fromiter(
+            (dic_old.get(vid, -1) for vid in glob_vids[gl]),
+            dtype=np.int64,
+            count=gl.stop - gl.start,
+        )
+        known_vids = vidxs >= 0
+        glob[gl][known_vids] = glob_old[vidxs[known_vids]]
+        # parameters of known users
+        users = node_users[nodes]
+        pos = np.searchsorted(users_old, users).clip(max=len(users_old) - 1)
+        known = users_old[pos] == users
+        s[nodes][known] = s_old[pos[known]]
+        ages[nodes][known] = ages_old[pos[known]]
+        # local scores of known (user, video) couples
+        rated_uidxs = np.repeat(
+            np.arange(len(users)),
+            np.diff(licch.rated_offsets[nodes.start : nodes.stop + 1]),
+        )
+        rated_vidxs = vidxs[rated_gidxs[loc] - gl.start]
+        old_uidxs = np.repeat(np.arange(len(users_old)), np.diff(offsets_old))
+        positions, found = get_pairs_positions(
+            old_uidxs, vidxs_old, pos[rated_uidxs], rated_vidxs, len(dic_old) + 1
+        )
+        found &= known[rated_uidxs] & (rated_vidxs >= 0)
+        models[loc][found] = models_old[positions[found]]
+    licch.set_state(glob, s, models, ages)
+    logging.info("Models updated")
+
+
+def format_out_multi(licch, layout, uncertainties):
+    """Puts scores of all criterias in lists of global and local scores
+
+    licch (LicchaviBase()): multi-criteria licchavi object, trained
+    layout (tuple): output of distribute_data_multi()
+    uncertainties (tuple): output of licch.train()
+
+    Returns:
+        (list list): global scores, same as format_out_glob()
+        (list list): local scores, same as format_out_loc()
+    """
+    criterias, _, node_users, _, glob_vids = layout
+    (_, glob_scores), (rated_uidxs, rated_gidxs, loc_scores) = (
+        licch.output_flat_scores()
+    )
+    loc_vids = glob_vids[rated_gidxs.astype(np.int64)]
+    uncert_glob, uncert_loc = uncertainties
+    out_glob, out_loc = [], []
+    for cidx, crit in enumerate(criterias):
+        nodes, gl, loc = _crit_slices(licch, layout, cidx)
+        out_glob += format_out_glob(
+            (glob_vids[gl], glob_scores[gl]),
+            crit,
+            None if uncert_glob is None else uncert_glob[gl],
+        )
+        out_loc += format_out_loc(
+            (rated_uidxs[loc] - nodes.start, loc_vids[loc], loc_scores[loc]),
+            node_users[nodes],
+            crit,
+            None if uncert_loc is None else uncert_loc[nodes],
+        )
+    return out_glob, out_loc
@@ -6,22 +6,64 @@ Main file is "ml_train.py"
 
 
 class Node:
-    def __init__(self, vid1, vid2, r, vids, mask, s, model, age, w, lr_node, lr_s, opt):
-        self.vid1 = vid1
-        self.vid2 = vid2
-        self.r = r
-        self.vids = vids
-        self.mask = mask
-        self.s = s
-        self.model = model
-        self.age = age  # number of epochs the node has been trained
-        self.w = w
-
-        self.lr_s = lr_s / len(vid1)
-        self.opt = opt(
-            [
-                {"params": self.model},
-                {"params": self.s, "lr": self.lr_s},
-            ],
-            lr=lr_node,
-        )
+    """Views on the data and parameters of one node (user)
+
+    Data and parameters of all nodes are concatenated in the Licchavi object,
+    the local model of a node only has scores for the videos it rated
+    """
+
+    def __init__(self, licch, uidx):
+        self.licch = licch  # Licchavi object storing nodes data and parameters
+        self.uidx = uidx  # index of the node in Licchavi
+
+    @property
+    def _comps(self):
+        """slice of the comparisons of the node"""
+        return slice(*self.licch.offsets[self.uidx : self.uidx + 2])
+
+    @property
+    def _rated(self):
+        """slice of the videos rated by the node"""
+        return slice(*self.licch.rated_offsets[self.uidx : self.uidx + 2])
+
+    @property
+    def vid1(self):
+        """positions in local model of first videos compared"""
+        return self.licch.pos1[self._comps] - self._rated.start
+
+    @property
+    def vid2(self):
+        """positions in local model of second videos compared"""
+        return self.licch.pos2[self._comps] - self._rated.start
+
+    @property
+    def r(self):
+        return self.licch.r[self._comps]
+
+    @property
+    def vidxs(self):
+        """indexes of videos rated"""
+        return self.licch.rated_vidxs[self._rated]
+
+    @property
+    def vids(self):
+        """IDs of videos rated"""
+        return self.licch.rated_vids[self._rated]
+
+    @property
+    def s(self):
+        return self.licch.s[self.uidx : self.uidx + 1]
+
+    @property
+    def model(self):
+        """local scores of videos rated"""
+        return self.licch.models[self._rated]
+
+    @property
+    def age(self):
+        """number of epochs the node has been trained"""
+        return self.licch.ages[self.uidx].item()
+
+    @property
+    def w(self):
+        return self.licch.weights[self.uidx]
@@ -0,0 +1,112 @@
+import logging
+import numpy as np
+
+from ml.data_utility import PATH, load_checkpoint, checkpoint_exists
+from ml.handle_data import (
+    get_criterias_data, distribute_data_from_save, format_out_loc
+)
+from ml.licchavi_numpy import LicchaviNumpy
+
+"""
+Online refresh of the local scores of one contributor, used in "ml_train.py"
+
+Main file is "ml_train.py"
+
+Structure:
+- _user_checkpoint() keeps only the models of one user in the last
+    checkpoint of a criteria (global scores are all kept)
+- refresh_user() loads them in a LicchaviNumpy with the comparisons of
+    this user only, and solves the problem of this node with global
+    scores fixed (block solver, see _solve_nodes() in "licchavi_numpy.py"):
+    local scores and s parameter are trained, global scores stay fixed
+- local scores are returned like ml_run() ones, checkpoints are not
+    modified (the next ml_train run trains the user with all others)
+
+USAGE:
+- ml_train.refresh_contributor() fetches the comparisons of a user and
+    publishes the scores refreshed, it is run by "ml_train --user ID" and
+    by the "ml_train --refresh-pending" consumer, which refreshes
+    contributors whose comparisons were submitted when ML_ONLINE_REFRESH
+    is set in the server settings
+"""
+
+TOL = 1e-5  # largest step of a local parameter to stop
+MAX_ITERS = 500  # maximum number of iterations of the local solver
+
+
+def _user_checkpoint(saved_data, user_id):
+    """Keeps only the local models of one user in a checkpoint
+
+    saved_data (tuple): checkpoint, output of load_checkpoint()
+    user_id (int): user ID
+
+    Returns:
+        (tuple): checkpoint with only this user, None if user is unknown
+    """
+    criteria, vid_vidx, glob, loc_models_old = saved_data
+    users_old, _, offsets_old = loc_models_old[:3]
+    pos = np.searchsorted(users_old, user_id)
+    if pos == len(users_old) or users_old[pos] != user_id:
+        return None
+    start, stop = offsets_old[pos], offsets_old[pos + 1]
+    local_data = tuple(  # users IDs, s, ages (, fingerprints) of this user
+        np.array(arr[pos : pos + 1]) for arr in loc_models_old
+    )
+    local_data = local_data[:2] + (  # rated offsets, rated vidxs, models
+        np.array([0, stop - start]),
+        np.array(loc_models_old[3][start:stop]),
+        np.array(loc_models_old[4][start:stop]),
+    ) + local_data[5:]
+    return criteria, vid_vidx, glob, local_data
+
+
+def refresh_user(
+    comparison_data, user_id, criterias, path=PATH, tol=TOL, max_iters=MAX_ITERS
+):
+    """Trains the local scores of one user with global scores fixed
+
+    comparison_data (list of lists or tuple): comparisons of this user
+                                only, same format as fetch_data() output
+    user_id (int): user ID
+    criterias (str list): criterias to refresh, those without
+                            checkpoint or comparisons are skipped
+    path (str): path of checkpoints, criteria name is appended
+    tol (float): largest step of a local parameter to stop
+    max_iters (int): maximum number of iterations of the local solver
+
+    Returns:
+        (list list): list of [contributor_id: int, video_id: int,
+            criteria_name: str, score: float, uncertainty: float]
+    """
+    loc_scores = []
+    crits_data = get_criterias_data(comparison_data, criterias)
+    for criteria in criterias:
+        full_data = crits_data[criteria]
+        fullpath = f"{path}_{criteria}"
+        if full_data is not None:
+            mine = full_data[0] == user_id
+            full_data = tuple(col[mine] for col in full_data)
+        if full_data is None or not len(full_data[0]):
+            continue
+        if not checkpoint_exists(fullpath):
+            logging.warning(f"No saved models for this criteria ({criteria})")
+            continue
+        saved_data = load_checkpoint(fullpath)
+        user_data = _user_checkpoint(saved_data, user_id)
+        nodes_data, users_ids, vid_vidx = distribute_data_from_save(
+            full_data, saved_data
+        )
+        licch = LicchaviNumpy(len(vid_vidx), vid_vidx, criteria, verb=-1)
+        if user_data is not None:
+            licch.load_and_update(nodes_data, users_ids, user_data)
+        else:  # new user, starts from default local models
+            licch.set_allnodes(nodes_data, users_ids)
+            glob_old = saved_data[2]
+            licch.global_model[: len(glob_old)] = glob_old
+        licch._solve_local(tol, max_iters)  # global scores are not trained
+        # local uncertainty only, as in LicchaviNumpy._get_uncertainty()
+        _, hess = licch._get_fit_derivs(np.arange(len(licch.comp_uidxs)))
+        uncert_loc = hess ** (-0.5)
+        loc = licch.output_flat_scores()[1]
+        loc_scores += format_out_loc(loc, users_ids, criteria, uncert_loc)
+    return loc_scores
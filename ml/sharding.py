@@ -0,0 +1,239 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .licchavi_numpy import _local_terms, _gen_terms
+
+"""
+Sharded local steps of LicchaviNumpy, used in "licchavi_numpy.py"
+
+Main file is "ml_train.py"
+
+Structure:
+- nodes are split in shards of consecutive nodes with about the same
+    number of comparisons (their comparisons and local scores are
+    consecutive too)
+- parameters (local scores, s parameters, global scores) and data are put
+    in shared memory, Licchavi parameters are views on it during training
+- at each epoch, worker processes:
+-- do the local step of their shard (local scores and s parameters of
+    different shards are independent given global scores)
+-- sum the generalisation term derivatives of their shard for each video,
+    the main process adds the sums of all shards and does the global step
+
+USAGE:
+- set "LicchaviBase.shards" in "hyperparameters.gin" (numpy backend, SGD)
+"""
+
+_SHARED = {}  # arrays in shared memory (in workers only)
+
+
+def _share(arrays):
+    """Copies arrays in new shared memory blocks
+
+    arrays (dictionnary): {name: numpy array}
+
+    Returns:
+        (SharedMemory list): memory blocks created
+        (dictionnary): {name: (block name, dtype, shape)}
+        (dictionnary): {name: numpy array in shared memory}
+    """
+    from multiprocessing import shared_memory  # python >= 3.8, when used
+
+    shms, specs, shared = [], {}, {}
+    for key, arr in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        shared[key] = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        shared[key][...] = arr
+        shms.append(shm)
+        specs[key] = (shm.name, arr.dtype.str, arr.shape)
+    return shms, specs, shared
+
+
+def _init_shard_worker(specs):
+    """Initializes a worker process training shards
+
+    specs (dictionnary): shared arrays, output of _share()
+    """
+    from multiprocessing import shared_memory  # python >= 3.8, when used
+
+    shms = []  # keeping references keeps the buffers alive
+    for key, (shm_name, dtype, shape) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shms.append(shm)
+        _SHARED[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _SHARED["shms"] = shms
+
+
+def _fit_shard(bounds, lr_node):
+    """Does the local step of one shard, in place in shared memory
+
+    bounds ((int, int), (int, int), (int, int)): nodes, comparisons and
+                                        local scores of the shard
+    lr_node (float): learning rate of local scores
+
+    Returns:
+        (float, float, float): fitting, s and generalisation losses
+    """
+    (u0, u1), (c0, c1), (l0, l1) = bounds
+    arr = _SHARED
+    models, s = arr["models"][l0:l1], arr["s"][u0:u1]  # views
+    losses, grad_models, grad_s = _local_terms(
+        models, s,
+        arr["glob"][arr["rated_vidxs"][l0:l1]],
+        arr["w_rated"][l0:l1],
+        arr["r"][c0:c1], arr["pos1"][c0:c1], arr["pos2"][c0:c1],
+        arr["comp_uidxs"][c0:c1],
+    )
+    models -= lr_node * grad_models
+    s -= arr["lr_s"][u0:u1] * grad_s  # per node learning rates
+    return losses
+
+
+def _gen_shard(idx, bounds):
+    """Sums generalisation derivatives of one shard for each video
+
+    idx (int): index of the shard, sums are written in sums[idx]
+    bounds: see _fit_shard()
+
+    Returns:
+        (float): generalisation loss of the shard
+    """
+    l0, l1 = bounds[2]
+    arr = _SHARED
+    rated_vidxs = arr["rated_vidxs"][l0:l1]
+    gen_loss, arr["sums"][idx] = _gen_terms(
+        arr["models"][l0:l1],
+        arr["glob"][rated_vidxs],
+        arr["w_rated"][l0:l1],
+        rated_vidxs, len(arr["glob"]),
+    )
+    return gen_loss
+
+
+def get_shards(offsets, rated_offsets, nb_shards):
+    """Splits nodes in shards with about the same number of comparisons
+
+    offsets (int array): comparisons of node i are in [offsets[i],
+                            offsets[i + 1][
+    rated_offsets (int array): same for local scores
+    nb_shards (int): maximum number of shards
+
+    Returns:
+        (list of tuples): bounds of nodes, comparisons and local scores
+                            of each shard, see _fit_shard()
+    """
+    nb_nodes = len(offsets) - 1
+    cuts = np.searchsorted(offsets, np.linspace(0, offsets[-1], nb_shards + 1))
+    cuts = np.unique(np.clip(cuts, 0, nb_nodes))
+    cuts[0], cuts[-1] = 0, nb_nodes
+    return [
+        (
+            (int(u0), int(u1)),
+            (int(offsets[u0]), int(offsets[u1])),
+            (int(rated_offsets[u0]), int(rated_offsets[u1])),
+        )
+        for u0, u1 in zip(cuts[:-1], cuts[1:])
+        if u1 > u0
+    ]
+
+
+class ShardPool:
+    """Worker processes doing local steps of shards of nodes
+
+    Used as a context manager: Licchavi parameters are in shared memory
+    inside the context, and copied back when leaving it
+    """
+
+    def __init__(self, licch, nb_shards):
+        """
+        licch (LicchaviNumpy()): licchavi object trained
+        nb_shards (int): (maximum) number of shards and worker processes
+        """
+        self.licch = licch
+        self.shards = get_shards(licch.offsets, licch.rated_offsets, nb_shards)
+        self.executor = None
+        self.shms = []
+        self.arrays = None
+
+    def _relative_idxs(self):
+        """Returns indexes of comparisons relative to their shard
+
+        Returns:
+            (int array, int array, int array): positions of local scores
+                and nodes of comparisons, from the start of their shard
+        """
+        licch = self.licch
+        pos1, pos2 = licch.pos1.copy(), licch.pos2.copy()
+        comp_uidxs = licch.comp_uidxs.copy()
+        for (u0, _), (c0, c1), (l0, _) in self.shards:
+            pos1[c0:c1] -= l0
+            pos2[c0:c1] -= l0
+            comp_uidxs[c0:c1] -= u0
+        return pos1, pos2, comp_uidxs
+
+    def __enter__(self):
+        licch = self.licch
+        pos1, pos2, comp_uidxs = self._relative_idxs()
+        self.shms, specs, self.arrays = _share({
+            "models": licch.models,
+            "s": licch.s,
+            "glob": licch.global_model,
+            "r": licch.r,
+            "pos1": pos1,
+            "pos2": pos2,
+            "comp_uidxs": comp_uidxs,
+            "rated_vidxs": licch.rated_vidxs,
+            "w_rated": licch.weights[licch.rated_uidxs],
+            "lr_s": licch.lr_s_nodes,
+            "sums": np.zeros((len(self.shards), licch.nb_vids)),
+        })
+        # parameters are views on shared memory during training
+        licch.models = self.arrays["models"]
+        licch.s = self.arrays["s"]
+        licch.global_model = self.arrays["glob"]
+        self.executor = ProcessPoolExecutor(
+            len(self.shards),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shard_worker,
+            initargs=(specs,),
+        )
+        return self
+
+    def __exit__(self, *exc):
+        licch = self.licch
+        licch.models = np.array(self.arrays["models"])
+        licch.s = np.array(self.arrays["s"])
+        licch.global_model = np.array(self.arrays["glob"])
+        self.executor.shutdown()
+        self.arrays = None  # no more views on buffers
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
+
+    def fit_step(self, lr_node):
+        """Does the local step of all shards
+
+        lr_node (float): learning rate of local scores
+
+        Returns:
+            (float, float, float): fitting, s and generalisation losses
+        """
+        all_losses = self.executor.map(
+            _fit_shard, self.shards, [lr_node] * len(self.shards)
+        )
+        return tuple(np.sum(list(all_losses), axis=0))
+
+    def gen_sums(self):
+        """Sums generalisation derivatives of all nodes for each video
+
+        Returns:
+            (float): generalisation loss
+            (float array): sums, see licchavi_numpy._gen_terms()
+        """
+        gen_losses = self.executor.map(
+            _gen_shard, range(len(self.shards)), self.shards
+        )
+        gen_loss = sum(gen_losses)
+        return gen_loss, self.arrays["sums"].sum(axis=0)
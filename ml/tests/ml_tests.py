@@ -1,17 +1,31 @@
 import numpy as np
+import pytest
 import torch
 
 from ml.data_utility import (
     rescale_rating,
     get_all_vids,
-    get_mask,
+    get_pairs_positions,
+    get_vidxs,
+    get_offsets,
     reverse_idxs,
     sort_by_first,
     expand_dic,
-    expand_tens,
+    get_vid_index,
+    save_arrays,
+    load_arrays,
+    load_checkpoint,
+    checkpoint_exists,
+    _global_uncert,
+    _global_uncerts,
+)
+from ml.handle_data import (
+    distribute_data, get_columns, split_criterias
+)
+from ml.losses import (
+    _bbt_loss, _approx_bbt_loss, get_s_loss, models_dist, model_norm, predict,
+    loss_fit_s_gen, loss_gen_reg, _batched_fit_loss, _approx_bbt_deriv
 )
-from ml.handle_data import select_criteria, shape_data, distribute_data
-from ml.losses import _bbt_loss, _approx_bbt_loss, get_s_loss, models_dist, model_norm
 from ml.metrics import (
     extract_grad,
     scalar_product,
@@ -21,9 +35,19 @@ from ml.metrics import (
     check_equilibrium_loc,
     get_uncertainty_loc,
 )
-from ml.licchavi import Licchavi, get_model, get_s
-from ml.dev.fake_data import generate_data
+from ml.licchavi import Licchavi, get_model, get_s, expand_tens
+from ml.licchavi_base import LicchaviBase
+from ml.licchavi_numpy import _solve_local, _solve_global
+from ml.dev.fake_data import (
+    generate_data, generate_columns, load_columns, _get_rd_rates)
+from ml.dev.ml_benchmark import get_configs, compare_results
 from ml.core import _set_licchavi, _train_predict, ml_run
+from ml.history import History
+from ml.sharding import get_shards
+from ml.online import refresh_user
+from ml.monitoring import (
+    timed, set_metric, get_metrics, clear_metrics, format_metrics,
+    export_metrics)
 
 
 """
@@ -67,23 +91,112 @@ def test_rescale_rating():
 
 def test_get_all_vids():
     size = 50
-    input = np.reshape(np.arange(4 * size), (size, 4))
-    assert len(get_all_vids(input)) == 2 * size
+    vids = get_all_vids(np.arange(0, 2 * size, 2), np.arange(1, 2 * size, 2))
+    assert len(vids) == 2 * size
+    assert vids.dtype == np.int64  # IDs are not converted to floats
+
+
+def test_get_pairs_positions():
+    ref_uidxs, ref_vidxs = np.array([0, 0, 1, 3]), np.array([1, 4, 0, 2])
+    positions, found = get_pairs_positions(
+        ref_uidxs, ref_vidxs, np.array([1, 0, 3, 2]), np.array([0, 4, 2, 2]), 5
+    )
+    assert found.tolist() == [True, True, True, False]
+    assert positions[found].tolist() == [2, 1, 3]
+
+
+def test_get_vid_index():
+    order, offsets = get_vid_index(np.array([2, 0, 2, 1, 0]), 4)
+    assert offsets.tolist() == [0, 2, 3, 5, 5]
+    assert order.tolist() == [1, 4, 3, 0, 2]
+
+
+def test_global_uncerts():
+    """vectorized global uncertainty is the same as one video at a time"""
+    rated_vidxs = np.random.permutation(np.repeat(range(20), range(1, 21)))
+    dists = np.random.uniform(0, 8, size=len(rated_vidxs))
+    order, offsets = get_vid_index(rated_vidxs, 20)
+    uncerts = _global_uncerts(dists, order, offsets)
+    for vidx in range(20):
+        values = dists[rated_vidxs == vidx].tolist()
+        assert np.isclose(uncerts[vidx], _global_uncert(values))
+
+
+def test_save_load_arrays(tmp_path):
+    """arrays are saved atomically and memory mapped when loaded"""
+    filename = str(tmp_path / "arrays")
+    arrays = {
+        "a": np.arange(5, dtype=np.int64),
+        "b": np.linspace(0, 1, 6, dtype=np.float32).reshape(2, 3),
+        "c": np.array([], dtype=np.uint64),
+        "d": np.array([3.5]),
+    }
+    save_arrays(arrays, {"criteria": "test"}, filename)
+    assert [p.name for p in tmp_path.iterdir()] == ["arrays"]  # no temp file
+    meta, loaded = load_arrays(filename)
+    assert meta == {"criteria": "test"}
+    for key, arr in arrays.items():
+        assert loaded[key].dtype == arr.dtype
+        assert (loaded[key] == arr).all() and loaded[key].shape == arr.shape
+    assert isinstance(loaded["a"], np.memmap)
+    loaded["a"][0] = 7  # copy on write, file not modified
+    assert load_arrays(filename, mmap=False)[1]["a"][0] == 0
+
+
+def test_load_torch_checkpoint(tmp_path):
+    """checkpoints saved with torch.save() by previous versions are
+    converted and can be resumed"""
+    name = str(tmp_path / "models_weights_test")
+    vids = np.unique(np.array(TEST_DATA)[:7, 1:3].astype(np.float64))
+    models_old = torch.zeros(2, 7)  # dense models, 0 for videos not rated
+    models_old[0, 1], models_old[1, 0], models_old[1, 2] = 0.5, 1, -1
+    loc_models = {
+        np.float64(1): (torch.ones(1) * 2, models_old[1], 3),
+        np.float64(0): (torch.ones(1), models_old[0], 2),
+    }
+    saved_data = (
+        "test", {vid: idx for idx, vid in enumerate(vids)},
+        torch.arange(7.), loc_models,
+    )
+    torch.save(saved_data, name)
+    assert checkpoint_exists(name)
+    criteria, vid_vidx, glob, local_data = load_checkpoint(name)
+    assert criteria == "test"
+    assert vid_vidx == {int(vid): idx for idx, vid in enumerate(vids)}
+    assert (glob == np.arange(7)).all()
+    users, s, rated_offsets, rated_vidxs, models, ages = local_data
+    assert list(users) == [0, 1]
+    assert list(s) == [1, 2] and list(ages) == [2, 3]
+    assert list(rated_offsets) == [0, 1, 3]
+    assert list(rated_vidxs) == [1, 0, 2]
+    assert list(models) == [0.5, 1, -1]
+    licch, _ = _set_licchavi(
+        TEST_DATA, "test", fullpath=name, resume=True, verb=-1,
+        backend="numpy",
+    )
+    assert licch.s[1] == 2
 
 
-def test_get_mask():
-    input = torch.randint(2, (5, 4), dtype=bool)  # boolean tensor
-    input2 = torch.zeros((5, 4), dtype=bool)
-    mask = get_mask(input, input2)
-    assert mask.shape == torch.Size([4])
+def test_get_vidxs():
+    vid_vidx = {100: 0, 300: 1, 200: 2}
+    vidxs = get_vidxs(vid_vidx, np.array([200, 100, 300, 200]))
+    assert vidxs.tolist() == [2, 0, 1, 2]
+
+
+def test_get_offsets():
+    user_ids, offsets = get_offsets(np.array([0, 0, 3, 5, 5, 5]))
+    assert user_ids.tolist() == [0, 3, 5]
+    assert offsets.tolist() == [0, 2, 3, 6]
 
 
 def test_sort_by_first():
     size = 50
-    arr = np.reshape(np.array(range(2 * size, 0, -1)), (size, 2))
-    sorted = sort_by_first(arr)
-    assert (sorted == sort_by_first(sorted)).all()  # second sort has no effect
-    assert isinstance(sorted, np.ndarray)  # output is a numpy array
+    cols = (np.arange(size, 0, -1), np.arange(size), np.linspace(0, 1, size))
+    sorted = sort_by_first(cols)
+    assert (np.diff(sorted[0]) >= 0).all()
+    assert (sorted[1] == np.arange(size)[::-1]).all()  # lines kept together
+    for col, col2 in zip(sorted, sort_by_first(sorted)):
+        assert (col == col2).all()  # second sort has no effect
 
 
 def test_reverse_idx():
@@ -118,43 +231,43 @@ def test_expand_dic():
 
 
 # -------- handle_data.py -------------
-def test_select_criteria():
-    comparison_data = TEST_DATA
-    crit = "test"
-    output = select_criteria(comparison_data, crit)
-    for comp in output:
-        assert len(comp) == 6  # len of each element of output list
-    assert isinstance(output, list)
-    assert len(output) == len(TEST_DATA) - 1  # number of comparisons extracted
-
-
-def test_shape_data():
-    l_ratings = [
-        [0, 100, 101, "test", 100, 0],
-        [0, 100, 101, "test", 50, 0],
-        [0, 100, 101, "test", 0, 0],
-    ]
-    output = shape_data(l_ratings)
-    assert isinstance(output, np.ndarray)
-    assert output.shape == (3, 4)  # output shape
-    assert np.max(abs(output[:, 3])) <= 1  # range of scores
+def test_split_criterias():
+    """one pass on columns gives the same arrays as one pass per criteria"""
+    comparison_data = TEST_DATA + [[3, 100, 104, "test", None, 0]]
+    columns = get_columns(comparison_data)
+    assert columns[0] == ["test", "largely_recommended"]
+    assert columns[1].dtype == np.int64
+    assert get_columns(columns) is columns
+    split = split_criterias(columns, ["test", "largely_recommended", "other"])
+    for crit in ("test", "largely_recommended"):
+        comps = [
+            comp for comp in comparison_data
+            if comp[3] == crit and comp[4] is not None
+        ]
+        users, vid1, vid2, r = split[crit]
+        assert users.dtype == vid1.dtype == vid2.dtype == np.int64
+        assert users.tolist() == [comp[0] for comp in comps]
+        assert vid1.tolist() == [comp[1] for comp in comps]
+        assert vid2.tolist() == [comp[2] for comp in comps]
+        assert r.tolist() == [rescale_rating(comp[4]) for comp in comps]
+    assert split["other"] is None
 
 
 def test_distribute_data():
-    arr = np.array(
-        [
-            [0, 100, 101, 1],
-            [1, 100, 101, -1],
-            [0, 101, 102, 0],
-        ]
+    comps = (
+        np.array([0, 3, 0]),  # comparison 1 is performed by user of id 3
+        np.array([100, 100, 101]),
+        np.array([101, 101, 102]),
+        np.array([1., -1., 0.]),
     )
-    arr[1][0] = 3  # comparison 1 is performed by user or id 3
-    nodes_dic, user_ids, vid_vidx = distribute_data(arr)
-    assert len(nodes_dic) == 2  # number of nodes
-    assert len(nodes_dic[0][0]) == 2  # number of comparisons for user 0
-    assert len(nodes_dic[0][0][0]) == 3  # total number of videos
-    assert len(user_ids) == len(nodes_dic)  # number of users
-    assert len(vid_vidx) == len(nodes_dic[0][0][0])  # total number of videos
+    (vidx1, vidx2, r, offsets), user_ids, vid_vidx = distribute_data(comps)
+    assert len(user_ids) == 2  # number of users
+    assert offsets.tolist() == [0, 2, 3]  # 2 comparisons for user 0
+    assert vidx1.tolist() == [0, 1, 0]  # comparisons sorted by user
+    assert vidx2.tolist() == [1, 2, 1]
+    assert len(r) == len(vidx1)
+    assert len(vid_vidx) == 3  # total number of videos
+    assert user_ids.dtype == np.int64
 
 
 # ------------ losses.py ---------------------
@@ -164,6 +277,60 @@ def test_bbt_loss_approx_bbt_loss():
     assert abs(_bbt_loss(l_t, l_r) - _approx_bbt_loss(l_t, l_r)) <= 0.0001
 
 
+def _bbt_loss_autograd(t, r):
+    """Approximated BBT loss written with torch operators (reference)"""
+    small, big = t.abs() <= 0.01, t.abs() >= 10
+    tt = torch.where(t != 0, t, torch.ones_like(t))
+    loss = torch.where(
+        small, t ** 2 / 6 + np.log(2),
+        torch.where(big, tt.abs() - tt.abs().log(), (2 * tt.sinh() / tt).log())
+    )
+    return (loss + r * t).sum()
+
+
+def test_approx_bbt_loss_gradients():
+    """custom backward matches autograd and finite differences"""
+    t = torch.tensor(
+        [-50, -10.0001, -10, -9.9999, -0.5, -0.01, -0.0099, 0, 1e-8, 0.01,
+         0.0101, 2, 9.9999, 10, 10.0001, 100], dtype=torch.float64,
+    )
+    r = torch.linspace(-1, 1, len(t), dtype=torch.float64)
+    assert torch.autograd.gradcheck(
+        _approx_bbt_loss, (t.clone().requires_grad_(), r.requires_grad_())
+    )
+    t1, t2 = t.clone().requires_grad_(), t.clone().requires_grad_()
+    _approx_bbt_loss(t1, r.detach()).backward()
+    _bbt_loss_autograd(t2, r.detach()).backward()
+    assert torch.allclose(t1.grad, t2.grad, atol=1e-12)
+    assert torch.isclose(t1.grad[7], r[7])  # derivative in 0 is r
+
+
+def test_approx_bbt_loss_boundaries():
+    """loss and derivative are continuous across regions, in float32 too"""
+    for bound in (0.01, 10):
+        t = torch.tensor(
+            [-bound - 1e-6, -bound, -bound + 1e-6,
+             bound - 1e-6, bound, bound + 1e-6], dtype=torch.float64,
+        )
+        r = torch.zeros(6, dtype=torch.float64)
+        losses = torch.stack([_approx_bbt_loss(tt, rr) for tt, rr in zip(
+            t.view(-1, 1), r.view(-1, 1)
+        )])
+        assert (losses[1:3] - losses[0]).abs().max() < 1e-5  # slope < 1
+        assert (losses[4:] - losses[3]).abs().max() < 1e-5
+        derivs = _approx_bbt_deriv(t, r)
+        assert (derivs[1:3] - derivs[0]).abs().max() < 1e-5
+        assert (derivs[4:] - derivs[3]).abs().max() < 1e-5
+        # float32 agrees with float64
+        t32 = t.float().requires_grad_()
+        loss32 = _approx_bbt_loss(t32, r.float())
+        loss32.backward()
+        assert loss32.dtype == torch.float32
+        assert t32.grad.dtype == torch.float32
+        assert torch.isclose(loss32.double(), losses.sum(), rtol=1e-6)
+        assert torch.allclose(t32.grad.double(), derivs, rtol=1e-5, atol=1e-7)
+
+
 def test_get_s_loss():
     l_s = [0.4, 0.5, 0.67, 0.88, 0.1, 1.2]
     results = [0.9963, 0.8181, 0.6249, 0.515, 2.3076, 0.5377]
@@ -173,6 +340,12 @@ def test_get_s_loss():
         assert abs(output - res) <= 0.001
 
 
+def test_predict():
+    model = torch.tensor([0.5, -1, 2])
+    output = predict(torch.tensor([2, 0, 2]), model)
+    assert output.tolist() == [2, 0.5, 2]
+
+
 def test_models_dist():
     model1 = torch.tensor([1, 2, 4, 7])
     model2 = torch.tensor([3, -2, -5, 9.2])
@@ -186,6 +359,24 @@ def test_model_norm():
     assert model_norm(model) == 73.36  # squared l2 norm
 
 
+def test_batched_losses():
+    """batched losses are equal to the sum of the losses of each node"""
+    licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1)
+    licch.train(2)
+    fit, s, gen = loss_fit_s_gen(licch)
+    gen2, _ = loss_gen_reg(licch)
+    fit_sum, s_sum, gen_sum = 0, 0, 0
+    for uid in licch.nodes:
+        fit_node, s_node, gen_node = loss_fit_s_gen(licch, uid=uid)
+        fit_sum += fit_node
+        s_sum += s_node
+        gen_sum += gen_node
+    assert abs(fit - fit_sum) < 1e-5
+    assert abs(s - s_sum) < 1e-5
+    assert abs(gen - gen_sum) < 1e-5
+    assert abs(gen2 - gen_sum) < 1e-5
+
+
 # --------- licchavi.py ------------
 def test_Licchavi():
     licch = Licchavi(0, {}, "test")
@@ -193,6 +384,16 @@ def test_Licchavi():
     # TODO add more tests here
 
 
+def test_incomplete_backend():
+    """a backend missing training steps can't be instantiated"""
+    class Incomplete(LicchaviBase):
+        def _fit_step(self):
+            return 0, 0, 0
+
+    with pytest.raises(TypeError):
+        Incomplete(0, {}, "test")
+
+
 def test_get_model():
     model = get_model(6)
     assert (model == torch.zeros(6)).all()
@@ -250,6 +451,19 @@ def test_get_uncertainty_loc():
             assert 0 <= uncert <= 10
 
 
+def test_get_uncertainty_loc_hessian():
+    """closed form uncertainty is the autograd second derivative"""
+    licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1)
+    licch.train(3, -1)
+    uncert_loc = torch.cat(get_uncertainty_loc(licch))
+    hess = torch.autograd.functional.hessian(
+        lambda models: _batched_fit_loss(licch, models, licch.s.detach()),
+        licch.models.detach().double(),
+    )
+    expected = hess.diagonal() ** (-0.5)
+    assert torch.allclose(uncert_loc.double(), expected, rtol=1e-4)
+
+
 def test_check_equilibrium_glob():
     """checks equilibrium at initialisation"""
     licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1)
@@ -264,6 +478,66 @@ def test_check_equilibrium_loc():
     assert 0.4 <= eq <= 1
 
 
+def _equilibrium_loc(licch, epsilon):
+    """Exact fraction of local scores at equilibrium, one by one
+
+    Fitting losses of nodes are independent, so one score of each node
+    is moved at a time
+    """
+    offsets = licch.rated_offsets
+    ranks = np.arange(offsets[-1]) - np.repeat(offsets[:-1], np.diff(offsets))
+    equilibrated = torch.zeros(offsets[-1], dtype=torch.bool)
+    for rank in range(ranks.max() + 1):
+        moved = torch.as_tensor(ranks == rank)
+        derivs = []
+        for incr in (epsilon, -epsilon):
+            licch._zero_opt()
+            with torch.no_grad():
+                licch.models[moved] += incr
+            fit_loss, _, gen_loss = loss_fit_s_gen(licch)
+            (fit_loss + gen_loss).backward()
+            derivs.append(licch.models.grad[moved] * incr)
+            with torch.no_grad():
+                licch.models[moved] -= incr
+        equilibrated[moved] = (derivs[0] > 0) & (derivs[1] > 0)
+    return equilibrated.double().mean().item()
+
+
+def test_check_convergence():
+    """convergence monitor matches equilibrium checks, for both backends"""
+    _, _, _, comps_fake = generate_data(20, 8, 10, dens=0.5)
+    licchs = [
+        _set_licchavi(comps_fake, "test", verb=-1, backend=backend)[0]
+        for backend in ("torch", "numpy")
+    ]
+    fracs = []
+    for licch in licchs:
+        licch.train(12)
+        fracs.append(licch._check_convergence(0.1))
+    assert np.allclose(fracs[0], fracs[1], atol=0.02)
+    frac_loc, frac_glob = fracs[0]
+    assert abs(frac_glob - check_equilibrium_glob(0.1, licchs[0])) <= 0.05
+    assert abs(frac_loc - _equilibrium_loc(licchs[0], 0.1)) <= 0.05
+
+
+def test_sample_convergence():
+    """monitored scores are the ones of sampled nodes and videos"""
+    _, _, _, comps_fake = generate_data(20, 8, 10, dens=0.5)
+    licch, _ = _set_licchavi(comps_fake, "test", verb=-1, backend="numpy")
+    licch.conv_sample = 0.5
+    (loc, loc_uidxs, loc_vidxs, comps), (glob, pos, seg, pos_uidxs) = (
+        licch._sample_convergence()
+    )
+    assert (licch.rated_uidxs[loc] == loc_uidxs).all()
+    assert (licch.rated_vidxs[loc] == loc_vidxs).all()
+    assert set(licch.comp_uidxs[comps]) == set(loc_uidxs)
+    assert (licch.rated_vidxs[pos] == glob[seg]).all()
+    assert (licch.rated_uidxs[pos] == pos_uidxs).all()
+    licch.conv_sample = 0
+    licch.train(2)
+    assert licch._check_convergence(0.1) == (1.0, 1.0)
+
+
 # --------- core.py ------------
 def test_set_licchavi():
     licch, users_ids = _set_licchavi(TEST_DATA, "test")
@@ -280,15 +554,122 @@ def test_set_licchavi():
     assert licch.global_model.sum() == 0
 
 
+def test_load_and_update(tmp_path):
+    """resumed models keep saved parameters of known users"""
+    fullpath = str(tmp_path / "models_test")
+    licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1)
+    licch.train(2)
+    licch.save_models(fullpath)
+    new_data = TEST_DATA + [
+        [5, 100, 106, "test", 70, 0],  # new user, new video
+        [2, 104, 107, "test", 20, 0],  # known user, new video
+    ]
+    licch2, users_ids = _set_licchavi(
+        new_data, "test", fullpath=fullpath, resume=True, verb=-1
+    )
+    assert list(users_ids) == [0, 1, 2, 5, 7]
+    assert licch2.nb_vids == licch.nb_vids + 2
+    for uid, node in licch.nodes.items():
+        node2 = licch2.nodes[uid]
+        assert node2.s == node.s
+        scores2 = dict(zip(node2.vids, node2.model.tolist()))
+        for vid, score in zip(node.vids, node.model.tolist()):
+            assert scores2[vid] == score
+        assert node2.age == node.age == 2
+    assert len(licch2.nodes[2].model) == 3  # videos 104, 105 and 107
+    assert licch2.nodes[2].model[-1] == 0
+    assert licch2.nodes[5].age == 0
+    assert licch2.nodes[5].s == 1
+    assert (licch2.nodes[5].model == 0).all()
+
+
+def test_incremental_training(tmp_path):
+    """only nodes whose comparisons changed since save are trained"""
+    fullpath = str(tmp_path / "models_test")
+    new_data = TEST_DATA[:4] + [
+        [1, 104, 105, "test", 60, 0],  # edited comparison
+        [2, 104, 105, "test", 100, 0],
+        [5, 100, 106, "test", 70, 0],  # new user
+    ] + TEST_DATA[6:]
+    for backend in ("torch", "numpy"):
+        licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1, backend=backend)
+        licch.train(3)
+        licch.save_models(fullpath)
+        licch2, users_ids = _set_licchavi(
+            new_data, "test", fullpath=fullpath, resume=True, verb=-1,
+            backend=backend,
+        )
+        assert list(users_ids) == [0, 1, 2, 5, 7]
+        assert list(licch2.touched) == [False, True, False, True, False]
+        _, s_old, models_old, _ = licch2.get_state()
+        licch2.train(5, incremental=True)
+        _, s, models, _ = licch2.get_state()
+        assert licch2.masks is None
+        for uidx in range(len(users_ids)):
+            loc = slice(*licch2.rated_offsets[uidx : uidx + 2])
+            changed = (models[loc] != models_old[loc]).any()
+            assert changed == licch2.touched[uidx]
+            assert (s[uidx] != s_old[uidx]) == licch2.touched[uidx]
+        # no comparison changed, no score changes
+        licch.train(30)
+        licch.save_models(fullpath)
+        licch3, _ = _set_licchavi(
+            TEST_DATA, "test", fullpath=fullpath, resume=True, verb=-1,
+            backend=backend,
+        )
+        assert not licch3.touched.any()
+        state_old = licch3.get_state()
+        licch3.train(5, incremental=True)
+        for arr, arr_old in zip(licch3.get_state(), state_old):
+            assert np.allclose(arr, arr_old, atol=1e-6)
+
+
+def test_refresh_user(tmp_path):
+    """local scores of one user are trained, global scores are fixed"""
+    path = str(tmp_path / "models")
+    licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1, backend="numpy")
+    licch.train(20)
+    licch.save_models(path + "_test")
+    glob_old = load_checkpoint(path + "_test")[2].copy()
+    user_data = [comp for comp in TEST_DATA if comp[0] == 1] + [
+        [1, 102, 106, "test", 100, 0],  # new comparison, new video
+    ]
+    loc = refresh_user(user_data, 1, ["test", "reliability"], path=path)
+    scores = {vid: score for _, vid, _, score, _ in loc}
+    assert {(uid, crit) for uid, _, crit, _, _ in loc} == {(1, "test")}
+    assert set(scores) == {100, 101, 102, 104, 105, 106}
+    # same rating as (100, 101), same direction
+    assert (scores[106] > scores[102]) == (scores[101] > scores[100])
+    assert (load_checkpoint(path + "_test")[2] == glob_old).all()
+    new_user = refresh_user([[9, 100, 966, "test", 0, 0]], 9, ["test"], path)
+    assert {(uid, vid) for uid, vid, _, _, _ in new_user} == {
+        (9, 100), (9, 966)
+    }
+    # same solution as the node solved among all others, global scores fixed
+    user_data = [comp for comp in TEST_DATA if comp[0] == 1]
+    loc = refresh_user(user_data, 1, ["test"], path=path)
+    licch._solve_local(1e-5, 500)
+    uidxs, vids, scores = licch.output_flat_scores()[1]
+    mine = uidxs == list(licch.users).index(1)
+    expected = dict(zip(vids[mine].tolist(), scores[mine].tolist()))
+    for _, vid, _, score, _ in loc:
+        assert abs(score - expected[vid]) < 0.01  # rounded scores
+
+
 def test_train_predict():
     licch, users_ids = _set_licchavi(TEST_DATA, "test", verb=-1)
     glob, loc, _ = _train_predict(licch, 1, verb=-1)
-    assert len(glob) == len(loc) == 2  # good output shape
-    assert len(users_ids) == len(loc[1])  # good nb of users
-    for vids, scores in zip(*loc):
-        assert len(vids) == len(scores)  # matching lengths
-        assert type(vids) == np.ndarray  # type
-        assert type(scores) == torch.Tensor  # type
+    assert len(glob) == 2 and len(loc) == 3  # good output shape
+    assert len(glob[0]) == len(glob[1]) == licch.nb_vids
+    uidxs, vids, scores = loc
+    assert len(uidxs) == len(vids) == len(scores)  # matching lengths
+    assert set(uidxs) == set(range(len(users_ids)))  # good nb of users
+    (_, _), per_node = licch.output_scores()
+    for uidx, (node_vids, node_scores) in enumerate(zip(*per_node)):
+        assert (vids[uidxs == uidx] == node_vids).all()  # same as per node
+        assert (scores[uidxs == uidx] == node_scores.detach().numpy()).all()
+        assert type(node_vids) == np.ndarray  # type
+        assert type(node_scores) == torch.Tensor  # type
 
 
 def test_ml_run():
@@ -307,6 +688,322 @@ def test_ml_run():
     assert len(contributor_scores) == nb_users * vids_per_user
 
 
+def test_numpy_backend_gradients():
+    """analytic gradients of numpy backend match torch autograd"""
+    licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1)
+    licch_np, _ = _set_licchavi(TEST_DATA, "test", verb=-1, backend="numpy")
+    licch.train(2)
+    with torch.no_grad():  # moving parameters away from default ones
+        licch.models += torch.linspace(-1, 1, len(licch.models))
+    licch_np.models = licch.models.detach().numpy().copy()
+    licch_np.s = licch.s.detach().numpy().copy()
+    licch_np.global_model = licch.global_model.detach().numpy().copy()
+
+    licch._zero_opt()
+    fit_loss, s_loss, gen_loss = loss_fit_s_gen(licch)
+    (fit_loss + s_loss + gen_loss).backward()
+    losses, grad_models, grad_s = licch_np._local_loss_grad()
+    assert np.allclose(losses, [fit_loss.item(), s_loss.item(), gen_loss.item()])
+    assert np.allclose(grad_models, licch.models.grad, atol=1e-6)
+    assert np.allclose(grad_s, licch.s.grad, atol=1e-6)
+
+    licch._zero_opt()
+    gen_loss, reg_loss = loss_gen_reg(licch)
+    (gen_loss + reg_loss).backward()
+    losses, grad_glob = licch_np._global_loss_grad()
+    assert np.allclose(losses, [gen_loss.item(), reg_loss.item()])
+    assert np.allclose(grad_glob, licch.global_model.grad, atol=1e-6)
+
+
+def test_numpy_backend():
+    """numpy backend gives the same outputs as torch backend"""
+    _, _, _, comps_fake = generate_data(10, 5, 6, dens=0.8)
+    outputs = [
+        ml_run(
+            comps_fake,
+            epochs=5,
+            criterias=["test"],
+            save=False,
+            verb=-1,
+            compute_uncertainty=True,
+            backend=backend,
+        )[:2]
+        for backend in ("torch", "numpy")
+    ]
+    (glob_torch, loc_torch), (glob_np, loc_np) = outputs
+    assert len(glob_torch) == len(glob_np)
+    assert len(loc_torch) == len(loc_np)
+    for out_torch, out_np in zip(glob_torch + loc_torch, glob_np + loc_np):
+        assert out_torch[:-2] == out_np[:-2]  # same IDs and criteria
+        assert abs(out_torch[-2] - out_np[-2]) <= 0.011  # score
+        assert abs(out_torch[-1] - out_np[-1]) <= 0.011  # uncertainty
+
+
+def test_sharded_training():
+    """sharded local steps give the same parameters as one process"""
+    columns = generate_columns(40, 30, 8, seed=5)
+    # 3 nodes with 10, 1 and 1 comparisons
+    shards = get_shards(np.array([0, 10, 11, 12]), np.array([0, 3, 5, 7]), 3)
+    assert shards == [((0, 1), (0, 10), (0, 3)), ((1, 3), (10, 12), (3, 7))]
+    states = []
+    for shards in (1, 3):
+        licch, _ = _set_licchavi(columns, "test", verb=-1, backend="numpy")
+        licch.shards = shards
+        licch.train(10)
+        assert licch.shard_pool is None
+        states.append(licch.get_state())
+    for arr, arr_sharded in zip(*states):
+        assert np.allclose(arr, arr_sharded, atol=1e-5)
+
+
+def test_train_lbfgs():
+    """L-BFGS reaches a lower loss than gradient descent, for both backends"""
+    for backend in ("torch", "numpy"):
+        losses = {}
+        for solver in ("sgd", "lbfgs"):
+            licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1, backend=backend)
+            licch.solver = solver
+            licch.history.level = "full"
+            licch.train(30)
+            assert 0 < licch.nb_iters <= 30
+            assert licch.nb_evals >= licch.nb_iters
+            assert len(licch.history["fit"]) == licch.nb_iters
+            assert (licch.ages == licch.nb_iters).all()
+            losses[solver] = sum(licch._full_loss_grad(0)[0])
+        assert losses["lbfgs"] <= losses["sgd"] + 1e-3
+
+
+def test_train_block():
+    """block solver reaches a lower loss than gradient descent, for both
+    backends, and only moves the nodes trained"""
+    for backend in ("torch", "numpy"):
+        losses = {}
+        for solver in ("sgd", "block"):
+            licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1, backend=backend)
+            licch.solver = solver
+            licch.train(30)
+            losses[solver] = sum(licch._full_loss_grad(0)[0])
+        assert losses["block"] <= losses["sgd"] + 1e-3
+    licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1, backend="numpy")
+    licch.train(5)
+    models, s = licch.models.copy(), licch.s.copy()
+    nodes = np.zeros(len(s), dtype=bool)
+    nodes[1] = True
+    data = (
+        licch.r, licch.pos1, licch.pos2,
+        licch.comp_uidxs, licch.rated_uidxs, licch.rated_vidxs,
+    )
+    kink_signs = _solve_local(
+        models, s, licch.global_model, licch.weights, data, 1e-6, 100, nodes
+    )[1]
+    assert (np.abs(kink_signs) <= 1).all()
+    assert (kink_signs[~nodes[licch.rated_uidxs]] == 0).all()
+    moved = nodes[licch.rated_uidxs]
+    assert (models[~moved] == licch.models[~moved]).all()
+    assert (s[~nodes] == licch.s[~nodes]).all()
+    assert not np.allclose(models[moved], licch.models[moved])
+    # solved problems are not changed by more iterations
+    models_solved, s_solved = models.copy(), s.copy()
+    _solve_local(
+        models, s, licch.global_model, licch.weights, data, 1e-6, 100, nodes
+    )
+    assert np.allclose(models, models_solved, atol=1e-4)
+    assert np.allclose(s, s_solved, atol=1e-4)
+
+
+def test_solve_global():
+    """exact global scores are the minimums of their loss terms"""
+    models = np.array([-1, 0.5, 0.5, 2, 0.3, -0.2, 3], dtype=np.float32)
+    w_rated = np.array([1, 1, 2, 1, 0.5, 3, 1])
+    rated_vidxs = np.array([0, 0, 0, 0, 1, 1, 3])
+    grid = np.linspace(-4, 4, 8001)
+    for w0 in (0, 0.5, 1, 10):
+        glob = _solve_global(models, w_rated, rated_vidxs, 4, w0)
+        assert glob[2] == 0  # not rated
+        for vidx in range(4):
+            rated = rated_vidxs == vidx
+            dists = np.abs(models[rated][:, None] - grid)
+            losses = (w_rated[rated][:, None] * dists).sum(0) + w0 * grid ** 2
+            loss = (w_rated[rated] * np.abs(models[rated] - glob[vidx])).sum()
+            assert loss + w0 * glob[vidx] ** 2 <= losses.min() + 1e-6
+    # same global scores for both backends, at equilibrium after each epoch
+    states = []
+    for backend in ("torch", "numpy"):
+        licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1, backend=backend)
+        licch.glob_update = "exact"
+        licch.train(10)
+        assert licch._check_convergence(1e-3)[1] == 1
+        states.append(licch.output_flat_scores()[0][1])
+    assert np.allclose(*states, atol=1e-5)
+
+
+def test_history():
+    """metrics are collected depending on history level"""
+    hist = History(level="sampled", freq=3)
+    hist.reserve(2)  # grows when needed
+    for epoch in range(10):
+        if hist.wants(epoch):
+            hist.record(epoch, fit=epoch, error_glob=1)
+    assert list(hist.epochs) == [0, 3, 6, 9]
+    assert list(hist["fit"]) == [0, 3, 6, 9]
+    assert np.isnan(hist["s"]).all()
+    assert "error_glob" in hist
+    for level, size in (("off", 0), ("sampled", 2), ("full", 20)):
+        licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1)
+        licch.history.level, licch.history.freq = level, 7
+        licch.train(20)
+        assert len(licch.history.epochs) == size
+        assert all([len(v) == size for v in licch.history.values()])
+
+
+def test_monitoring(tmp_path):
+    """metrics are recorded and exported in Prometheus text format"""
+    clear_metrics()
+    with timed("fetch"):
+        set_metric("nodes", 3, criteria="test")
+    metrics = get_metrics()
+    assert metrics[("nodes", (("criteria", "test"),))] == 3
+    assert ("stage_seconds", (("criteria", "all"), ("stage", "fetch"))) in metrics
+    filename = str(tmp_path / "metrics.prom")
+    export_metrics(textfile=filename)
+    with open(filename) as f:
+        text = f.read()
+    assert text == format_metrics()
+    assert "# TYPE ml_train_nodes gauge" in text
+    assert 'ml_train_nodes{criteria="test"} 3.0' in text
+    ml_run(TEST_DATA, epochs=2, criterias=["test"], save=False, verb=-1)
+    metrics = get_metrics()
+    assert ("stage_seconds", (("criteria", "all"), ("stage", "shape"))) in metrics
+    for stage in ("distribute", "train"):
+        assert ("stage_seconds", (("criteria", "test"), ("stage", stage))) in metrics
+    assert metrics[("comparisons", (("criteria", "test"),))] == 7
+    assert ("peak_memory_bytes", (("criteria", "all"),)) in metrics
+    clear_metrics()
+
+
+def test_profile_epoch(tmp_path, monkeypatch):
+    """the epoch asked is traced once, for both backends"""
+    monkeypatch.setattr("ml.monitoring.PROFILE_FOLDER", str(tmp_path) + "/")
+    for backend, ext in (("torch", ".json"), ("numpy", ".prof")):
+        licch, _ = _set_licchavi(TEST_DATA, "test", verb=-1, backend=backend)
+        licch.profile_epoch = 2
+        licch.train(3)
+        assert licch.profiled
+        assert (tmp_path / f"test_epoch2{ext}").exists()
+
+
+def test_get_rd_rates():
+    """random ratings are in [-1, 1] and favor the best video"""
+    size = 10000
+    a, s = np.zeros(size), np.ones(size)
+    for t, sign in ((2, -1), (0, 0), (-2, 1), (1e-9, 0)):
+        rates = _get_rd_rates(np.full(size, t), a, s)
+        assert (np.abs(rates) <= 1).all()
+        assert np.sign(round(rates.mean(), 1)) == sign
+
+
+def test_generate_columns(tmp_path):
+    """fake columns are reproducible, can be saved and are trainable"""
+    filename = str(tmp_path / "fake.bin")
+    columns = generate_columns(
+        30, 10, 6, criterias=["test", "other"], seed=3, filename=filename
+    )
+    assert columns[0] == ["test", "other"]
+    assert len(columns[1]) == 2 * 10 * 14  # 4 + 4 + 3 + 2 + 1 per user
+    assert np.array_equal(columns[4], np.repeat([0, 1], 140))
+    assert ((columns[5] >= 0) & (columns[5] <= 100)).all()
+    assert (columns[2] != columns[3]).all()
+    for col, col_seed, col_file in zip(
+        columns, generate_columns(30, 10, 6, ["test", "other"], seed=3),
+        load_columns(filename),
+    ):
+        assert np.array_equal(col, col_seed) and np.array_equal(col, col_file)
+    glob, loc = ml_run(columns, 2, ["test", "other"], save=False, verb=-1)
+    assert len(glob) <= 2 * 30 and len(loc) == 2 * 10 * 6
+    _, loc_gt, _, comps = generate_data(30, 10, 6, seed=3)
+    assert comps == generate_data(30, 10, 6, seed=3)[3]
+    assert all(len({vid for vid, _ in node}) == 6 for node in loc_gt)
+
+
+def test_compare_results():
+    """only metrics increasing more than their threshold are regressions"""
+    configs = get_configs({
+        "users": [10, 20], "videos": [5], "vids_per_user": [3],
+        "criterias": [1], "backend": ["numpy"],
+    })
+    assert len(configs) == 2
+    base = {"epoch_seconds": 1.0, "peak_memory_bytes": 100}
+    baseline = {"results": [{**config, **base} for config in configs]}
+    results = {"results": [
+        {**configs[0], "epoch_seconds": 1.1, "peak_memory_bytes": 100},
+        {**configs[1], "epoch_seconds": 1.5, "peak_memory_bytes": 90},
+    ]}
+    thresholds = {"epoch_seconds": 0.2, "peak_memory_bytes": 0.1}
+    regressions = compare_results(results, baseline, thresholds)
+    assert len(regressions) == 1
+    assert regressions[0]["config"] == configs[1]
+    assert regressions[0]["metric"] == "epoch_seconds"
+    assert regressions[0]["ratio"] == 1.5
+
+
+def test_ml_run_parallel():
+    """criterias trained in worker processes give the same outputs"""
+    comparison_data = []
+    for crit in ["test", "reliability"]:
+        _, _, _, comps_fake = generate_data(5, 3, 5, dens=0.999)
+        comparison_data += [comp[:3] + [crit] + comp[4:] for comp in comps_fake]
+    outputs = [
+        ml_run(
+            comparison_data,
+            epochs=3,
+            criterias=["test", "reliability", "pedagogy"],
+            save=False,
+            verb=-1,
+            backend="numpy",
+            workers=workers,
+        )[:2]
+        for workers in (1, 2)
+    ]
+    assert outputs[0] == outputs[1]
+    assert len(outputs[0][0]) > 0
+
+
+def test_ml_run_multi_criteria():
+    """all criterias in one Licchavi, compatible with one criteria training"""
+    comparison_data = []
+    for crit in ["test", "reliability"]:
+        _, _, _, comps_fake = generate_data(5, 3, 5, dens=0.999)
+        comparison_data += [comp[:3] + [crit] + comp[4:] for comp in comps_fake]
+    criterias = ["test", "reliability", "pedagogy"]
+    for backend in ("torch", "numpy"):
+        outputs = [
+            ml_run(
+                comparison_data,
+                epochs=3,
+                criterias=criterias,
+                save=True,
+                verb=-1,
+                compute_uncertainty=True,
+                backend=backend,
+                multi_criteria=multi,
+            )[:2]
+            for multi in (False, True)
+        ]
+        assert outputs[0] == outputs[1]
+        # resuming from checkpoints saved by the other training mode
+        for multi in (False, True):
+            ml_run(
+                comparison_data, 3, criterias, save=True, verb=-1,
+                backend=backend, multi_criteria=multi
+            )
+            resumed = ml_run(
+                comparison_data, 0, criterias, resume=True, save=False,
+                verb=-1, compute_uncertainty=True, backend=backend,
+                multi_criteria=not multi
+            )[:2]
+            assert resumed == outputs[0]
+
+
 # ======= scores quality tests =============
 def _id_score_assert(id, score, glob):
     """assert that the video with this -id has this -score"""
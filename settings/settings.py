@@ -215,6 +215,10 @@ LOGIN_URL = server_settings.get('LOGIN_URL', '')
 CORS_ALLOWED_ORIGINS = server_settings.get("CORS_ALLOWED_ORIGINS", [])
 CORS_ALLOW_CREDENTIALS = server_settings.get("CORS_ALLOW_CREDENTIALS", False)
 
+# refresh the contributor's scores from the last ml checkpoints after each
+# comparison submitted (see ml/online.py)
+ML_ONLINE_REFRESH = server_settings.get("ML_ONLINE_REFRESH", False)
+
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
     # or allow read-only access for unauthenticated users.
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-16 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_rename_userpreferences_userpreference'),
+        ('tournesol', '0011_alter_comparison_datetime_lastedit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContributorScoresRefresh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('datetime_add', models.DateTimeField(auto_now_add=True, help_text='Time the refresh was requested')),
+                ('user', models.OneToOneField(help_text='Contributor whose scores must be refreshed', on_delete=django.db.models.deletion.CASCADE, related_name='scores_refresh', to='core.user')),
+            ],
+        ),
+    ]
@@ -601,6 +601,27 @@ class ContributorRatingCriteriaScore(models.Model):
         return f"{self.contributor_rating}/{self.criteria}/{self.score}"
 
 
+class ContributorScoresRefresh(models.Model):
+    """
+    Pending refresh of the personal scores of a contributor, one at most
+    per contributor, consumed by `ml_train --refresh-pending` (see
+    ml/online.py).
+    """
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name="scores_refresh",
+        help_text="Contributor whose scores must be refreshed",
+    )
+    datetime_add = models.DateTimeField(
+        auto_now_add=True, help_text="Time the refresh was requested"
+    )
+
+    def __str__(self):
+        return f"{self.user}@{self.datetime_add}"
+
+
 class VideoRatingThankYou(models.Model):
     """Thank you for recommendations."""
 
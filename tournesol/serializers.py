@@ -2,13 +2,17 @@
 Serializer used by Tournesol's API
 """
 
+from django.conf import settings
 from django.db import transaction
 from django.db.models import ObjectDoesNotExist
 
 from rest_framework import serializers
 from rest_framework.serializers import Serializer, ModelSerializer
 
-from .models import Comparison, ComparisonCriteriaScore, Video, VideoRateLater, VideoCriteriaScore
+from .models import (
+    Comparison, ComparisonCriteriaScore, ContributorScoresRefresh, Video, VideoRateLater,
+    VideoCriteriaScore
+)
 
 
 class VideoSerializer(ModelSerializer):
@@ -76,6 +80,20 @@ class ComparisonCriteriaScoreSerializer(ModelSerializer):
         fields = ["criteria", "score", "weight"]
 
 
+def _refresh_contributor_scores(user_id):
+    """
+    Request a refresh of the contributor's scores, if ML_ONLINE_REFRESH is
+    set.
+
+    A pending refresh is saved with the comparison, at most one per
+    contributor, and done by the `ml_train --refresh-pending` consumer, so
+    the request doesn't wait for it and the ml isn't loaded by the server.
+    """
+    if not settings.ML_ONLINE_REFRESH:
+        return
+    ContributorScoresRefresh.objects.get_or_create(user_id=user_id)
+
+
 class ComparisonSerializerMixin:
     def reverse_criteria_scores(self, criteria_scores):
         opposite_scores = criteria_scores.copy()
@@ -143,6 +161,7 @@ class ComparisonSerializer(ComparisonSerializerMixin, ModelSerializer):
                 **criteria_score
             )
 
+        _refresh_contributor_scores(comparison.user_id)
         return comparison
 
 
@@ -211,4 +230,5 @@ class ComparisonUpdateSerializer(ComparisonSerializerMixin, ModelSerializer):
         for criteria_score in validated_data.pop("criteria_scores"):
             instance.criteria_scores.create(**criteria_score)
 
+        _refresh_contributor_scores(instance.user_id)
         return instance
@@ -2,14 +2,14 @@ from copy import deepcopy
 import datetime
 
 from django.db.models import ObjectDoesNotExist, Q
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from rest_framework import status
 from rest_framework.test import APIClient
 
 from core.models import User
-from ..models import Video, Comparison
+from ..models import Video, Comparison, ContributorScoresRefresh
 
 
 class ComparisonApiTestCase(TestCase):
@@ -524,3 +524,62 @@ class ComparisonApiTestCase(TestCase):
         self.assertEqual(result_comparison1["video_b"]["video_id"], comparison1.video_2.video_id)
         self.assertEqual(result_comparison2["video_a"]["video_id"], comparison2.video_1.video_id)
         self.assertEqual(result_comparison2["video_b"]["video_id"], comparison2.video_2.video_id)
+
+    @override_settings(ML_ONLINE_REFRESH=True)
+    def test_online_refresh_on_create_and_update(self):
+        """
+        With ML_ONLINE_REFRESH, creating or updating a comparison requests
+        a refresh of the contributor's scores, one at most per contributor.
+        """
+        client = APIClient()
+        user = User.objects.get(username=self._user)
+        client.force_authenticate(user=user)
+        data = deepcopy(self.non_existing_comparison)
+
+        response = client.post(
+            reverse("tournesol:comparisons_me_list"), data, format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            list(ContributorScoresRefresh.objects.values_list("user", flat=True)),
+            [user.id]
+        )
+
+        response = client.put(
+            reverse(
+                "tournesol:comparisons_me_detail",
+                args=[self._video_id_01, self._video_id_02],
+            ),
+            {"criteria_scores": data["criteria_scores"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(ContributorScoresRefresh.objects.count(), 1)
+
+        ContributorScoresRefresh.objects.all().delete()  # refresh done
+        response = client.put(
+            reverse(
+                "tournesol:comparisons_me_detail",
+                args=[self._video_id_01, self._video_id_02],
+            ),
+            {"criteria_scores": data["criteria_scores"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(ContributorScoresRefresh.objects.count(), 1)
+
+    @override_settings(ML_ONLINE_REFRESH=False)
+    def test_no_online_refresh_by_default(self):
+        """
+        Without ML_ONLINE_REFRESH, no refresh is requested.
+        """
+        client = APIClient()
+        user = User.objects.get(username=self._user)
+        client.force_authenticate(user=user)
+        data = deepcopy(self.non_existing_comparison)
+
+        response = client.post(
+            reverse("tournesol:comparisons_me_list"), data, format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(ContributorScoresRefresh.objects.exists())
@@ -0,0 +1,335 @@
+from unittest.mock import patch
+
+import numpy as np
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from core.models import User
+from ml.handle_data import get_columns
+from ml.management.commands.ml_train import (
+    _LinesFile, _publish_contributor_scores, _refresh_pending_once, _to_columns, fetch_data,
+    save_data
+)
+from ..models import (
+    Comparison, ComparisonCriteriaScore, ContributorRating, ContributorRatingCriteriaScore,
+    ContributorScoresRefresh, Video, VideoCriteriaScore
+)
+
+COLUMNS_DTYPES = [np.int64] * 4 + [np.float64]
+
+
+class RefreshPendingTestCase(TestCase):
+    """
+    TestCase of the consumer of pending refreshes of contributors' scores.
+    """
+
+    _user = "username"
+    _other = "other_username"
+
+    def setUp(self):
+        self.user = User.objects.create(username=self._user)
+        self.other = User.objects.create(username=self._other)
+
+    @patch("ml.management.commands.ml_train.refresh_contributor")
+    def test_pending_refreshes_are_consumed(self, refresh):
+        """
+        Pending refreshes are done oldest first and deleted, a failed
+        refresh doesn't stop the others.
+        """
+        ContributorScoresRefresh.objects.create(user=self.other)
+        ContributorScoresRefresh.objects.create(user=self.user)
+        refresh.side_effect = [OSError, None]
+
+        self.assertEqual(_refresh_pending_once(["reliability"]), 2)
+        self.assertEqual(
+            [call.args for call in refresh.call_args_list],
+            [(self.other.id, ["reliability"]), (self.user.id, ["reliability"])]
+        )
+        self.assertFalse(ContributorScoresRefresh.objects.exists())
+        self.assertEqual(_refresh_pending_once(["reliability"]), 0)
+
+    @patch("ml.management.commands.ml_train.refresh_contributor")
+    def test_refresh_requested_during_refresh_is_kept(self, refresh):
+        """
+        A comparison submitted during the refresh of its contributor
+        requests a new refresh.
+        """
+        ContributorScoresRefresh.objects.create(user=self.user)
+        refresh.side_effect = (
+            lambda user_id, criterias: ContributorScoresRefresh.objects.create(
+                user_id=user_id
+            )
+        )
+
+        self.assertEqual(_refresh_pending_once(["reliability"]), 1)
+        self.assertEqual(
+            list(ContributorScoresRefresh.objects.values_list("user", flat=True)),
+            [self.user.id]
+        )
+
+
+class LinesFileTestCase(SimpleTestCase):
+    """
+    TestCase of the file-like object read by COPY.
+    """
+
+    def test_read_sizes(self):
+        """
+        Lines are split and buffered to return exactly the size asked.
+        """
+        lines_file = _LinesFile(["ab\n", "cdef\n", "g\n"])
+        self.assertEqual(lines_file.read(3), "ab\n")
+        self.assertEqual(lines_file.read(2), "cd")
+        self.assertEqual(lines_file.read(), "ef\ng\n")
+        self.assertEqual(lines_file.read(5), "")
+
+    def test_read_more_than_available(self):
+        lines_file = _LinesFile(iter(["ab\n", "c\n"]))
+        self.assertEqual(lines_file.read(100), "ab\nc\n")
+        self.assertEqual(lines_file.read(100), "")
+
+
+class PublishScoresTestCase(TransactionTestCase):
+    """
+    TestCase of the publication of scores computed by ml_train.
+
+    Scores are staged in temporary tables dropped at commit, so each
+    publication is committed.
+    """
+
+    _user = "username"
+    _other = "other_username"
+
+    def setUp(self):
+        self.user = User.objects.create(username=self._user)
+        self.other = User.objects.create(username=self._other)
+        self.videos = Video.objects.bulk_create([
+            Video(video_id=f"video_id_0{idx}", name=f"video_id_0{idx}")
+            for idx in range(1, 5)
+        ])
+
+    def _rating(self, user, video, scores, is_public=False):
+        rating = ContributorRating.objects.create(
+            user=user, video=video, is_public=is_public
+        )
+        for criteria, score in scores.items():
+            ContributorRatingCriteriaScore.objects.create(
+                contributor_rating=rating, criteria=criteria, score=score
+            )
+        return rating
+
+    def _contributor_scores(self, user):
+        return {
+            (video_id, criteria): score
+            for video_id, criteria, score in ContributorRatingCriteriaScore.objects.filter(
+                contributor_rating__user=user
+            ).values_list("contributor_rating__video_id", "criteria", "score")
+        }
+
+    def test_video_scores(self):
+        """
+        Changed global scores are updated, new ones created, smaller
+        changes than SCORE_TOLERANCE are not written and vanished scores
+        are deleted only for the criterias trained.
+        """
+        v1, v2, v3, v4 = self.videos
+        VideoCriteriaScore.objects.bulk_create([
+            VideoCriteriaScore(video=v1, criteria="reliability", score=0.5),
+            VideoCriteriaScore(video=v2, criteria="reliability", score=1.0),
+            VideoCriteriaScore(video=v3, criteria="reliability", score=0.3),
+            VideoCriteriaScore(video=v3, criteria="importance", score=0.7),
+        ])
+
+        save_data(
+            [
+                [v1.pk, "reliability", 0.502, 0],
+                [v2.pk, "reliability", 1.5, 0.2],
+                [v4.pk, "reliability", 0.8, 0.1],
+            ],
+            [],
+            ["reliability"],
+        )
+
+        scores = {
+            (video_id, criteria): (score, uncertainty)
+            for video_id, criteria, score, uncertainty in
+            VideoCriteriaScore.objects.values_list(
+                "video_id", "criteria", "score", "uncertainty"
+            )
+        }
+        self.assertEqual(scores, {
+            (v1.pk, "reliability"): (0.5, 0),  # within tolerance, unchanged
+            (v2.pk, "reliability"): (1.5, 0.2),
+            (v3.pk, "importance"): (0.7, 0),  # criteria not trained
+            (v4.pk, "reliability"): (0.8, 0.1),
+        })
+        self.assertEqual(
+            VideoCriteriaScore.objects.get(video=v4, criteria="reliability").quantile, 1.0
+        )
+
+    def test_contributor_scores(self):
+        """
+        Changed local scores are updated, smaller changes than
+        SCORE_TOLERANCE are not written, vanished scores are deleted only
+        for the criterias trained and missing ContributorRatings are
+        created not public.
+        """
+        v1, v2, v3, _ = self.videos
+        self._rating(self.user, v1, {"reliability": 0.5}, is_public=True)
+        self._rating(self.user, v2, {"reliability": 1.0, "importance": 0.7})
+        self._rating(self.other, v1, {"reliability": 0.2})
+
+        save_data(
+            [],
+            [
+                [self.user.id, v1.pk, "reliability", 0.503, 0],
+                [self.user.id, v3.pk, "reliability", -1.0, 0.1],
+                [self.other.id, v1.pk, "reliability", 0.9, 0],
+            ],
+            ["reliability"],
+        )
+
+        self.assertEqual(self._contributor_scores(self.user), {
+            (v1.pk, "reliability"): 0.5,  # within tolerance, unchanged
+            (v2.pk, "importance"): 0.7,  # criteria not trained
+            (v3.pk, "reliability"): -1.0,
+        })
+        self.assertEqual(self._contributor_scores(self.other), {
+            (v1.pk, "reliability"): 0.9,
+        })
+        self.assertTrue(ContributorRating.objects.get(user=self.user, video=v1).is_public)
+        self.assertFalse(ContributorRating.objects.get(user=self.user, video=v3).is_public)
+
+    def test_user_id_limits_deletions(self):
+        """
+        Publishing the scores of one contributor (online refresh) doesn't
+        delete the scores of the others.
+        """
+        v1, v2, _, _ = self.videos
+        self._rating(self.user, v1, {"reliability": 0.5})
+        self._rating(self.other, v1, {"reliability": 0.2})
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            _publish_contributor_scores(
+                cursor,
+                [[self.user.id, v2.pk, "reliability", 0.4, 0]],
+                ["reliability"],
+                self.user.id,
+            )
+
+        self.assertEqual(self._contributor_scores(self.user), {
+            (v2.pk, "reliability"): 0.4,
+        })
+        self.assertEqual(self._contributor_scores(self.other), {
+            (v1.pk, "reliability"): 0.2,
+        })
+
+
+class ToColumnsTestCase(SimpleTestCase):
+    """
+    TestCase of the conversion of fetched rows to typed columns.
+    """
+
+    def assertSameColumns(self, columns, expected):
+        self.assertEqual(columns[0], expected[0])
+        for col, col_expected, dtype in zip(columns[1:], expected[1:], COLUMNS_DTYPES):
+            self.assertEqual(col.dtype, dtype)
+            np.testing.assert_array_equal(col, col_expected)  # nan equal to nan
+
+    def test_same_as_get_columns(self):
+        """
+        Columns built by chunks are those of get_columns(), criteria
+        indexes in first seen order and None scores as nan.
+        """
+        rows = [
+            (3, 10, 11, "reliability", 20.0),
+            (3, 10, 12, "importance", None),
+            (1, 11, 12, "reliability", 100.0),
+            (1, 11, 12, "pedagogy", 0.0),
+            (2, 12, 10, "importance", 50.0),
+        ]
+        columns = _to_columns(iter(rows), chunk_size=2)
+        self.assertEqual(columns[0], ["reliability", "importance", "pedagogy"])
+        self.assertTrue(np.isnan(columns[5][1]))
+        self.assertSameColumns(columns, get_columns([list(row) + [0] for row in rows]))
+
+    def test_empty(self):
+        columns = _to_columns(iter([]))
+        self.assertEqual(columns[0], [])
+        for col, dtype in zip(columns[1:], COLUMNS_DTYPES):
+            self.assertEqual(col.dtype, dtype)
+            self.assertEqual(len(col), 0)
+
+
+class FetchDataTestCase(TestCase):
+    """
+    TestCase of the comparisons fetched for ml_train.
+    """
+
+    _user = "username"
+    _other = "other_username"
+
+    def setUp(self):
+        self.user = User.objects.create(username=self._user)
+        self.other = User.objects.create(username=self._other)
+        self.videos = Video.objects.bulk_create([
+            Video(video_id=f"video_id_0{idx}", name=f"video_id_0{idx}")
+            for idx in range(1, 4)
+        ])
+        v1, v2, v3 = self.videos
+        comparisons = Comparison.objects.bulk_create([
+            Comparison(user=self.user, video_1=v1, video_2=v2),
+            Comparison(user=self.user, video_1=v1, video_2=v3),
+            Comparison(user=self.other, video_1=v3, video_2=v2),
+        ])
+        ComparisonCriteriaScore.objects.bulk_create([
+            ComparisonCriteriaScore(comparison=comparisons[0], criteria="reliability", score=10),
+            ComparisonCriteriaScore(comparison=comparisons[0], criteria="importance", score=60),
+            ComparisonCriteriaScore(comparison=comparisons[1], criteria="reliability", score=0),
+            ComparisonCriteriaScore(comparison=comparisons[2], criteria="pedagogy", score=95),
+        ])
+        self.rows = {
+            (self.user.id, v1.pk, v2.pk, "reliability", 10.0),
+            (self.user.id, v1.pk, v2.pk, "importance", 60.0),
+            (self.user.id, v1.pk, v3.pk, "reliability", 0.0),
+            (self.other.id, v3.pk, v2.pk, "pedagogy", 95.0),
+        }
+
+    def _rows(self, columns):
+        names, users, vid1, vid2, crits, scores = columns
+        return [
+            (user, v1, v2, names[crit], score)
+            for user, v1, v2, crit, score in zip(
+                users.tolist(), vid1.tolist(), vid2.tolist(), crits.tolist(), scores.tolist()
+            )
+        ]
+
+    def test_fetch_data(self):
+        """
+        All comparisons are fetched in typed columns, the same as
+        get_columns() of the same comparisons.
+        """
+        columns = fetch_data()
+        rows = self._rows(columns)
+        self.assertEqual(set(rows), self.rows)
+        self.assertEqual(len(rows), len(self.rows))
+        expected = get_columns([list(row) + [0] for row in rows])
+        self.assertEqual(columns[0], expected[0])  # criterias in first seen order
+        for col, col_expected, dtype in zip(columns[1:], expected[1:], COLUMNS_DTYPES):
+            self.assertEqual(col.dtype, dtype)
+            np.testing.assert_array_equal(col, col_expected)
+
+    def test_fetch_data_of_one_user(self):
+        columns = fetch_data(self.other.id)
+        self.assertEqual(columns[0], ["pedagogy"])
+        self.assertEqual(set(self._rows(columns)), {
+            row for row in self.rows if row[0] == self.other.id
+        })
+
+    def test_fetch_data_empty(self):
+        ComparisonCriteriaScore.objects.all().delete()
+        columns = fetch_data()
+        self.assertEqual(columns[0], [])
+        for col, dtype in zip(columns[1:], COLUMNS_DTYPES):
+            self.assertEqual(col.dtype, dtype)
+            self.assertEqual(len(col), 0)